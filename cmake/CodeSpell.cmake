@@ -21,6 +21,8 @@ set(CODESPELL_WHITELIST
   ${PROJECT_SOURCE_DIR}/src/lj_wbuf.h
   ${PROJECT_SOURCE_DIR}/src/lmisclib.h
   ${PROJECT_SOURCE_DIR}/src/luajit-gdb.py
+  ${PROJECT_SOURCE_DIR}/src/luajit_dbg_core.py
+  ${PROJECT_SOURCE_DIR}/src/luajit_heapdump.py
   ${PROJECT_SOURCE_DIR}/src/luajit_lldb.py
   ${PROJECT_SOURCE_DIR}/test/CMakeLists.txt
   ${PROJECT_SOURCE_DIR}/test/LuaJIT-tests/CMakeLists.txt
@@ -29,6 +31,8 @@ set(CODESPELL_WHITELIST
   ${PROJECT_SOURCE_DIR}/test/PUC-Rio-Lua-5.1-tests/libs/CMakeLists.txt
   ${PROJECT_SOURCE_DIR}/test/lua-Harness-tests/CMakeLists.txt
   ${PROJECT_SOURCE_DIR}/test/tarantool-c-tests
+  ${PROJECT_SOURCE_DIR}/test/tarantool-debugger-bench
+  ${PROJECT_SOURCE_DIR}/test/tarantool-debugger-tests
   ${PROJECT_SOURCE_DIR}/test/tarantool-tests
   ${PROJECT_SOURCE_DIR}/tools
 )
@@ -1,9 +1,16 @@
 # GDB extension for LuaJIT post-mortem analysis.
 # To use, just put 'source <path-to-repo>/src/luajit-gdb.py' in gdb.
 
+import atexit
+import functools
+import inspect
+import os
 import re
 import gdb
+import signal
 import sys
+import threading
+import time
 
 # make script compatible with the ancient Python {{{
 
@@ -18,6 +25,14 @@ if LEGACY:
 
 # }}}
 
+# The debugger-agnostic core is located next to this script, so make it
+# importable regardless of the way the script is sourced.
+sys.path.insert(0, os.path.dirname(os.path.abspath(
+    inspect.getsourcefile(lambda: 0)
+)))
+
+import luajit_dbg_core as core  # noqa: E402
+
 
 gtype_cache = {}
 
@@ -57,6 +72,23 @@ def parse_arg(arg):
     return ret
 
 
+def parse_opts(parser, arg):
+    try:
+        return parser(arg)
+    except ValueError as e:
+        raise gdb.GdbError(str(e))
+
+
+def write_lines(lines):
+    # Every line is written as soon as it is rendered, so the dump of a
+    # huge object can be stopped via Ctrl-C at any moment.
+    try:
+        for line in lines:
+            gdb.write('{}\n'.format(line))
+    except KeyboardInterrupt:
+        gdb.write('Interrupted\n')
+
+
 def tou64(val):
     return cast('uint64_t', val) & 0xFFFFFFFFFFFFFFFF
 
@@ -74,35 +106,102 @@ def strx64(val):
                   hex(int(cast('uint64_t', val) & 0xFFFFFFFFFFFFFFFF)))
 
 
-# Types {{{
-
-
-LJ_T = {
-    'NIL':     i2notu32(0),
-    'FALSE':   i2notu32(1),
-    'TRUE':    i2notu32(2),
-    'LIGHTUD': i2notu32(3),
-    'STR':     i2notu32(4),
-    'UPVAL':   i2notu32(5),
-    'THREAD':  i2notu32(6),
-    'PROTO':   i2notu32(7),
-    'FUNC':    i2notu32(8),
-    'TRACE':   i2notu32(9),
-    'CDATA':   i2notu32(10),
-    'TAB':     i2notu32(11),
-    'UDATA':   i2notu32(12),
-    'NUMX':    i2notu32(13),
-}
+def addr(val):
+    return int(cast('uintptr_t', val))
 
 
-def typenames(value):
-    return {
-        LJ_T[k]: 'LJ_T' + k for k in LJ_T.keys()
-    }.get(int(value), 'LJ_TINVALID')
+# Adapter for the core {{{
+
+
+def read_memory(address, size):
+    return gdb.selected_inferior().read_memory(address, size)
+
+
+def sizeof(typestr):
+    return gtype(typestr).sizeof
+
+
+def fieldof(typestr, field):
+    f = gtype(typestr)[field]
+    return int(f.bitpos / 8), f.type.sizeof
+
+
+def global_state():
+    return addr(G(L(None)))
+
+
+def static_address(name):
+    # gdb.lookup_static_symbol is missing in the older gdb versions.
+    lookup_static = getattr(gdb, 'lookup_static_symbol', None)
+    symbol = lookup_static(name) if lookup_static \
+        else gdb.lookup_symbol(name)[0]
+    return addr(symbol.value().address) if symbol else None
+
+
+def watch_resume(interval):
+    # Let the inferior run for <interval> seconds and interrupt it via
+    # SIGINT: gdb stops the inferior on it and does not pass it further
+    # (see sigint_handling() below). The stop is ours only if it is
+    # caused by SIGINT after the timer has fired: a breakpoint, another
+    # signal or Ctrl-C before it ends the watching. The timer sends
+    # nothing once the stop is reported, so SIGINT is not left pending
+    # for the next resume (but for the short window before gdb reports
+    # the stop). Return the time the interrupt is sent at or None.
+    pid = gdb.selected_inferior().pid
+    lock = threading.Lock()
+    state = {'fired': None, 'stops': []}
+
+    def interrupt():
+        with lock:
+            if not state['stops']:
+                state['fired'] = time.time()
+                os.kill(pid, signal.SIGINT)
+
+    def on_stop(event):
+        with lock:
+            state['stops'].append(event)
+
+    timer = threading.Timer(interval, interrupt)
+    gdb.events.stop.connect(on_stop)
+    try:
+        timer.start()
+        gdb.execute('continue', to_string=True)
+    finally:
+        timer.cancel()
+        gdb.events.stop.disconnect(on_stop)
+    stops = state['stops']
+    if state['fired'] is not None and len(stops) == 1 \
+            and isinstance(stops[0], gdb.SignalEvent) \
+            and stops[0].stop_signal == 'SIGINT':
+        return state['fired']
+    return None
+
+
+def sigint_handling():
+    # Whether gdb stops the inferior on SIGINT and passes it to the
+    # inferior, parsed from the `info signals SIGINT` output:
+    # Signal        Stop  Print  Pass to program  Description
+    # SIGINT        Yes   Yes    No               Interrupt
+    for line in gdb.execute('info signals SIGINT', to_string=True) \
+            .splitlines():
+        fields = line.split()
+        if len(fields) >= 4 and fields[0] == 'SIGINT':
+            return fields[1] == 'Yes', fields[3] == 'Yes'
+    raise gdb.GdbError('Failed to obtain the SIGINT handling')
+
+
+def objfile_build_id():
+    # Build-id of the objfile libluajit is linked into, if any.
+    try:
+        symbol = gdb.lookup_global_symbol('luaJIT_setmode')
+        return symbol.symtab.objfile.build_id
+    except Exception:
+        return None
 
 
 # }}}
 
+
 # Frames {{{
 
 
@@ -193,24 +292,12 @@ LJ_GC64 = None
 LJ_FR2 = None
 LJ_DUALNUM = None
 
-LJ_GCVMASK = ((1 << 47) - 1)
-LJ_TISNUM = None
 PADDING = None
 
-# These constants are meaningful only for 'LJ_64' mode.
-LJ_LIGHTUD_BITS_SEG = 8
-LJ_LIGHTUD_BITS_LO = 47 - LJ_LIGHTUD_BITS_SEG
-LIGHTUD_SEG_MASK = (1 << LJ_LIGHTUD_BITS_SEG) - 1
-LIGHTUD_LO_MASK = (1 << LJ_LIGHTUD_BITS_LO) - 1
-
 
 # }}}
 
 
-def itype(o):
-    return cast('uint32_t', o['it64'] >> 47) if LJ_GC64 else o['it']
-
-
 def mref(typename, obj):
     return cast(typename, obj['ptr64'] if LJ_GC64 else obj['ptr32'])
 
@@ -220,11 +307,6 @@ def gcref(obj):
                 else cast('uintptr_t', obj['gcptr32']))
 
 
-def gcval(obj):
-    return cast('GCobj *', obj['gcptr64'] & LJ_GCVMASK if LJ_GC64
-                else cast('uintptr_t', obj['gcptr32']))
-
-
 def gcnext(obj):
     return gcref(obj)['gch']['nextgc']
 
@@ -249,11 +331,9 @@ def G(L):
 
 
 def J(g):
-    typeGG = gtype('GG_State')
-
     return cast('jit_State *', int(cast('char *', g))
-                - int(typeGG['g'].bitpos / 8)
-                + int(typeGG['J'].bitpos / 8))
+                - core.offsetof('GG_State', 'g')
+                + core.offsetof('GG_State', 'J'))
 
 
 def vm_state(g):
@@ -294,45 +374,6 @@ def jit_state(g):
     }.get(int(J(g)['state']), 'INVALID')
 
 
-def tvisint(o):
-    return LJ_DUALNUM and itype(o) == LJ_TISNUM
-
-
-def tvisnumber(o):
-    return itype(o) <= LJ_TISNUM
-
-
-def tvislightud(o):
-    if LJ_64 and not LJ_GC64:
-        return (cast('int32_t', itype(o)) >> 15) == -2
-    else:
-        return itype(o) == LJ_T['LIGHTUD']
-
-
-def strdata(obj):
-    # String is printed with pointer to it, thanks to gdb. Just strip it.
-    try:
-        return str(cast('char *', cast('GCstr *', obj) + 1))[len(PADDING):]
-    except UnicodeEncodeError:
-        return "<luajit-gdb: error occurred while rendering non-ascii slot>"
-
-
-def itypemap(o):
-    if LJ_64 and not LJ_GC64:
-        return LJ_T['NUMX'] if tvisnumber(o)       \
-            else LJ_T['LIGHTUD'] if tvislightud(o) \
-            else itype(o)
-    else:
-        return LJ_T['NUMX'] if tvisnumber(o) else itype(o)
-
-
-def funcproto(func):
-    assert func['ffid'] == 0
-
-    return cast('GCproto *',
-                mref('char *', func['pc']) - gdb.lookup_type('GCproto').sizeof)
-
-
 def gclistlen(root, end=0x0):
     count = 0
     while (gcref(root) != end):
@@ -374,138 +415,11 @@ def frames(L):
         framelink = frame_prev(framelink)
 
 
-def lightudV(tv):
-    if LJ_64:
-        u = int(tv['u64'])
-        # lightudseg macro expanded.
-        seg = (u >> LJ_LIGHTUD_BITS_LO) & LIGHTUD_SEG_MASK
-        segmap = mref('uint32_t *', G(L(None))['gc']['lightudseg'])
-        # lightudlo macro expanded.
-        return (int(segmap[seg]) << 32) | (u & LIGHTUD_LO_MASK)
-    else:
-        return gcval(tv['gcr'])
-
-
-# Dumpers {{{
-
-
-def dump_lj_tnil(tv):
-    return 'nil'
-
-
-def dump_lj_tfalse(tv):
-    return 'false'
-
-
-def dump_lj_ttrue(tv):
-    return 'true'
-
-
-def dump_lj_tlightud(tv):
-    return 'light userdata @ {}'.format(strx64(lightudV(tv)))
-
-
-def dump_lj_tstr(tv):
-    return 'string {body} @ {address}'.format(
-        body=strdata(gcval(tv['gcr'])),
-        address=strx64(gcval(tv['gcr']))
-    )
-
-
-def dump_lj_tupval(tv):
-    return 'upvalue @ {}'.format(strx64(gcval(tv['gcr'])))
-
-
-def dump_lj_tthread(tv):
-    return 'thread @ {}'.format(strx64(gcval(tv['gcr'])))
-
-
-def dump_lj_tproto(tv):
-    return 'proto @ {}'.format(strx64(gcval(tv['gcr'])))
-
-
-def dump_lj_tfunc(tv):
-    func = cast('struct GCfuncC *', gcval(tv['gcr']))
-    ffid = func['ffid']
-
-    if ffid == 0:
-        pt = funcproto(func)
-        return 'Lua function @ {addr}, {nups} upvalues, {chunk}:{line}'.format(
-            addr=strx64(func),
-            nups=int(func['nupvalues']),
-            chunk=strdata(cast('GCstr *', gcval(pt['chunkname']))),
-            line=pt['firstline']
-        )
-    elif ffid == 1:
-        return 'C function @ {}'.format(strx64(func['f']))
-    else:
-        return 'fast function #{}'.format(int(ffid))
-
-
-def dump_lj_ttrace(tv):
-    trace = cast('struct GCtrace *', gcval(tv['gcr']))
-    return 'trace {traceno} @ {addr}'.format(
-        traceno=strx64(trace['traceno']),
-        addr=strx64(trace)
-    )
-
-
-def dump_lj_tcdata(tv):
-    return 'cdata @ {}'.format(strx64(gcval(tv['gcr'])))
-
-
-def dump_lj_ttab(tv):
-    table = cast('GCtab *', gcval(tv['gcr']))
-    return 'table @ {gcr} (asize: {asize}, hmask: {hmask})'.format(
-        gcr=strx64(table),
-        asize=table['asize'],
-        hmask=strx64(table['hmask']),
-    )
-
-
-def dump_lj_tudata(tv):
-    return 'userdata @ {}'.format(strx64(gcval(tv['gcr'])))
-
-
-def dump_lj_tnumx(tv):
-    if tvisint(tv):
-        return 'integer {}'.format(cast('int32_t', tv['i']))
-    else:
-        return 'number {}'.format(cast('double', tv['n']))
-
-
-def dump_lj_invalid(tv):
-    return 'not valid type @ {}'.format(strx64(gcval(tv['gcr'])))
-
-
-# }}}
-
-
-dumpers = {
-    'LJ_TNIL':     dump_lj_tnil,
-    'LJ_TFALSE':   dump_lj_tfalse,
-    'LJ_TTRUE':    dump_lj_ttrue,
-    'LJ_TLIGHTUD': dump_lj_tlightud,
-    'LJ_TSTR':     dump_lj_tstr,
-    'LJ_TUPVAL':   dump_lj_tupval,
-    'LJ_TTHREAD':  dump_lj_tthread,
-    'LJ_TPROTO':   dump_lj_tproto,
-    'LJ_TFUNC':    dump_lj_tfunc,
-    'LJ_TTRACE':   dump_lj_ttrace,
-    'LJ_TCDATA':   dump_lj_tcdata,
-    'LJ_TTAB':     dump_lj_ttab,
-    'LJ_TUDATA':   dump_lj_tudata,
-    'LJ_TNUMX':    dump_lj_tnumx,
-}
-
-
-def dump_tvalue(tvalue):
-    return dumpers.get(typenames(itypemap(tvalue)), dump_lj_invalid)(tvalue)
-
-
 def dump_framelink_slot_address(fr):
-    return '{}:{}'.format(fr - 1, fr) if LJ_FR2 \
-        else '{}'.format(fr) + PADDING
+    # XXX: The slot addresses are formatted explicitly, since TValue
+    # pointers are rendered by the pretty-printer below otherwise.
+    return '{}:{}'.format(strx64(fr - 1), strx64(fr)) if LJ_FR2 \
+        else strx64(fr) + PADDING
 
 
 def dump_framelink(L, fr):
@@ -520,10 +434,14 @@ def dump_framelink(L, fr):
             p='P' if frame_typep(fr) & FRAME_P else ''
         ),
         d=cast('TValue *', fr) - cast('TValue *', frame_prev(fr)),
-        f=dump_lj_tfunc(fr - LJ_FR2),
+        f=core.dump_lj_tfunc(core.read_tvalue(addr(fr - LJ_FR2))),
     )
 
 
+def dump_tvalue(tvalue):
+    return core.dump_tvalue(core.read_tvalue(addr(tvalue)))
+
+
 def dump_stack_slot(L, slot, base=None, top=None):
     base = base or L['base']
     top = top or L['top']
@@ -538,46 +456,70 @@ def dump_stack_slot(L, slot, base=None, top=None):
     )
 
 
-def dump_stack(L, base=None, top=None):
+def dump_stack(L, base=None, top=None, window=core.WINDOW):
     base = base or L['base']
     top = top or L['top']
     stack = mref('TValue *', L['stack'])
     maxstack = mref('TValue *', L['maxstack'])
     red = 5 + 2 * LJ_FR2
 
-    dump = [
-        '{padding} Red zone: {nredslots: >2} slots {padding}'.format(
-            padding='-' * len(PADDING),
-            nredslots=red,
-        ),
-    ]
-    dump.extend([
-        dump_stack_slot(L, maxstack + offset, base, top)
-            for offset in range(red, 0, -1)  # noqa: E131
-    ])
-    dump.extend([
-        '{padding} Stack: {nstackslots: >5} slots {padding}'.format(
-            padding='-' * len(PADDING),
-            nstackslots=int((tou64(maxstack) - tou64(stack)) >> 3),
-        ),
-        dump_stack_slot(L, maxstack, base, top),
-        '{start}:{end} [    ] {nfreeslots} slots: Free stack slots'.format(
+    # Every slot is yielded as a callable, so it is rendered only if it
+    # falls into the given window (see core.paginate for details).
+    def slot(s):
+        return functools.partial(dump_stack_slot, L, s, base, top)
+
+    def framelink(fr):
+        return functools.partial(dump_framelink, L, fr)
+
+    def freeslots():
+        fmt = '{start}:{end} [    ] {nfreeslots} slots: Free stack slots'
+        return fmt.format(
             start=strx64(top + 1),
             end=strx64(maxstack - 1),
             nfreeslots=int((tou64(maxstack) - tou64(top) - 8) >> 3),
-        ),
-    ])
+        )
 
-    for framelink, frametop in frames(L):
-        # Dump all data slots in the (framelink, top) interval.
-        dump.extend([
-            dump_stack_slot(L, framelink + offset, base, top)
-                for offset in range(frametop - framelink, 0, -1)  # noqa: E131
-        ])
-        # Dump frame slot (2 slots in case of GC64).
-        dump.append(dump_framelink(L, framelink))
+    redzone_header = '{padding} Red zone: {nredslots: >2} slots {padding}'
+    redzone_header = redzone_header.format(
+        padding='-' * len(PADDING),
+        nredslots=red,
+    )
+    stack_header = '{padding} Stack: {nstackslots: >5} slots {padding}'.format(
+        padding='-' * len(PADDING),
+        nstackslots=int((tou64(maxstack) - tou64(stack)) >> 3),
+    )
 
-    return '\n'.join(dump)
+    def from_top():
+        yield redzone_header
+        for offset in range(red, 0, -1):
+            yield slot(maxstack + offset)
+        yield stack_header
+        yield slot(maxstack)
+        yield freeslots
+        for fr, frametop in frames(L):
+            # Dump all data slots in the (framelink, top) interval.
+            for offset in range(frametop - fr, 0, -1):
+                yield slot(fr + offset)
+            # Dump frame slot (2 slots in case of GC64).
+            yield framelink(fr)
+
+    def from_bottom():
+        yield stack_header
+        # Frames are linked from the top to the bottom, so the whole
+        # chain is collected to walk it backwards.
+        for fr, frametop in reversed(list(frames(L))):
+            yield framelink(fr)
+            for offset in range(1, frametop - fr + 1):
+                yield slot(fr + offset)
+        yield freeslots
+        yield slot(maxstack)
+        yield redzone_header
+        for offset in range(1, red + 1):
+            yield slot(maxstack + offset)
+
+    return core.paginate(
+        from_bottom() if window['reverse'] else from_top(), window
+    )
 
 
 def dump_gc(g):
@@ -669,23 +611,17 @@ lj-str <GCstr *>
 
 The command receives a <gcr> of the corresponding GCstr object and dumps
 the payload, size in bytes and hash.
-
-*Caveat*: Since Python 2 provides no native Unicode support, the payload
-is replaced with the corresponding error when decoding fails.
     '''
 
     def invoke(self, arg, from_tty):
         string = cast('GCstr *', parse_arg(arg))
-        gdb.write("String: {body} [{len} bytes] with hash {hash}\n".format(
-            body=strdata(string),
-            hash=strx64(string['hash']),
-            len=string['len'],
-        ))
+        gdb.write('{}\n'.format(core.dump_string(addr(string))))
 
 
 class LJDumpTable(LJBase):
     '''
-lj-tab <GCtab *>
+lj-tab [--limit <N>] [--offset <K>] [--from-top|--from-bottom] [--stats]
+       <GCtab *>
 
 The command receives a GCtab address and dumps the table contents:
 * Metatable address whether the one is set
@@ -693,45 +629,39 @@ The command receives a GCtab address and dumps the table contents:
   <aslot ptr>: [<index>]: <tv>
 * Hash part <hsize> nodes:
   <hnode ptr>: { <tv> } => { <tv> }; next = <next hnode ptr>
+
+The options restrict both array and hash parts independently:
+* --limit <N>: dump at most <N> entries of each part
+* --offset <K>: skip the first <K> entries of each part
+* --from-top: walk each part from the first entry (default)
+* --from-bottom: walk each part from the last entry
+
+If --stats option is given, the summary is dumped instead of the table
+contents:
+* Array part: <asize> slots, <non-nil slots> used (<fill ratio>)
+* Hash part: <hmask + 1> nodes, <non-nil nodes> used (<fill ratio>)
+* Keys outside their main position: <count> (<percentage>)
+* Lookup probes: <average> on average, <maximum> at most
+* Chain length histogram (Node.next chains starting at main positions):
+  <length>: <count> chains
+* Rehash: asize <asize> -> <new asize>, hsize <hsize> -> <new hsize>
+  (<shrinks|grows|keeps size>), i.e. the sizes lj_tab_resize is called
+  with when a non-integer key is inserted into the full hash part
     '''
 
     def invoke(self, arg, from_tty):
-        t = cast('GCtab *', parse_arg(arg))
-        array = mref('TValue *', t['array'])
-        nodes = mref('struct Node *', t['node'])
-        mt = gcval(t['metatable'])
-        capacity = {
-            'apart': int(t['asize']),
-            'hpart': int(t['hmask'] + 1) if t['hmask'] > 0 else 0
-        }
-
-        if mt != 0:
-            gdb.write('Metatable detected: {}\n'.format(strx64(mt)))
-
-        gdb.write('Array part: {} slots\n'.format(capacity['apart']))
-        for i in range(capacity['apart']):
-            slot = array + i
-            gdb.write('{ptr}: [{index}]: {value}\n'.format(
-                ptr=slot,
-                index=i,
-                value=dump_tvalue(slot)
-            ))
-
-        gdb.write('Hash part: {} nodes\n'.format(capacity['hpart']))
-        # See hmask comment in lj_obj.h
-        for i in range(capacity['hpart']):
-            node = nodes + i
-            gdb.write('{ptr}: {{ {key} }} => {{ {val} }}; next = {n}\n'.format(
-                ptr=node,
-                key=dump_tvalue(node['key']),
-                val=dump_tvalue(node['val']),
-                n=mref('struct Node *', node['next'])
-            ))
+        expr, window, stats = parse_opts(core.parse_table, arg)
+        t = cast('GCtab *', parse_arg(expr))
+        if stats:
+            write_lines(core.dump_table_stats(core.table_stats(addr(t))))
+        else:
+            write_lines(core.dump_table(addr(t), window))
 
 
 class LJDumpStack(LJBase):
     '''
-lj-stack [<lua_State *>]
+lj-stack [--limit <N>] [--offset <K>] [--from-top|--from-bottom]
+         [<lua_State *>]
 
 The command receives a lua_State address and dumps the given Lua
 coroutine guest stack:
@@ -759,11 +689,18 @@ coroutine guest stack:
     + CP: Protected C frame
     + PP: VM performs a call as a result of executinig pcall or xpcall
 
+The options restrict the dumped slots (section headers are not counted):
+* --limit <N>: dump at most <N> slots
+* --offset <K>: skip the first <K> slots
+* --from-top: walk the stack from L->maxstack to L->stack (default)
+* --from-bottom: walk the stack from L->stack to L->maxstack
+
 If L is omitted the main coroutine is used.
     '''
 
     def invoke(self, arg, from_tty):
-        gdb.write('{}\n'.format(dump_stack(L(parse_arg(arg)))))
+        expr, window = parse_opts(core.parse_window, arg)
+        write_lines(dump_stack(L(parse_arg(expr)), window=window))
 
 
 class LJState(LJBase):
@@ -813,8 +750,577 @@ The command requires no args and dumps current GC stats:
         ))
 
 
+class LJGCCensus(LJBase):
+    '''
+lj-gc-census [--stride <N>] [--sites <N>] [--arena]
+
+The command walks all GC objects (gc.root list, string table and
+gc.mmudata ring) and dumps the number of objects and bytes occupied by
+them per type, sorted by the occupied memory:
+* <type>: <count> objects, <bytes> bytes
+  <bucket>: <count> objects, <bytes> bytes
+
+Object sizes are computed the same way the GC releases the objects.
+Tables are split into buckets by array and hash part sizes, strings and
+userdata by payload length, traces by machine code size (the machine
+code is accounted within the trace size).
+
+* --stride <N>: decode only every <N>-th object and scale the results,
+  so the census of a huge heap is estimated much faster
+* --sites <N>: dump <N> allocation sites occupying the most memory;
+  functions, prototypes and traces are accounted by <chunk:line> of the
+  corresponding (or starting) prototype
+* --arena: instead of chasing the object lists (a random access per
+  object), scan the segments of the lj_alloc arena sequentially by large
+  pieces and recognize the GC objects among the chunks in use by the
+  header type and the chunk size. The objects larger than 128 KiB are
+  mmapped directly and missed, as well as the variable-length cdata
+
+The walk can be interrupted via Ctrl-C, then the partial results are
+reported.
+    '''
+
+    def invoke(self, arg, from_tty):
+        _, opts = parse_opts(core.parse_census, arg)
+        census = core.gc_census(opts['stride'], opts['sites'] > 0,
+                                opts['arena'])
+        write_lines(core.dump_gc_census(census, opts['stride'],
+                                        opts['sites']))
+
+
+class LJStrtab(LJBase):
+    '''
+lj-strtab [--chains <N>]
+
+The command walks the string interning table (g->strhash) and dumps:
+* Strings: <strnum> in <buckets> buckets (load factor <strnum/buckets>)
+* Interning: <strhash_hit> hits, <strhash_miss> misses
+* Memory: <bytes occupied by the strings> (<payload bytes>)
+* Chain length histogram:
+  <length>: <count> buckets (<percentage>), <strings in such chains>
+* Longest chains:
+  [<bucket>]: <length> strings: <sample strings>
+
+* --chains <N>: the number of the longest chains to dump (10 by default)
+
+The walk can be interrupted via Ctrl-C, then the partial results are
+reported.
+    '''
+
+    def invoke(self, arg, from_tty):
+        _, opts = parse_opts(core.parse_strtab, arg)
+        write_lines(core.dump_strtab(core.strtab_stats(opts['chains'])))
+
+
+class LJTrace(LJBase):
+    '''
+lj-trace
+
+The command requires no args and walks the trace array (J->trace) to dump
+every compiled trace:
+* TRACE <traceno> (<root|side of <root trace>>) @ <GCtrace address>:
+  start <chunk:line>, link <linked trace> (<link type>),
+  mcode <szmcode> bytes @ <mcode address>,
+  IR <instructions>/<constants>, <nsnap> snapshots/<nsnapmap> entries
+
+and the totals compared with the JIT engine parameters:
+* Traces: <count> (<root traces>, <side traces>) of maxtrace <maxtrace>
+* Memory: <bytes occupied by traces, IR, snapshots and mcode>
+* Machine code: <mcode bytes in traces>, <bytes allocated for mcode
+  areas> of maxmcode <maxmcode> (<percentage>)
+
+Dumping is interrupted via Ctrl-C, then the totals are not reported.
+    '''
+
+    def invoke(self, arg, from_tty):
+        write_lines(core.dump_traces())
+
+
+class LJMCode(LJBase):
+    '''
+lj-mcode [<address>]
+
+The command resolves the address within the JIT-compiled machine code
+(the PC of the selected frame, if omitted) to the trace it belongs to:
+* <address> is in TRACE <traceno> @ <GCtrace address>:
+  mcode <mcode address> + <offset>, snapshot #<snapno>,
+  pc <snapshot PC>, <chunk:line of snapshot PC>
+
+The snapshot is the one whose exit covers the given address (the same
+way the VM looks it up on the trace exit). The line is known only if
+the snapshot PC belongs to the starting prototype of the trace.
+
+The lookup is the binary search in the index of all traces and mcode
+areas. The index is built once until the inferior is resumed.
+    '''
+
+    def invoke(self, arg, from_tty):
+        pc = addr(parse_arg(arg)) if arg else int(gdb.selected_frame().pc())
+        gdb.write('{}\n'.format(core.dump_mcode(pc, stop_generation())))
+
+
+class LJThreads(LJBase):
+    '''
+lj-threads [--top <N>] [--by-stacksize|--by-used|--by-depth]
+
+The command walks the gc.root list once and summarizes every coroutine
+(LJ_TTHREAD object) found there, the main one included:
+* <lua_State *> (<status>): stack <used>/<stacksize> slots,
+  <depth> frames, top <top Lua function frame, chunk:current line>
+
+and the totals:
+* Coroutines: <count> (<count per status>)
+* Stacks: <slots allocated>, <slots used>
+
+The status is the one coroutine.status reports. The current line of the
+top Lua frame is unknown for the running coroutine, since the interpreter
+keeps the PC in the register.
+
+* --top <N>: the number of the coroutines to dump (20 by default)
+* --by-stacksize, --by-used, --by-depth: dump the coroutines with the
+  largest stack size (default), used stack slots or number of frames
+
+The walk can be interrupted via Ctrl-C, then the partial results are
+reported.
+    '''
+
+    def invoke(self, arg, from_tty):
+        _, opts = parse_opts(core.parse_threads, arg)
+        write_lines(core.dump_threads(generation=stop_generation(), **opts))
+
+
+class LJHeapdump(LJBase):
+    '''
+lj-heapdump <file>
+
+The command walks all GC objects (gc.root list, string table and
+gc.mmudata ring) once and writes the heap snapshot to the given file:
+every object address, type, size and label (the same lj-gc-census
+reports: the allocation site or the bucket, e.g. the table shape) and
+outgoing references to the other objects:
+* tables: metatable, keys and values (weak ones are marked)
+* functions: environment, prototype and upvalues
+* upvalues: value
+* prototypes: chunk name and GC constants
+* coroutines: environment and stack slots
+* userdata: environment and metatable
+* traces: starting prototype
+
+The GC roots (main coroutine, registry, metamethod names, etc.) are
+written as well. The snapshot is written while walking, and it is read
+offline without the debugger via luajit_heapdump.py located next to
+this extension (see the module for the format):
+$ python3 luajit_heapdump.py <file>
+
+The walk can be interrupted via Ctrl-C, then the partial snapshot is
+written.
+    '''
+
+    def invoke(self, arg, from_tty):
+        if not arg:
+            raise gdb.GdbError('lj-heapdump expects a file name')
+        write_lines(core.dump_heap_snapshot(os.path.expanduser(arg)))
+
+
+class LJRetainers(LJBase):
+    '''
+lj-retainers [--paths <N>] [--depth <N>] <GCobj *>
+
+The command finds the shortest reference paths from the GC roots (main
+coroutine, registry, metamethod names, etc.) to the given GC object and
+reports up to --paths of them (3 by default); every path starts at the
+root and lists the kinds of the references (key, value, metatable,
+upvalue, stack slot, etc.) down to the object. The paths longer than
+--depth references are not searched.
+
+The reverse reference index of the heap is built on the first query
+(all GC objects are walked once, the same way as lj-heapdump does) and
+reused by the next ones until the inferior is resumed. The weak
+references of the weak tables are not followed, since they do not keep
+the object alive. The same search is done offline for the snapshot
+written by lj-heapdump:
+$ python3 luajit_heapdump.py <file> --retainers <address>
+
+The walk can be interrupted via Ctrl-C, then no index is built.
+    '''
+
+    def invoke(self, arg, from_tty):
+        expr, opts = parse_opts(core.parse_retainers, arg)
+        if not expr:
+            raise gdb.GdbError('lj-retainers expects a GC object address')
+        write_lines(core.dump_retainers(
+            addr(parse_arg(expr)), generation=stop_generation(), **opts
+        ))
+
+
+class LJHeapdiff(LJBase):
+    '''
+lj-heapdiff [--top <N>] <old file> [<new file>]
+
+The command compares two heap snapshots written by lj-heapdump (e.g.
+the ones taken from the cores dumped before and after the load test) or
+the snapshot with the current heap, if the second file is omitted (e.g.
+the snapshot taken at one stop with the heap at the later one):
+* the number of objects and bytes per type
+* --top (10 by default) allocation sites (<chunkname>:<firstline> of
+  the functions, prototypes and traces) grown the most
+* --top table shapes (lj-gc-census buckets of the array and hash part
+  sizes) grown the most
+
+The objects are matched by the type, the label (the site or the shape)
+and the size rather than by the address, so the heaps of the different
+processes are compared as well; the objects that are not matched are
+reported as allocated or freed. The objects are counted in the sorted
+runs spilled to the temporary files and merged, so the heaps are never
+kept in memory. The same comparison is done offline:
+$ python3 luajit_heapdump.py <new file> --diff <old file>
+
+The walk can be interrupted via Ctrl-C, then nothing is compared.
+    '''
+
+    def invoke(self, arg, from_tty):
+        expr, opts = parse_opts(core.parse_heapdiff, arg)
+        files = [os.path.expanduser(path) for path in expr.split()]
+        if len(files) not in (1, 2):
+            raise gdb.GdbError('lj-heapdiff expects one or two file names')
+        write_lines(core.dump_heap_diff(*files, **opts))
+
+
+class LJBytecode(LJBase):
+    '''
+lj-bc <GCproto *|GCfunc *>
+
+The command disassembles the bytecode of the given prototype (or the
+prototype of the given Lua function) in the style of jit.bc:
+* -- BYTECODE -- <chunk>:<firstline>-<lastline> @ <GCproto address>
+* <pos> [=>] <opcode> <operands> [; <constant, upvalue or child>]
+
+The branch targets are marked with =>, and the instructions the frames
+of the running coroutine execute (i.e. the frame PCs) are marked with
+->. The bytecode, constants and debug info are fetched by a single read
+of the whole prototype; the decoded prototypes are cached until the
+inferior is resumed, so the frames of the same function are dumped
+without reading the memory again.
+    '''
+
+    def invoke(self, arg, from_tty):
+        if not arg:
+            raise gdb.GdbError('lj-bc expects a GCproto or GCfunc address')
+        write_lines(core.dump_bc(addr(parse_arg(arg)),
+                                 generation=stop_generation()))
+
+
+class LJJitPenalty(LJBase):
+    '''
+lj-jit-penalty [--top <N>]
+
+The command reports the locations the JIT compiler gave up on or keeps
+aborting on, so the cause of the interpreter-only slow path is found
+from a single core:
+* Penalty cache: <used> of <capacity> slots used
+* Blacklisted: <count> instructions, JIT disabled: <count> instructions
+* --top (20 by default) locations ranked by the lost compilation:
+  <chunk:line> (<opcode> @ <PC>): <state>[, last abort: <reason>]
+
+The blacklisted instructions (the loops and function headers patched to
+ILOOP, IFUNCF, etc. after too many aborts) and the ones of the functions
+with JIT disabled via jit.off() are never compiled again, so they go
+first. They are followed by the J->penalty slots ranked by the penalty
+value, which is doubled on every abort and delays the next attempt by
+that number of hot counter ticks. The abort reason is the last one kept
+in the penalty slot; the arguments of the message are not kept.
+
+The prototypes are walked once to find the patched instructions and to
+resolve the PCs. The walk can be interrupted via Ctrl-C, then the
+results are partial.
+    '''
+
+    def invoke(self, arg, from_tty):
+        _, opts = parse_opts(core.parse_penalties, arg)
+        write_lines(core.dump_jit_penalties(generation=stop_generation(),
+                                            **opts))
+
+
+class LJAlloc(LJBase):
+    '''
+lj-alloc
+
+The command requires no args and dumps the state of the lj_alloc
+allocator, so it is seen whether the memory is occupied by the live data
+or wasted by the allocator:
+* lj_alloc state: <address of malloc_state>
+* Segments: <number> segments, <bytes> bytes, then every segment
+* In use: <number> chunks, <bytes> bytes
+* Top chunk: <bytes> (the free space at the end of the segment)
+* Designated victim: <bytes> (the remainder of the last split chunk)
+* Small bins and Tree bins: the free chunks per bin size (range)
+* Direct mmapped (estimated): <bytes> of gc.total not found within the
+  segments; the chunks larger than 128 KiB are mmapped directly and
+  are not linked anywhere, so only the estimate is known
+* GC total: <gc.total>
+* Fragmentation: <free bytes in the top chunk, the designated victim
+  and the bins>, <percentage of gc.total>
+
+The segments are walked sequentially chunk by chunk. The walk can be
+interrupted via Ctrl-C, then the results are partial. Nothing is
+reported if LuaJIT uses the system allocator (LUAJIT_USE_SYSMALLOC).
+    '''
+
+    def invoke(self, arg, from_tty):
+        write_lines(core.dump_alloc())
+
+
+class LJProfbuf(LJBase):
+    '''
+lj-profbuf [<prefix>]
+
+The command reports the state of the memory (memprof) and the sampling
+(sysprof) profilers, so the profile events not yet flushed by the
+writer are not lost if the process crashes while profiling:
+* <profiler>: <idle|profiling|halted>
+* mode: <default|leaf|callgraph>, interval: <sampling interval> ms
+  (sysprof only)
+* samples: <total> (<number of samples per VM state>) (sysprof only)
+* stream: <ok|stopped|I/O error>, <N> of <size> buffer bytes
+  unflushed @ <buffer address>
+
+If <prefix> is given, the unflushed bytes of every profiler are written
+to the <prefix>.memprof.bin and <prefix>.sysprof.bin files with the
+epilogue appended, so they are parsed by tools/memprof.lua and
+tools/sysprof.lua. If nothing has been flushed yet, the file is the
+whole profile, otherwise it is the tail of the profile to be appended to
+the part the writer has already flushed (e.g. to the profile file).
+    '''
+
+    def invoke(self, arg, from_tty):
+        prefix = os.path.expanduser(arg.strip()) if arg.strip() else None
+        write_lines(core.dump_profilers(prefix))
+
+
+class LJMetrics(LJBase):
+    '''
+lj-metrics [--json]
+
+The command dumps the same metrics misc.getmetrics() reports (see
+luam_Metrics in lmisclib.h) computed from global_State and jit_State, so
+the values from a core line up with the time series collected from the
+live process:
+* strhash_hit, strhash_miss: <string interning hits and misses>
+* gc_strnum, gc_tabnum, gc_udatanum, gc_cdatanum: <number of objects>
+* gc_total, gc_freed, gc_allocated: <bytes allocated now, freed and
+  allocated in total>
+* gc_steps_<state>: <number of incremental GC steps per GC state>
+* jit_snap_restore, jit_trace_abort, jit_mcode_size, jit_trace_num:
+  <JIT counters>
+
+With --json, the metrics are dumped as a single JSON object line.
+    '''
+
+    def invoke(self, arg, from_tty):
+        _, opts = parse_opts(core.parse_metrics, arg)
+        write_lines(core.dump_metrics(opts['json']))
+
+
+class LJWatch(LJBase):
+    '''
+lj-watch [--count <N>] <interval> <file>
+
+The command samples the GC and JIT state of the live process every
+<interval> milliseconds, up to --count samples (until interrupted via
+Ctrl-C or until the process stops for another reason by default), and
+writes the time series to the given file: JSON lines if the file name
+ends with .json, CSV otherwise. Every sample has the following fields:
+* time: <UNIX time of the sample>
+* total: <total number of allocated bytes in GC area>
+* debt: <how much GC is behind schedule>
+* gcstate: <GC state>
+* vmstate: <VM state>
+* strnum: <number of strings in the string table>
+* tracenum: <overall number of traces> (with JIT only)
+
+The process is interrupted via SIGINT at every interval and resumed
+right after the sample is taken: the offsets of the fields are computed
+once, so every sample is a single memory read. SIGINT must be handled
+as `stop nopass` (the default), so it never reaches the process. The
+time from the interrupt to the resume per sample is reported when the
+watching is over (the cost of the resume itself is not measured), and
+the process is left stopped.
+    '''
+
+    def invoke(self, arg, from_tty):
+        _, opts = parse_opts(core.parse_watch, arg)
+        inferior = gdb.selected_inferior()
+        connection = getattr(inferior, 'connection', None)
+        if not inferior.pid or not inferior.threads() \
+                or connection is not None and connection.type != 'native':
+            raise gdb.GdbError('lj-watch requires a live native process')
+        stop, passed = sigint_handling()
+        if not stop or passed:
+            raise gdb.GdbError('lj-watch interrupts the process via SIGINT, '
+                               'run `handle SIGINT stop nopass` first')
+        write_lines(core.dump_watch(resume=watch_resume, **opts))
+
+
+# Pretty-printers {{{
+
+
+class TValuePrinter(object):
+    def __init__(self, address):
+        self.address = address
+
+    def to_string(self):
+        return core.dump_tvalue(core.read_tvalue(self.address))
+
+
+class GCstrPrinter(TValuePrinter):
+    def to_string(self):
+        return core.dump_gcstr(self.address)
+
+
+class GCtabPrinter(TValuePrinter):
+    def to_string(self):
+        return core.dump_gctab(self.address)
+
+    def children(self):
+        # The children are fetched page by page only when requested, so
+        # both `print` (limited with `set print elements`) and variable
+        # objects of the IDEs (limited with the visible range) fetch the
+        # needed entries only.
+        capacity = core.table_capacity(self.address)
+        asize, used = capacity
+        tvptr = gtype('TValue *')
+        for start in range(0, asize + len(used), core.CHILDREN_PAGE):
+            for key, slot, _ in core.table_entries(
+                self.address, start, core.CHILDREN_PAGE, capacity
+            ):
+                yield core.dump_key(key), \
+                    gdb.Value(slot).cast(tvptr).dereference()
+
+
+PRINTERS = {
+    'TValue': TValuePrinter,
+    'GCstr':  GCstrPrinter,
+    'GCtab':  GCtabPrinter,
+}
+
+
+def lookup_printer(val):
+    # Both the objects and the pointers to them are pretty-printed.
+    vtype = val.type.strip_typedefs()
+    if vtype.code == gdb.TYPE_CODE_PTR:
+        target = vtype.target().strip_typedefs()
+        printer = PRINTERS.get(target.tag or target.name)
+        address = addr(val) if printer else 0
+    else:
+        printer = PRINTERS.get(vtype.tag or vtype.name)
+        address = addr(val.address) if printer and val.address else 0
+    return printer(address) if address else None
+
+
+def register_pretty_printers():
+    try:
+        import gdb.printing
+    except ImportError:
+        # Pretty-printers are not supported by this gdb.
+        return
+
+    class LuaJITPrettyPrinter(gdb.printing.PrettyPrinter):
+        def __init__(self):
+            super(LuaJITPrettyPrinter, self).__init__('luajit')
+
+        def __call__(self, val):
+            return lookup_printer(val) if self.enabled else None
+
+    gdb.printing.register_pretty_printer(None, LuaJITPrettyPrinter(),
+                                         replace=True)
+
+
+# }}}
+
+
+def register_frame_filter():
+    # Frames executing the JIT-compiled machine code have no symbols,
+    # so gdb shows ?? for them. The decorator names such frames after
+    # the trace and Lua source location the machine code belongs to.
+    # The guest (Lua) frames are put into the native backtrace above
+    # the frame of the assembler VM running them.
+    try:
+        from gdb.FrameDecorator import FrameDecorator
+    except ImportError:
+        # Frame filters are not supported by this gdb.
+        return
+
+    class MCodeDecorator(FrameDecorator):
+        def function(self):
+            frame = self.inferior_frame()
+            if frame.name() is None:
+                try:
+                    found = core.mcode_lookup(int(frame.pc()),
+                                              stop_generation())
+                    if found is not None and 'traceno' in found:
+                        return core.mcode_location(found)
+                except Exception:
+                    # Never break the backtrace.
+                    pass
+            return super(MCodeDecorator, self).function()
+
+    class MCodeFrameFilter(object):
+        def __init__(self):
+            self.name = 'luajit-mcode'
+            self.priority = 100
+            self.enabled = True
+            gdb.frame_filters[self.name] = self
+
+        def filter(self, frame_iter):
+            return (MCodeDecorator(frame) for frame in frame_iter)
+
+    class LuaFrameDecorator(FrameDecorator):
+        # The guest frame has no frame of its own, so the VM frame
+        # running it is decorated.
+        def __init__(self, base, entry):
+            super(LuaFrameDecorator, self).__init__(base)
+            self.entry = entry
+
+        def function(self):
+            return '[Lua] ' + self.entry['name']
+
+        def address(self):
+            return None
+
+        def filename(self):
+            return self.entry['file']
+
+        def line(self):
+            return self.entry['line']
+
+        def frame_args(self):
+            return None
+
+        def frame_locals(self):
+            return None
+
+    class LuaFrameFilter(object):
+        def __init__(self):
+            self.name = 'luajit-lua'
+            self.priority = 90
+            self.enabled = True
+            gdb.frame_filters[self.name] = self
+
+        def filter(self, frame_iter):
+            frames = core.mixed_backtrace(
+                frame_iter, lambda frame: frame.inferior_frame().name(),
+                stop_generation()
+            )
+            return (frame if entry is None
+                    else LuaFrameDecorator(frame, entry)
+                    for frame, entry in frames)
+
+    MCodeFrameFilter()
+    LuaFrameFilter()
+
+
 def init(commands):
-    global LJ_64, LJ_GC64, LJ_FR2, LJ_DUALNUM, LJ_TISNUM, PADDING
+    global LJ_64, LJ_GC64, LJ_FR2, LJ_DUALNUM, PADDING
 
     # XXX Fragile: though connecting the callback looks like a crap but it
     # respects both Python 2 and Python 3 (see #4828).
@@ -852,34 +1358,114 @@ def init(commands):
         connect(load)
         return
 
+    # The flags (as well as the type layout) are cached on disk, so the
+    # debug info lookups are skipped for the already known build.
+    build_id = objfile_build_id()
+    flags = core.cached_flags(build_id)
+
     try:
-        LJ_64 = str(gdb.parse_and_eval('IRT_PTR')) == 'IRT_P64'
-        LJ_FR2 = LJ_GC64 = str(gdb.parse_and_eval('IRT_PGC')) == 'IRT_P64'
-        LJ_DUALNUM = gdb.lookup_global_symbol('lj_lib_checknumber') is not None
+        if flags is None:
+            endian = gdb.execute('show endian', to_string=True)
+            arch = gdb.execute('show architecture', to_string=True)
+            flags = {
+                'lj_64': str(gdb.parse_and_eval('IRT_PTR')) == 'IRT_P64',
+                'lj_gc64': str(gdb.parse_and_eval('IRT_PGC')) == 'IRT_P64',
+                'lj_dualnum':
+                    gdb.lookup_global_symbol('lj_lib_checknumber') is not None,
+                'little_endian': 'little endian' in endian,
+                'x86orx64': 'i386' in arch,
+            }
     except Exception:
         gdb.write('luajit-gdb.py failed to load: '
                   'no debugging symbols found for libluajit\n')
         return
 
+    LJ_64 = flags['lj_64']
+    LJ_FR2 = LJ_GC64 = flags['lj_gc64']
+    LJ_DUALNUM = flags['lj_dualnum']
+
     for name, command in commands.items():
         command(name)
 
     PADDING = ' ' * len(':' + hex((1 << (47 if LJ_GC64 else 32)) - 1))
-    LJ_TISNUM = 0xfffeffff if LJ_64 and not LJ_GC64 else LJ_T['NUMX']
+
+    core.configure(
+        read_memory=read_memory,
+        sizeof=sizeof,
+        fieldof=fieldof,
+        global_state=global_state,
+        static_address=static_address,
+        build_id=build_id,
+        **flags
+    )
+
+    register_frame_filter()
+    register_pretty_printers()
 
     gdb.write('luajit-gdb.py is successfully loaded\n')
 
 
 def load(event=None):
     init({
-        'lj-arch':  LJDumpArch,
-        'lj-tv':    LJDumpTValue,
-        'lj-str':   LJDumpString,
-        'lj-tab':   LJDumpTable,
-        'lj-stack': LJDumpStack,
-        'lj-state': LJState,
-        'lj-gc':    LJGC,
+        'lj-arch':      LJDumpArch,
+        'lj-tv':        LJDumpTValue,
+        'lj-str':       LJDumpString,
+        'lj-tab':       LJDumpTable,
+        'lj-stack':     LJDumpStack,
+        'lj-state':     LJState,
+        'lj-gc':        LJGC,
+        'lj-gc-census': LJGCCensus,
+        'lj-strtab':    LJStrtab,
+        'lj-trace':     LJTrace,
+        'lj-mcode':     LJMCode,
+        'lj-threads':   LJThreads,
+        'lj-heapdump':  LJHeapdump,
+        'lj-retainers': LJRetainers,
+        'lj-heapdiff':  LJHeapdiff,
+        'lj-bc':        LJBytecode,
+        'lj-jit-penalty': LJJitPenalty,
+        'lj-alloc':     LJAlloc,
+        'lj-profbuf':   LJProfbuf,
+        'lj-metrics':   LJMetrics,
+        'lj-watch':     LJWatch,
     })
 
 
+# The traces are neither created nor flushed while the inferior is
+# stopped, so the machine code index (as well as the other per-stop
+# caches) is rebuilt only after the next stop. The caches are dropped as
+# well when the inspected program or process may change: the objfiles
+# are (re)loaded, e.g. by core-file, or the inferiors are changed.
+STOPS = 0
+
+
+def on_change(event=None):
+    global STOPS
+    STOPS += 1
+
+
+def stop_generation():
+    # The key of the per-stop caches. The selected inferior is a part of
+    # it, since switching the inferiors triggers no event.
+    inferior = gdb.selected_inferior()
+    return STOPS, inferior.num, inferior.pid
+
+
+for name in ('stop', 'new_objfile', 'clear_objfiles', 'new_inferior',
+             'inferior_deleted', 'new_thread', 'exited'):
+    # Some of the events are missing in the older gdb versions.
+    if hasattr(gdb.events, name):
+        getattr(gdb.events, name).connect(on_change)
+
+
+def flush_layout(event=None):
+    core.save_cache()
+
+
+# The layout misses are written to the cache once the command is done
+# (the prompt is shown) rather than on every miss. The batch mode shows
+# no prompt, so the cache is flushed at exit as well.
+if hasattr(gdb.events, 'before_prompt'):
+    gdb.events.before_prompt.connect(flush_layout)
+atexit.register(flush_layout)
 load(None)
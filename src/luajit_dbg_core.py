@@ -0,0 +1,3497 @@
+# Debugger-agnostic core of the LuaJIT extensions for gdb and lldb.
+# The module decodes LuaJIT objects right from the raw inferior memory,
+# so it depends neither on gdb nor on lldb. Both luajit-gdb.py and
+# luajit_lldb.py provide a thin adapter (memory reader and type layout
+# lookup) via configure() and use the routines below.
+
+import bisect
+import collections
+import json
+import os
+import re
+import struct
+import sys
+import time
+
+import luajit_heapdump as heapdump
+
+# make script compatible with the ancient Python {{{
+
+
+LEGACY = re.match(r'^2\.', sys.version)
+
+if LEGACY:
+    int = long  # noqa: F821
+    range = xrange  # noqa: F821
+
+
+# }}}
+
+# Const {{{
+
+
+LJ_64 = None
+LJ_GC64 = None
+LJ_FR2 = None
+LJ_DUALNUM = None
+LJ_TARGET_X86ORX64 = None
+
+LJ_GCVMASK = ((1 << 47) - 1)
+LJ_TISNUM = None
+
+# These constants are meaningful only for 'LJ_64' mode.
+LJ_LIGHTUD_BITS_SEG = 8
+LJ_LIGHTUD_BITS_LO = 47 - LJ_LIGHTUD_BITS_SEG
+LIGHTUD_SEG_MASK = (1 << LJ_LIGHTUD_BITS_SEG) - 1
+LIGHTUD_LO_MASK = (1 << LJ_LIGHTUD_BITS_LO) - 1
+
+# Byte order of the inferior in terms of struct module.
+ENDIAN = None
+
+# The number of slots (or nodes) fetched from the inferior by a single
+# read. It is large enough to make the debugger round trip negligible
+# and small enough to survive the garbage sizes of a corrupted object.
+BULK_SLOTS = 1 << 16
+
+UINT_FMT = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+# See lj_obj.h and lj_ctype.h for details.
+LJ_GC_CDATA_VAR = 0x80
+CTSHIFT_NUM = 28
+CTMASK_CID = 0xffff
+CT_HASSIZE = 5
+CT_ATTRIB = 8
+CTSIZE_PTR = None
+
+# See lj_def.h and lj_tab.h for details.
+LJ_MAX_ABITS = 28
+LJ_MAX_ASIZE = (1 << (LJ_MAX_ABITS - 1)) + 1
+HASH_BIAS = -0x04c11db7
+HASH_ROT1 = 14
+HASH_ROT2 = 5
+HASH_ROT3 = 13
+
+# See lj_ir.h for details.
+REF_BIAS = 0x8000
+
+# See jit_trlinkname in lib_jit.c for details.
+TRLINK = ['none', 'root', 'loop', 'tail-recursion', 'up-recursion',
+          'down-recursion', 'interpreter', 'return', 'stitch']
+
+# See lj_frame.h for details.
+FRAME_LUA = 0x0
+FRAME_C = 0x1
+FRAME_CONT = 0x2
+FRAME_VARG = 0x3
+FRAME_TYPE = 0x3
+FRAME_P = 0x4
+FRAME_TYPEP = FRAME_TYPE | FRAME_P
+
+# Symbols of the assembler VM (see buildvm_asm.c): the interpreter runs
+# the guest frames of the whole VM entry within a single native frame.
+VM_SYMBOL = re.compile(r'^lj_(BC|vm|ff|fff|cont)_')
+
+# See JIT_PARAMDEF in lj_jit.h for details.
+JIT_PARAMS = ['maxtrace', 'maxrecord', 'maxirconst', 'maxside', 'maxsnap',
+              'minstitch', 'hotloop', 'hotexit', 'tryside', 'instunroll',
+              'loopunroll', 'callunroll', 'recunroll', 'sizemcode',
+              'maxmcode']
+
+
+# }}}
+
+# Debugger adapter {{{
+
+
+# The callbacks are set by the debugger extension via configure():
+# * read_memory(addr, size): returns a buffer with <size> bytes of the
+#   inferior memory starting at <addr> or raises RuntimeError (or the
+#   subclass of it) if the memory is inaccessible.
+# * sizeof(typename): returns the size of the given type.
+# * fieldof(typename, field): returns a tuple with the offset and the
+#   size of the given field.
+# * global_state(): returns the address of the global_State object.
+# * static_address(name): returns the address of the file-scope static
+#   variable with the given name or None if there is no such variable.
+adapter = {
+    'read_memory':    None,
+    'sizeof':         None,
+    'fieldof':        None,
+    'global_state':   None,
+    'static_address': None,
+}
+
+# Sizes and fields of LuaJIT types are requested from the debugger only
+# once: the debug info lookups are rather slow.
+layout = {}
+
+
+def configure(read_memory, sizeof, fieldof, global_state,
+              lj_64, lj_gc64, lj_dualnum, little_endian, x86orx64,
+              build_id=None, static_address=None):
+    global LJ_64, LJ_GC64, LJ_FR2, LJ_DUALNUM, LJ_TISNUM, ENDIAN, CTSIZE_PTR
+    global LJ_TARGET_X86ORX64
+
+    adapter.update({
+        'read_memory':    read_memory,
+        'sizeof':         sizeof,
+        'fieldof':        fieldof,
+        'global_state':   global_state,
+        'static_address': static_address,
+    })
+    if build_id is None or cache['build_id'] != build_id:
+        layout.clear()
+
+    LJ_64 = lj_64
+    LJ_FR2 = LJ_GC64 = lj_gc64
+    LJ_DUALNUM = lj_dualnum
+    LJ_TISNUM = 0xfffeffff if LJ_64 and not LJ_GC64 else LJ_T['NUMX']
+    CTSIZE_PTR = 8 if LJ_64 else 4
+    ENDIAN = '<' if little_endian else '>'
+    LJ_TARGET_X86ORX64 = x86orx64
+
+    cache.update({
+        'build_id': build_id,
+        'flags': {
+            'lj_64':         lj_64,
+            'lj_gc64':       lj_gc64,
+            'lj_dualnum':    lj_dualnum,
+            'little_endian': little_endian,
+            'x86orx64':      x86orx64,
+        },
+    })
+    preload_layout()
+
+
+def sizeof(typename):
+    key = (typename, None)
+    if key not in layout:
+        layout[key] = adapter['sizeof'](typename)
+        cache['dirty'] = True
+    return layout[key]
+
+
+def fieldof(typename, field):
+    key = (typename, field)
+    if key not in layout:
+        layout[key] = tuple(adapter['fieldof'](typename, field))
+        cache['dirty'] = True
+    return layout[key]
+
+
+def offsetof(typename, field):
+    return fieldof(typename, field)[0]
+
+
+# }}}
+
+# Persistent layout cache {{{
+
+
+# The layout obtained from the debug info is stored on disk keyed by the
+# build-id of the libluajit objfile, so the next debugger sessions skip
+# the (rather slow for the huge debug info) type lookups at all.
+CACHE_VERSION = 1
+
+cache = {
+    'build_id': None,
+    'flags':    None,
+    # Whether the layout is changed since it is loaded or saved. The
+    # layout misses are not saved at once: the debugger extensions call
+    # save_cache() when the command is done.
+    'dirty':    False,
+}
+
+# The types (and their fields) the extensions use the most. Their layout
+# is obtained at once when the cache is created.
+PRELOAD = {
+    'TValue':       (),
+    'GCRef':        (),
+    'GChead':       ('nextgc', 'gct'),
+    'GCstr':        ('nextgc', 'len', 'hash'),
+    'GCtab':        ('array', 'node', 'metatable', 'asize', 'hmask', 'colo',
+                     'marked'),
+    'Node':         ('val', 'key', 'next'),
+    'GCfuncC':      ('ffid', 'nupvalues', 'pc', 'f'),
+    'GCproto':      ('chunkname', 'firstline', 'sizept', 'sizebc',
+                     'lineinfo', 'numline', 'k', 'sizekgc', 'sizekn',
+                     'sizeuv', 'uvinfo', 'flags'),
+    'GCtrace':      ('traceno', 'nins', 'nk', 'nsnap', 'nsnapmap', 'szmcode',
+                     'startpt', 'startpc', 'root', 'link', 'linktype',
+                     'mcode', 'snap', 'snapmap'),
+    'lua_State':    ('stacksize', 'base', 'stack', 'top', 'status'),
+    'GCState':      ('root', 'mmudata', 'lightudseg', 'total'),
+    'global_State': ('gc', 'strhash', 'strmask', 'strnum', 'strhash_hit',
+                     'strhash_miss', 'ctype_state', 'cur_L', 'mainthref'),
+    'GG_State':     ('g', 'J'),
+    'jit_State':    ('trace', 'sizetrace', 'param', 'szallmcarea',
+                     'mcarea', 'penalty'),
+    'HotPenalty':   ('pc', 'val', 'reason'),
+    'MCLink':       ('next', 'size'),
+    'SnapShot':     ('mapofs', 'mcofs', 'nent'),
+    'SnapEntry':    (),
+    'MCode':        (),
+    'BCIns':        (),
+}
+
+
+def cache_path(build_id):
+    root = os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'luajit-dbg', '{}.json'.format(build_id))
+
+
+def cached_flags(build_id):
+    # Load the layout of the given build and return the flags saved
+    # with it, or None if there is no valid cache.
+    if build_id is None:
+        return None
+    try:
+        with open(cache_path(build_id)) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if data.get('version') != CACHE_VERSION:
+        return None
+    layout.clear()
+    cache['dirty'] = False
+    for typename, field, value in data['layout']:
+        layout[(typename, field)] = tuple(value) if field else value
+    cache['build_id'] = build_id
+    return data['flags']
+
+
+def save_cache():
+    if cache['build_id'] is None or not cache['dirty']:
+        return
+    cache['dirty'] = False
+    path = cache_path(cache['build_id'])
+    data = {
+        'version': CACHE_VERSION,
+        'flags':   cache['flags'],
+        'layout':  [[t, f, v] for (t, f), v in sorted(
+            layout.items(), key=lambda e: (e[0][0], e[0][1] or '')
+        )],
+    }
+    try:
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # The directory already exists.
+            pass
+        # Write the cache atomically: another debugger session may read
+        # it at the same time.
+        tmp = '{}.{}'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        # The cache is an optimization only, so just go without it.
+        pass
+
+
+def preload_layout():
+    for typename, fields in PRELOAD.items():
+        try:
+            sizeof(typename)
+            for field in fields:
+                fieldof(typename, field)
+        except Exception:
+            # The type (or the field) is missing in this build, e.g.
+            # GCtrace in the build with JIT disabled.
+            continue
+    save_cache()
+
+
+# }}}
+
+# Memory access {{{
+
+
+def read_memory(addr, size):
+    return adapter['read_memory'](addr, size) if size else b''
+
+
+def unpack_uint(buf, offset, size):
+    return struct.unpack_from(ENDIAN + UINT_FMT[size], buf, offset)[0]
+
+
+def tosigned(val, size):
+    bits = size * 8
+    return val - (1 << bits) if val >> (bits - 1) else val
+
+
+def read_uint(addr, size):
+    return unpack_uint(read_memory(addr, size), 0, size)
+
+
+def read_fields(typename, addr, *fields):
+    # Read the whole object at once and unpack only the requested
+    # fields from the obtained buffer.
+    return unpack_fields(typename, addr, b'', *fields)
+
+
+def unpack_fields(typename, addr, buf, *fields):
+    # Unpack the fields from the buffer already fetched from <addr>,
+    # unless it is too short to contain the whole object.
+    if len(buf) < sizeof(typename):
+        buf = read_memory(addr, sizeof(typename))
+    return [unpack_uint(buf, *fieldof(typename, f)) for f in fields]
+
+
+def read_tvalue(addr):
+    return read_uint(addr, sizeof('TValue'))
+
+
+def chunks(count, reverse=False):
+    # Split <count> items into the (start, length) pieces fetched by a
+    # single read, walking them backwards if <reverse> is set.
+    starts = range(0, count, BULK_SLOTS)
+    for start in (reversed(starts) if reverse else starts):
+        yield start, min(BULK_SLOTS, count - start)
+
+
+def read_tvalues(addr, count, reverse=False):
+    tvsize = sizeof('TValue')
+    for start, n in chunks(count, reverse):
+        base = addr + start * tvsize
+        buf = read_memory(base, n * tvsize)
+        tvs = struct.unpack_from('{}{}Q'.format(ENDIAN, n), buf)
+        for i in (reversed(range(n)) if reverse else range(n)):
+            yield base + i * tvsize, tvs[i]
+
+
+def read_nodes(addr, count, reverse=False):
+    nsize = sizeof('Node')
+    key = offsetof('Node', 'key')
+    val = offsetof('Node', 'val')
+    nxt = fieldof('Node', 'next')
+    for start, n in chunks(count, reverse):
+        base = addr + start * nsize
+        buf = read_memory(base, n * nsize)
+        for i in (reversed(range(n)) if reverse else range(n)):
+            offset = i * nsize
+            yield (
+                base + offset,
+                unpack_uint(buf, offset + key, 8),
+                unpack_uint(buf, offset + val, 8),
+                unpack_uint(buf, offset + nxt[0], nxt[1]),
+            )
+
+
+# }}}
+
+# Output window {{{
+
+
+# The default window covers the whole object.
+WINDOW = {'offset': 0, 'limit': None, 'reverse': False}
+
+
+def parse_options(arg, options, flags=()):
+    # Split the command argument into the expression and the options:
+    # the ones listed in <options> expect a non-negative integer value,
+    # while the ones listed in <flags> have no value at all.
+    opts = {}
+    expr = []
+    argv = (arg or '').split()
+    while argv:
+        token = argv.pop(0)
+        if token in options:
+            if not argv or not argv[0].isdigit():
+                raise ValueError('{} expects a non-negative integer'.format(
+                    token
+                ))
+            opts[token[2:]] = int(argv.pop(0))
+        elif token in flags:
+            opts[token[2:]] = True
+        elif token.startswith('--'):
+            raise ValueError('unknown option {}'.format(token))
+        else:
+            expr.append(token)
+    return ' '.join(expr), opts
+
+
+WINDOW_OPTIONS = ('--limit', '--offset')
+WINDOW_FLAGS = ('--from-top', '--from-bottom')
+
+
+def window_of(opts):
+    window = dict(WINDOW)
+    window.update({k: v for k, v in opts.items() if k in window})
+    if 'from-bottom' in opts:
+        window['reverse'] = True
+    return window
+
+
+def parse_window(arg):
+    # The options restricting the dumped entries: --limit <N>,
+    # --offset <K> and --from-top/--from-bottom.
+    expr, opts = parse_options(arg, WINDOW_OPTIONS, WINDOW_FLAGS)
+    return expr, window_of(opts)
+
+
+def parse_table(arg):
+    # The window options and --stats flag requesting the table summary
+    # instead of its contents.
+    expr, opts = parse_options(arg, WINDOW_OPTIONS,
+                               WINDOW_FLAGS + ('--stats',))
+    return expr, window_of(opts), 'stats' in opts
+
+
+def parse_census(arg):
+    # The options for the walks over all GC objects: --stride <N>,
+    # --sites <N> and --arena.
+    expr, opts = parse_options(arg, ('--stride', '--sites'), ('--arena',))
+    census = {'stride': 1, 'sites': 0, 'arena': False}
+    census.update(opts)
+    if census['stride'] < 1:
+        raise ValueError('--stride expects a positive integer')
+    if census['arena'] and census['stride'] > 1:
+        raise ValueError('--stride is not supported with --arena')
+    return expr, census
+
+
+def parse_strtab(arg):
+    # The options for the string table analysis: --chains <N>.
+    expr, opts = parse_options(arg, ('--chains',))
+    strtab = {'chains': 10}
+    strtab.update(opts)
+    return expr, strtab
+
+
+def select(count, window):
+    # Return the index range of <count> entries covered by the window in
+    # the order the entries are dumped.
+    start = min(window['offset'], count)
+    stop = count if window['limit'] is None \
+        else min(count, start + window['limit'])
+    if window['reverse']:
+        return range(count - 1 - start, count - 1 - stop, -1)
+    return range(start, stop)
+
+
+def paginate(entries, window):
+    # Headers (plain strings) are yielded as is, while the entries are
+    # callables rendered only when they fall into the window. The walk
+    # stops as soon as the window is exhausted.
+    offset = window['offset']
+    limit = window['limit']
+    index = 0
+    for entry in entries:
+        if not callable(entry):
+            yield entry
+            continue
+        if limit is not None and index >= offset + limit:
+            return
+        if index >= offset:
+            yield entry()
+        index += 1
+
+
+# }}}
+
+# Types {{{
+
+
+def i2notu32(val):
+    return ~int(val) & 0xFFFFFFFF
+
+
+LJ_T = {
+    'NIL':     i2notu32(0),
+    'FALSE':   i2notu32(1),
+    'TRUE':    i2notu32(2),
+    'LIGHTUD': i2notu32(3),
+    'STR':     i2notu32(4),
+    'UPVAL':   i2notu32(5),
+    'THREAD':  i2notu32(6),
+    'PROTO':   i2notu32(7),
+    'FUNC':    i2notu32(8),
+    'TRACE':   i2notu32(9),
+    'CDATA':   i2notu32(10),
+    'TAB':     i2notu32(11),
+    'UDATA':   i2notu32(12),
+    'NUMX':    i2notu32(13),
+}
+
+
+def typenames(value):
+    return {
+        LJ_T[k]: 'LJ_T' + k for k in LJ_T.keys()
+    }.get(int(value), 'LJ_TINVALID')
+
+
+# }}}
+
+# TValue decoding {{{
+
+
+# All the decoders below work with the 64-bit pattern of the TValue
+# read from the inferior memory.
+
+
+def itype(u64):
+    if LJ_GC64:
+        # Sign-extend the 17 bits of it64 >> 47 to uint32_t.
+        it = u64 >> 47
+        return it | 0xFFFE0000 if it & 0x10000 else it
+    else:
+        return u64 >> 32
+
+
+def gcval(u64):
+    return u64 & LJ_GCVMASK if LJ_GC64 else u64 & 0xFFFFFFFF
+
+
+def tvisint(u64):
+    return LJ_DUALNUM and itype(u64) == LJ_TISNUM
+
+
+def tvisnumber(u64):
+    return itype(u64) <= LJ_TISNUM
+
+
+def tvislightud(u64):
+    if LJ_64 and not LJ_GC64:
+        # (int32_t)itype(o) >> 15 == -2
+        return (itype(u64) >> 15) == 0x1FFFE
+    else:
+        return itype(u64) == LJ_T['LIGHTUD']
+
+
+def itypemap(u64):
+    if LJ_64 and not LJ_GC64:
+        return LJ_T['NUMX'] if tvisnumber(u64)       \
+            else LJ_T['LIGHTUD'] if tvislightud(u64) \
+            else itype(u64)
+    else:
+        return LJ_T['NUMX'] if tvisnumber(u64) else itype(u64)
+
+
+def intV(u64):
+    i = u64 & 0xFFFFFFFF
+    return i - (1 << 32) if i & 0x80000000 else i
+
+
+def numV(u64):
+    return struct.unpack('d', struct.pack('Q', u64))[0]
+
+
+def lightudV(u64):
+    if LJ_64:
+        # lightudseg macro expanded.
+        seg = (u64 >> LJ_LIGHTUD_BITS_LO) & LIGHTUD_SEG_MASK
+        segmap, = read_fields(
+            'GCState',
+            adapter['global_state']() + offsetof('global_State', 'gc'),
+            'lightudseg',
+        )
+        # lightudlo macro expanded.
+        return (read_uint(segmap + seg * 4, 4) << 32) | (u64 & LIGHTUD_LO_MASK)
+    else:
+        return gcval(u64)
+
+
+# }}}
+
+# Objects {{{
+
+
+def strx64(val):
+    return re.sub('L?$', '', hex(int(val) & 0xFFFFFFFFFFFFFFFF))
+
+
+def strquote(data):
+    # Render the payload the same way debuggers render char arrays.
+    escapes = {
+        ord('"'): '\\"', ord('\\'): '\\\\', ord('\n'): '\\n',
+        ord('\r'): '\\r', ord('\t'): '\\t',
+    }
+    return '"{}"'.format(''.join(
+        escapes.get(c, chr(c) if 0x20 <= c < 0x7f else '\\{:03o}'.format(c))
+        for c in bytearray(data)
+    ))
+
+
+def strdata(addr):
+    length, = read_fields('GCstr', addr, 'len')
+    return strquote(read_memory(addr + sizeof('GCstr'), length))
+
+
+def funcproto(func):
+    pc, = read_fields('GCfuncC', func, 'pc')
+    return pc - sizeof('GCproto')
+
+
+# }}}
+
+# Dumpers {{{
+
+
+def dump_lj_tnil(u64):
+    return 'nil'
+
+
+def dump_lj_tfalse(u64):
+    return 'false'
+
+
+def dump_lj_ttrue(u64):
+    return 'true'
+
+
+def dump_lj_tlightud(u64):
+    return 'light userdata @ {}'.format(strx64(lightudV(u64)))
+
+
+def dump_gcstr(addr):
+    return 'string {body} @ {address}'.format(
+        body=strdata(addr),
+        address=strx64(addr)
+    )
+
+
+def dump_lj_tstr(u64):
+    return dump_gcstr(gcval(u64))
+
+
+def dump_lj_tupval(u64):
+    return 'upvalue @ {}'.format(strx64(gcval(u64)))
+
+
+def dump_lj_tthread(u64):
+    return 'thread @ {}'.format(strx64(gcval(u64)))
+
+
+def dump_lj_tproto(u64):
+    return 'proto @ {}'.format(strx64(gcval(u64)))
+
+
+def dump_lj_tfunc(u64):
+    func = gcval(u64)
+    ffid, nupvalues, pc, f = read_fields(
+        'GCfuncC', func, 'ffid', 'nupvalues', 'pc', 'f'
+    )
+
+    if ffid == 0:
+        chunkname, firstline = read_fields(
+            'GCproto', pc - sizeof('GCproto'), 'chunkname', 'firstline'
+        )
+        return 'Lua function @ {addr}, {nups} upvalues, {chunk}:{line}'.format(
+            addr=strx64(func),
+            nups=nupvalues,
+            chunk=strdata(chunkname),
+            line=tosigned(firstline, 4)
+        )
+    elif ffid == 1:
+        return 'C function @ {}'.format(strx64(f))
+    else:
+        return 'fast function #{}'.format(ffid)
+
+
+def dump_lj_ttrace(u64):
+    trace = gcval(u64)
+    traceno, = read_fields('GCtrace', trace, 'traceno')
+    return 'trace {traceno} @ {addr}'.format(
+        traceno=strx64(traceno),
+        addr=strx64(trace)
+    )
+
+
+def dump_lj_tcdata(u64):
+    return 'cdata @ {}'.format(strx64(gcval(u64)))
+
+
+def dump_gctab(table):
+    asize, hmask = read_fields('GCtab', table, 'asize', 'hmask')
+    return 'table @ {gcr} (asize: {asize}, hmask: {hmask})'.format(
+        gcr=strx64(table),
+        asize=asize,
+        hmask=strx64(hmask),
+    )
+
+
+def dump_lj_ttab(u64):
+    return dump_gctab(gcval(u64))
+
+
+def dump_lj_tudata(u64):
+    return 'userdata @ {}'.format(strx64(gcval(u64)))
+
+
+def dump_lj_tnumx(u64):
+    if tvisint(u64):
+        return 'integer {}'.format(intV(u64))
+    else:
+        # Debuggers render doubles with 17 significant digits.
+        return 'number {:.17g}'.format(numV(u64))
+
+
+def dump_lj_invalid(u64):
+    return 'not valid type @ {}'.format(strx64(gcval(u64)))
+
+
+# }}}
+
+
+dumpers = {
+    'LJ_TNIL':     dump_lj_tnil,
+    'LJ_TFALSE':   dump_lj_tfalse,
+    'LJ_TTRUE':    dump_lj_ttrue,
+    'LJ_TLIGHTUD': dump_lj_tlightud,
+    'LJ_TSTR':     dump_lj_tstr,
+    'LJ_TUPVAL':   dump_lj_tupval,
+    'LJ_TTHREAD':  dump_lj_tthread,
+    'LJ_TPROTO':   dump_lj_tproto,
+    'LJ_TFUNC':    dump_lj_tfunc,
+    'LJ_TTRACE':   dump_lj_ttrace,
+    'LJ_TCDATA':   dump_lj_tcdata,
+    'LJ_TTAB':     dump_lj_ttab,
+    'LJ_TUDATA':   dump_lj_tudata,
+    'LJ_TNUMX':    dump_lj_tnumx,
+}
+
+
+def dump_tvalue(u64):
+    return dumpers.get(typenames(itypemap(u64)), dump_lj_invalid)(u64)
+
+
+def dump_string(addr):
+    length, strhash = read_fields('GCstr', addr, 'len', 'hash')
+    return 'String: {body} [{len} bytes] with hash {hash}'.format(
+        body=strdata(addr),
+        hash=strx64(strhash),
+        len=length,
+    )
+
+
+def dump_table(t, window=WINDOW):
+    array, nodes, mt, asize, hmask = read_fields(
+        'GCtab', t, 'array', 'node', 'metatable', 'asize', 'hmask'
+    )
+    capacity = {
+        'apart': asize,
+        'hpart': hmask + 1 if hmask > 0 else 0
+    }
+
+    if mt != 0:
+        yield 'Metatable detected: {}'.format(strx64(mt))
+
+    # The window is applied to both parts independently, and only the
+    # slots within it are fetched from the inferior.
+    yield 'Array part: {} slots'.format(capacity['apart'])
+    slots = select(capacity['apart'], window)
+    first = min(slots) if slots else 0
+    for i, (slot, tv) in enumerate(read_tvalues(
+        array + first * sizeof('TValue'), len(slots), window['reverse']
+    )):
+        yield '{ptr}: [{index}]: {value}'.format(
+            ptr=strx64(slot),
+            index=slots[i],
+            value=dump_tvalue(tv)
+        )
+
+    yield 'Hash part: {} nodes'.format(capacity['hpart'])
+    # See hmask comment in lj_obj.h
+    nslots = select(capacity['hpart'], window)
+    first = min(nslots) if nslots else 0
+    for node, key, val, n in read_nodes(
+        nodes + first * sizeof('Node'), len(nslots), window['reverse']
+    ):
+        yield '{ptr}: {{ {key} }} => {{ {val} }}; next = {n}'.format(
+            ptr=strx64(node),
+            key=dump_tvalue(key),
+            val=dump_tvalue(val),
+            n=strx64(n)
+        )
+
+
+# Variable views {{{
+
+
+# The number of table entries fetched by a single read for the variable
+# views of the debuggers (pretty-printers and synthetic children): the
+# IDEs request only the visible range of the children.
+CHILDREN_PAGE = 256
+
+
+def table_capacity(t):
+    # The children of the table: the array slots are followed by the
+    # hash nodes in use. Return the array size and the indices of the
+    # used nodes: the empty ones (the nil value) are never rendered, so
+    # the hash part is scanned once to address the children by index.
+    nodes, asize, hmask = read_fields('GCtab', t, 'node', 'asize', 'hmask')
+    hsize = hmask + 1 if hmask > 0 else 0
+    used = [i for i, (_, _, val, _) in enumerate(read_nodes(nodes, hsize))
+            if itype(val) != LJ_T['NIL']]
+    return asize, used
+
+
+def table_entries(t, start, count, capacity=None):
+    # Yield the children [<start>, <start> + <count>) of the table as
+    # (key, value address, value) tuples: the key is the array index
+    # for the array part and the (address, value) pair of the node key
+    # for the hash part. <capacity> is the table_capacity() result.
+    array, nodes = read_fields('GCtab', t, 'array', 'node')
+    asize, used = capacity or table_capacity(t)
+    stop = min(start + count, asize + len(used))
+    if start < asize:
+        n = min(stop, asize) - start
+        for i, (slot, tv) in enumerate(read_tvalues(
+            array + start * sizeof('TValue'), n
+        )):
+            yield start + i, slot, tv
+    used = used[max(start, asize) - asize:max(stop - asize, 0)]
+    if not used:
+        return
+    key = offsetof('Node', 'key')
+    val = offsetof('Node', 'val')
+    # The used nodes of the page are fetched with a single read.
+    nodes += used[0] * sizeof('Node')
+    wanted = set(i - used[0] for i in used)
+    for i, (node, k, v, _) in enumerate(
+        read_nodes(nodes, used[-1] - used[0] + 1)
+    ):
+        if i in wanted:
+            yield (node + key, k), node + val, v
+
+
+def dump_key(key):
+    # The name of the table child: the strings and the numbers are
+    # rendered the way they are written in Lua.
+    if not isinstance(key, tuple):
+        return '[{}]'.format(key)
+    u64 = key[1]
+    tname = typenames(itypemap(u64))
+    if tname == 'LJ_TSTR':
+        return '[{}]'.format(strdata(gcval(u64)))
+    if tname == 'LJ_TNUMX' and tvisint(u64):
+        return '[{}]'.format(intV(u64))
+    if tname == 'LJ_TNUMX':
+        return '[{:.17g}]'.format(numV(u64))
+    return '[{}]'.format(dump_tvalue(u64))
+
+
+# }}}
+
+# GC census {{{
+
+
+# Every function below returns the number of bytes occupied by the GC
+# object (the same as lj_*_free routines release) and the name of the
+# bucket the object belongs to. The buffer contains the object prefix
+# already read from the inferior.
+
+
+def bucket(name, n):
+    # Power of two buckets: 0, 1, 2-3, 4-7, 8-15, etc.
+    if n < 2:
+        return '{} {}'.format(name, n)
+    lo = 1 << (n.bit_length() - 1)
+    return '{} {}-{}'.format(name, lo, 2 * lo - 1)
+
+
+def gcsize_str(obj, buf, ctx):
+    length, = unpack_fields('GCstr', obj, buf, 'len')
+    return sizeof('GCstr') + length + 1, bucket('len', length)
+
+
+def gcsize_upval(obj, buf, ctx):
+    return sizeof('GCupval'), None
+
+
+def gcsize_thread(obj, buf, ctx):
+    stacksize, = unpack_fields('lua_State', obj, buf, 'stacksize')
+    return sizeof('lua_State') + stacksize * sizeof('TValue'), None
+
+
+def gcsize_proto(obj, buf, ctx):
+    sizept, = unpack_fields('GCproto', obj, buf, 'sizept')
+    return sizept, None
+
+
+def gcsize_func(obj, buf, ctx):
+    ffid, nupvalues = unpack_fields('GCfuncC', obj, buf, 'ffid', 'nupvalues')
+    if ffid == 0:
+        # sizeLfunc macro expanded.
+        return sizeof('GCfuncL') + (nupvalues - 1) * sizeof('GCRef'), None
+    # sizeCfunc macro expanded.
+    return sizeof('GCfuncC') + (nupvalues - 1) * sizeof('TValue'), None
+
+
+def gcsize_trace(obj, buf, ctx):
+    nins, nk, nsnap, nsnapmap, szmcode = unpack_fields(
+        'GCtrace', obj, buf, 'nins', 'nk', 'nsnap', 'nsnapmap', 'szmcode'
+    )
+    # IR constants are stored below REF_BIAS and instructions above it,
+    # so the difference is the size of the whole IR buffer. The machine
+    # code is allocated in the mcode area, but it is accounted here too,
+    # since it is released with the trace.
+    return ((sizeof('GCtrace') + 7) & ~7) \
+        + (nins - nk) * sizeof('IRIns') \
+        + nsnap * sizeof('SnapShot') \
+        + nsnapmap * sizeof('SnapEntry') \
+        + szmcode, bucket('mcode', szmcode)
+
+
+def ctype_rawsize(ctx, ctypeid):
+    # ctype_raw and ctype_hassize macros expanded.
+    while True:
+        info, size = read_fields(
+            'CType', ctx['ctypes'] + ctypeid * sizeof('CType'), 'info', 'size'
+        )
+        if info >> CTSHIFT_NUM != CT_ATTRIB:
+            break
+        ctypeid = info & CTMASK_CID
+    return size if info >> CTSHIFT_NUM <= CT_HASSIZE else CTSIZE_PTR
+
+
+def gcsize_cdata(obj, buf, ctx):
+    marked, ctypeid = unpack_fields('GCcdata', obj, buf, 'marked', 'ctypeid')
+    if marked & LJ_GC_CDATA_VAR:
+        # sizecdatav macro expanded.
+        extra, length = read_fields(
+            'GCcdataVar', obj - sizeof('GCcdataVar'), 'extra', 'len'
+        )
+        return length + extra, None
+    if ctypeid not in ctx['ctsizes']:
+        ctx['ctsizes'][ctypeid] = ctype_rawsize(ctx, ctypeid)
+    return sizeof('GCcdata') + ctx['ctsizes'][ctypeid], None
+
+
+def gcsize_tab(obj, buf, ctx):
+    asize, hmask, colo = unpack_fields(
+        'GCtab', obj, buf, 'asize', 'hmask', 'colo'
+    )
+    size = sizeof('GCtab')
+    if colo:
+        # The colocated array part (even the one detached later, when
+        # colo is negative) is allocated together with the header.
+        size += (colo & 0x7f) * sizeof('TValue')
+    if asize > 0 and not 0 < colo < 0x80:
+        size += asize * sizeof('TValue')
+    if hmask > 0:
+        size += (hmask + 1) * sizeof('Node')
+    return size, '{}, {}'.format(
+        bucket('asize', asize),
+        bucket('hsize', hmask + 1 if hmask > 0 else 0),
+    )
+
+
+def gcsize_udata(obj, buf, ctx):
+    length, = unpack_fields('GCudata', obj, buf, 'len')
+    return sizeof('GCudata') + length, bucket('len', length)
+
+
+def protosite(proto, ctx, buf=b''):
+    # Allocation site of the prototype is <chunkname>:<firstline>.
+    if proto not in ctx['sites']:
+        chunkname, firstline = unpack_fields(
+            'GCproto', proto, buf, 'chunkname', 'firstline'
+        )
+        if chunkname not in ctx['chunks']:
+            ctx['chunks'][chunkname] = strdata(chunkname)
+        ctx['sites'][proto] = '{}:{}'.format(
+            ctx['chunks'][chunkname], tosigned(firstline, 4)
+        )
+    return ctx['sites'][proto]
+
+
+def gcsite_proto(obj, buf, ctx):
+    return protosite(obj, ctx, buf)
+
+
+def gcsite_func(obj, buf, ctx):
+    ffid, pc, f = unpack_fields('GCfuncC', obj, buf, 'ffid', 'pc', 'f')
+    if ffid == 0:
+        return protosite(pc - sizeof('GCproto'), ctx)
+    elif ffid == 1:
+        return 'C function @ {}'.format(strx64(f))
+    else:
+        return 'fast function #{}'.format(ffid)
+
+
+def gcsite_trace(obj, buf, ctx):
+    startpt, = unpack_fields('GCtrace', obj, buf, 'startpt')
+    return protosite(startpt, ctx)
+
+
+gcsites = {
+    'LJ_TPROTO': gcsite_proto,
+    'LJ_TFUNC':  gcsite_func,
+    'LJ_TTRACE': gcsite_trace,
+}
+
+
+gcsizes = {
+    'LJ_TSTR':    gcsize_str,
+    'LJ_TUPVAL':  gcsize_upval,
+    'LJ_TTHREAD': gcsize_thread,
+    'LJ_TPROTO':  gcsize_proto,
+    'LJ_TFUNC':   gcsize_func,
+    'LJ_TTRACE':  gcsize_trace,
+    'LJ_TCDATA':  gcsize_cdata,
+    'LJ_TTAB':    gcsize_tab,
+    'LJ_TUDATA':  gcsize_udata,
+}
+
+
+def gcsize_ctx():
+    # The context shared by gcsize_* and gcsite_* routines: the caches
+    # of the sizes of the ctypes and the allocation sites.
+    g = adapter['global_state']()
+    ctypes = 0
+    cts, = read_fields('global_State', g, 'ctype_state')
+    if cts:
+        ctypes, = read_fields('CTState', cts, 'tab')
+    return {'ctypes': ctypes, 'ctsizes': {}, 'sites': {}, 'chunks': {}}
+
+
+def gcobj_prefix():
+    # The number of bytes enough to decode the header and the fields of
+    # any GC object, so an object is usually fetched by a single read.
+    return max(sizeof(t) for t in (
+        'GChead', 'GCstr', 'GCupval', 'lua_State', 'GCproto', 'GCfuncC',
+        'GCtrace', 'GCcdata', 'GCtab', 'GCudata',
+    ))
+
+
+def gclist(obj, fetch, end=0):
+    # Yield the GC objects linked via nextgc field starting from <obj>
+    # until <end> is met. Every object is represented as a tuple of its
+    # address and the buffer obtained via <fetch>, that has to cover at
+    # least the object header.
+    nextgc = fieldof('GChead', 'nextgc')
+    while obj != end:
+        buf = fetch(obj)
+        yield obj, buf
+        obj = unpack_uint(buf, *nextgc)
+
+
+def uvnext_field():
+    # The open upvalue links are the members of the anonymous struct in
+    # the anonymous union following the immutable field, and not every
+    # debugger looks up the anonymous members by the type, so the offset
+    # is computed: the union is aligned as TValue and <next> follows
+    # <prev>.
+    offset, size = fieldof('GCupval', 'immutable')
+    align = sizeof('TValue')
+    union = (offset + size + align - 1) // align * align
+    refsize = sizeof('GCRef')
+    return union + refsize, refsize
+
+
+def gcobjects(fetch):
+    # Yield all GC objects: the ones linked to the gc.root list, the
+    # strings interned in the string table, the objects in the
+    # gc.mmudata ring waiting for finalization and the open upvalues.
+    g = adapter['global_state']()
+    root, mmudata = read_fields(
+        'GCState', g + offsetof('global_State', 'gc'), 'root', 'mmudata'
+    )
+    for obj in gclist(root, fetch):
+        yield obj
+
+    strhash, strmask = read_fields('global_State', g, 'strhash', 'strmask')
+    refsize = sizeof('GCRef')
+    for start, n in chunks(strmask + 1):
+        buf = read_memory(strhash + start * refsize, n * refsize)
+        for i in range(n):
+            for obj in gclist(unpack_uint(buf, i * refsize, refsize), fetch):
+                yield obj
+
+    if mmudata:
+        # XXX: gc.mmudata is a ring-list and points to its last object.
+        for obj in gclist(read_uint(mmudata, refsize), fetch, mmudata):
+            yield obj
+        yield mmudata, fetch(mmudata)
+
+    # XXX: The open upvalues are linked only to the L->openupval lists
+    # and to the g->uvhead ring, but not to gc.root.
+    uvhead = g + offsetof('global_State', 'uvhead')
+    offset, size = uvnext_field()
+    uv = read_uint(uvhead + offset, size)
+    while uv != uvhead:
+        buf = fetch(uv)
+        yield uv, buf
+        uv = unpack_uint(buf, offset, size) if len(buf) >= offset + size \
+            else read_uint(uv + offset, size)
+
+
+def account(stats, key, count, size):
+    entry = stats.setdefault(key, [0, 0])
+    entry[0] += count
+    entry[1] += size
+
+
+def gc_census(stride=1, sites=False, arena=False):
+    # Walk all GC objects and account the number of objects and bytes
+    # per type and per bucket within the type. Only every <stride>-th
+    # object is decoded and the results are scaled accordingly, while
+    # only the header is fetched for the rest ones to follow the list.
+    # If <sites> is set, functions, prototypes and traces are accounted
+    # per allocation site too. If <arena> is set, the lj_alloc arena is
+    # scanned instead of the walk (see arena_census).
+    if arena:
+        return arena_census(sites)
+    ctx = gcsize_ctx()
+    prefix = gcobj_prefix()
+    header = sizeof('GChead')
+    gct = fieldof('GChead', 'gct')
+    census = {'walked': 0, 'interrupted': False, 'types': {}, 'sites': {}}
+
+    def fetch(obj):
+        census['walked'] += 1
+        if (census['walked'] - 1) % stride:
+            return read_memory(obj, header)
+        try:
+            return read_memory(obj, prefix)
+        except Exception:
+            # The object is too close to the end of the mapping.
+            return read_memory(obj, header)
+
+    try:
+        for obj, buf in gcobjects(fetch):
+            if (census['walked'] - 1) % stride:
+                continue
+            tname = typenames(i2notu32(unpack_uint(buf, *gct)))
+            if tname not in gcsizes:
+                tname = 'LJ_TINVALID'
+                size, name = 0, None
+            else:
+                size, name = gcsizes[tname](obj, buf, ctx)
+            stats = census['types'].setdefault(tname, {
+                'count': 0, 'bytes': 0, 'buckets': {},
+            })
+            stats['count'] += stride
+            stats['bytes'] += size * stride
+            if name is not None:
+                account(stats['buckets'], name, stride, size * stride)
+            if sites and tname in gcsites:
+                account(census['sites'], gcsites[tname](obj, buf, ctx),
+                        stride, size * stride)
+    except KeyboardInterrupt:
+        census['interrupted'] = True
+    return census
+
+
+def dump_gc_census(census, stride=1, sites=0):
+    total = {'count': 0, 'bytes': 0}
+    if stride > 1:
+        yield 'Every {}-th object is sampled, the numbers are ' \
+            'estimated'.format(stride)
+    if 'arena' in census:
+        for line in dump_arena(census):
+            yield line
+    if census['interrupted']:
+        yield 'Interrupted after {} objects, the numbers are ' \
+            'partial'.format(census['walked'])
+    for tname, stats in sorted(census['types'].items(),
+                               key=lambda t: -t[1]['bytes']):
+        total['count'] += stats['count']
+        total['bytes'] += stats['bytes']
+        yield '{tname}: {count} objects, {bytes} bytes'.format(
+            tname=tname, **stats
+        )
+        for name, (count, size) in sorted(stats['buckets'].items(),
+                                          key=lambda b: -b[1][1]):
+            yield '\t{name}: {count} objects, {size} bytes'.format(
+                name=name, count=count, size=size,
+            )
+    yield 'Total: {count} objects, {bytes} bytes'.format(**total)
+    if not sites:
+        return
+    yield 'Top {} allocation sites:'.format(sites)
+    for site, (count, size) in sorted(census['sites'].items(),
+                                      key=lambda s: -s[1][1])[:sites]:
+        yield '\t{site}: {count} objects, {size} bytes'.format(
+            site=site, count=count, size=size,
+        )
+
+
+# }}}
+
+# Arena scan {{{
+
+
+# See lj_alloc.c for details.
+PINUSE_BIT = 0x1
+CINUSE_BIT = 0x2
+INUSE_BITS = PINUSE_BIT | CINUSE_BIT
+CHUNK_ALIGN_MASK = 0x7
+DEFAULT_MMAP_THRESHOLD = 128 * 1024
+SMALLBIN_SHIFT = 3
+NSMALLBINS = 32
+TREEBIN_SHIFT = 8
+NTREEBINS = 32
+
+# The size of the piece of the segment read at once.
+ARENA_READ = 1 << 22
+
+
+def chunk_size(request):
+    # request2size macro expanded.
+    word = sizeof('size_t')
+    minchunk = (4 * word + CHUNK_ALIGN_MASK) & ~CHUNK_ALIGN_MASK
+    if request < minchunk - word - 1:
+        return minchunk
+    return (request + word + CHUNK_ALIGN_MASK) & ~CHUNK_ALIGN_MASK
+
+
+def align_as_chunk(addr):
+    # align_as_chunk macro expanded.
+    mem = addr + 2 * sizeof('size_t')
+    return addr + (-mem & CHUNK_ALIGN_MASK)
+
+
+def arena_segments(m):
+    # Yield the base and the size of every segment of the allocator.
+    seg = m + offsetof('struct malloc_state', 'seg')
+    while seg:
+        base, size, seg = read_fields('struct malloc_segment', seg,
+                                      'base', 'size', 'next')
+        yield base, size
+
+
+def arena_state(g):
+    # Return the malloc_state of the lj_alloc allocator or None if
+    # LuaJIT is built with LUAJIT_USE_SYSMALLOC or the allocator is
+    # replaced via lua_newstate.
+    m, = read_fields('global_State', g, 'allocd')
+    if not m:
+        return None
+    # The layout is resolved beforehand, so its lookup failures are
+    # reported as is and only the reads below may fail.
+    offsetof('struct malloc_state', 'seg')
+    for field in ('base', 'size', 'next'):
+        fieldof('struct malloc_segment', field)
+    try:
+        if any(base <= m < base + size for base, size in arena_segments(m)):
+            return m
+    except RuntimeError:
+        # The allocator data is not malloc_state at all, so the segments
+        # point to the inaccessible memory.
+        pass
+    return None
+
+
+def arena_chunks(m, prefix, segments):
+    # Walk the chunks of every segment sequentially (the same way the
+    # dlmalloc traversal does) by ARENA_READ pieces and yield the memory
+    # address, the size, the in-use flag and the buffer with the <prefix>
+    # bytes of every chunk except the top one. The segments walked are
+    # appended to <segments>. The direct chunks (mmapped for the requests
+    # larger than DEFAULT_MMAP_THRESHOLD) are not linked anywhere, so
+    # they are not found.
+    word = sizeof('size_t')
+    fencepost = INUSE_BITS | word
+    top, = read_fields('struct malloc_state', m, 'top')
+    for base, size in arena_segments(m):
+        segments.append((base, size))
+        end = base + size
+        q = align_as_chunk(base)
+        start, buf = q, b''
+        while q < end and q != top:
+            if q + 2 * word + prefix > start + len(buf):
+                start, buf = q, read_memory(q, min(ARENA_READ, end - q))
+                if len(buf) < 2 * word:
+                    break
+            head = unpack_uint(buf, q - start + word, word)
+            csize = head & ~INUSE_BITS
+            if head == fencepost or csize == 0:
+                break
+            mem = q - start + 2 * word
+            yield q + 2 * word, csize, bool(head & CINUSE_BIT), \
+                buf[mem:mem + prefix]
+            q += csize
+
+
+def gcalloc_size(tname, obj, buf, size):
+    # The size of the block allocated for the object itself (the one
+    # gcsize_* reports may include the separate parts of the object).
+    if tname == 'LJ_TTAB':
+        colo, = unpack_fields('GCtab', obj, buf, 'colo')
+        return sizeof('GCtab') + (colo & 0x7f) * sizeof('TValue')
+    if tname == 'LJ_TTHREAD':
+        return sizeof('lua_State')
+    if tname == 'LJ_TTRACE':
+        szmcode, = unpack_fields('GCtrace', obj, buf, 'szmcode')
+        return size - szmcode
+    return size
+
+
+def arena_census(sites=False):
+    # Census of the GC objects (see gc_census) via the sequential scan
+    # of the lj_alloc arena instead of chasing the object lists: every
+    # chunk in use starting with the GC object header of the valid type
+    # and having the size the object requires is accounted. The main
+    # coroutine is embedded into GG_State, so it is recognized by its
+    # address.
+    g = adapter['global_state']()
+    mainthref, = read_fields('global_State', g, 'mainthref')
+    m = arena_state(g)
+    census = {'walked': 0, 'interrupted': False, 'types': {}, 'sites': {},
+              'arena': {'segments': [], 'chunks': 0, 'inuse': 0,
+                        'objects': 0, 'valid': m is not None}}
+    if m is None:
+        return census
+    ctx = gcsize_ctx()
+    prefix = gcobj_prefix()
+    gct = fieldof('GChead', 'gct')
+    arena = census['arena']
+    try:
+        for obj, csize, inuse, buf in arena_chunks(m, prefix,
+                                                   arena['segments']):
+            if not inuse:
+                continue
+            arena['chunks'] += 1
+            arena['inuse'] += csize
+            census['walked'] += 1
+            if len(buf) < gct[0] + gct[1]:
+                continue
+            tname = typenames(i2notu32(unpack_uint(buf, *gct)))
+            if tname not in gcsizes:
+                continue
+            size, name = gcsizes[tname](obj, buf, ctx)
+            if obj != mainthref \
+                    and chunk_size(gcalloc_size(tname, obj, buf, size)) \
+                    != csize:
+                continue
+            arena['objects'] += 1
+            stats = census['types'].setdefault(tname, {
+                'count': 0, 'bytes': 0, 'buckets': {},
+            })
+            stats['count'] += 1
+            stats['bytes'] += size
+            if name is not None:
+                account(stats['buckets'], name, 1, size)
+            if sites and tname in gcsites:
+                account(census['sites'], gcsites[tname](obj, buf, ctx),
+                        1, size)
+    except KeyboardInterrupt:
+        census['interrupted'] = True
+    return census
+
+
+def dump_arena(census):
+    arena = census['arena']
+    if not arena['valid']:
+        yield 'The allocator is not lj_alloc (LUAJIT_USE_SYSMALLOC or ' \
+            'custom lua_Alloc), the arena is not scanned'
+        return
+    yield 'Arena: {} segments, {} bytes, {} chunks in use ({} bytes), {} ' \
+        'GC objects'.format(
+            len(arena['segments']), sum(s for _, s in arena['segments']),
+            arena['chunks'], arena['inuse'], arena['objects'],
+        )
+    yield 'The objects larger than {} bytes are mmapped directly and ' \
+        'not scanned, the variable-length cdata is not ' \
+        'recognized'.format(DEFAULT_MMAP_THRESHOLD)
+
+
+def tree_index(size):
+    # compute_tree_index macro expanded.
+    x = size >> TREEBIN_SHIFT
+    if x == 0:
+        return 0
+    if x > 0xFFFF:
+        return NTREEBINS - 1
+    k = x.bit_length() - 1
+    return (k << 1) + ((size >> (k + TREEBIN_SHIFT - 1)) & 1)
+
+
+def tree_minsize(index):
+    # minsize_for_tree_index macro expanded.
+    shift = (index >> 1) + TREEBIN_SHIFT
+    return (1 << shift) | ((index & 1) << (shift - 1))
+
+
+def alloc_stats():
+    # Walk the lj_alloc arena and account the chunks in use and the free
+    # ones per bin they belong to. Every free chunk except the top and
+    # the designated victim (the remainder of the last split, kept aside
+    # of the bins) is linked into the small bin of its exact size or the
+    # tree bin of its size range, so the sequential walk gives the same
+    # histograms as the bin traversal without chasing the lists.
+    g = adapter['global_state']()
+    total, = read_fields('GCState', g + offsetof('global_State', 'gc'),
+                         'total')
+    m = arena_state(g)
+    stats = {'total': total, 'state': m, 'interrupted': False,
+             'segments': [], 'chunks': 0, 'inuse': 0, 'usable': 0,
+             'small': {}, 'tree': {}, 'dv': 0, 'top': 0}
+    if m is None:
+        return stats
+    dv, dvsize, topsize = read_fields('struct malloc_state', m,
+                                      'dv', 'dvsize', 'topsize')
+    stats['dv'] = dvsize
+    stats['top'] = topsize
+    word = sizeof('size_t')
+    try:
+        for mem, csize, inuse, _ in arena_chunks(m, 0, stats['segments']):
+            if inuse:
+                stats['chunks'] += 1
+                stats['inuse'] += csize
+                # The allocator itself is not accounted in gc.total.
+                if mem != m:
+                    stats['usable'] += csize - word
+            elif mem - 2 * word == dv:
+                continue
+            elif csize >> SMALLBIN_SHIFT < NSMALLBINS:
+                account(stats['small'], csize >> SMALLBIN_SHIFT, 1, csize)
+            else:
+                account(stats['tree'], tree_index(csize), 1, csize)
+    except KeyboardInterrupt:
+        stats['interrupted'] = True
+    return stats
+
+
+def dump_alloc():
+    stats = alloc_stats()
+    if stats['state'] is None:
+        yield 'The allocator is not lj_alloc (LUAJIT_USE_SYSMALLOC or ' \
+            'custom lua_Alloc), nothing to report'
+        return
+    if stats['interrupted']:
+        yield 'Interrupted, the arena is walked partially'
+    yield 'lj_alloc state: {}'.format(strx64(stats['state']))
+    yield 'Segments: {} segments, {} bytes'.format(
+        len(stats['segments']), sum(s for _, s in stats['segments'])
+    )
+    for base, size in stats['segments']:
+        yield '\t{}: {} bytes'.format(strx64(base), size)
+    yield 'In use: {chunks} chunks, {inuse} bytes'.format(**stats)
+    yield 'Top chunk: {top} bytes'.format(**stats)
+    yield 'Designated victim: {dv} bytes'.format(**stats)
+    free = stats['top'] + stats['dv']
+    for kind, bins in (('Small', stats['small']), ('Tree', stats['tree'])):
+        yield '{} bins: {} free chunks, {} bytes'.format(
+            kind, sum(c for c, _ in bins.values()),
+            sum(b for _, b in bins.values()),
+        )
+        for index in sorted(bins):
+            count, size = bins[index]
+            free += size
+            if kind == 'Small':
+                limits = '{}'.format(index << SMALLBIN_SHIFT)
+            elif index == NTREEBINS - 1:
+                limits = '{}+'.format(tree_minsize(index))
+            else:
+                limits = '{}-{}'.format(tree_minsize(index),
+                                        tree_minsize(index + 1) - 1)
+            yield '\t{} bytes: {} chunks, {} bytes'.format(limits, count,
+                                                           size)
+    # The direct chunks are not linked anywhere, so only the part of
+    # gc.total not fitting into the chunks in use is known.
+    yield 'Direct mmapped (estimated): {} bytes'.format(
+        max(stats['total'] - stats['usable'], 0)
+    )
+    yield 'GC total: {} bytes'.format(stats['total'])
+    yield 'Fragmentation: {} free bytes, {:.1f}% of GC total'.format(
+        free, 100.0 * free / stats['total'] if stats['total'] else 0
+    )
+
+
+# }}}
+
+# String table {{{
+
+
+def strchains(strhash, strmask):
+    # Yield the string table chains: the bucket index and the list of
+    # (address, length) pairs of the strings chained there. All bucket
+    # anchors are fetched in bulk and each string is fetched by a single
+    # read of its header.
+    refsize = sizeof('GCRef')
+    nextgc = fieldof('GCstr', 'nextgc')
+    length = fieldof('GCstr', 'len')
+    for start, n in chunks(strmask + 1):
+        buf = read_memory(strhash + start * refsize, n * refsize)
+        for i in range(n):
+            chain = []
+            obj = unpack_uint(buf, i * refsize, refsize)
+            while obj:
+                header = read_memory(obj, sizeof('GCstr'))
+                chain.append((obj, unpack_uint(header, *length)))
+                obj = unpack_uint(header, *nextgc)
+            yield start + i, chain
+
+
+def strtab_stats(chains=10):
+    # Walk the whole string table and collect the chain length
+    # histogram, the total size of the interned strings and <chains>
+    # longest chains.
+    g = adapter['global_state']()
+    strhash, strmask, strnum, hit, miss = read_fields(
+        'global_State', g, 'strhash', 'strmask', 'strnum',
+        'strhash_hit', 'strhash_miss'
+    )
+    stats = {
+        'buckets': strmask + 1, 'strnum': strnum, 'hit': hit, 'miss': miss,
+        'walked': 0, 'bytes': 0, 'payload': 0, 'histogram': {},
+        'longest': [], 'interrupted': False,
+    }
+    try:
+        for i, chain in strchains(strhash, strmask):
+            stats['walked'] += len(chain)
+            account(stats['histogram'], len(chain), 1, len(chain))
+            for _, length in chain:
+                # sizestring macro expanded.
+                stats['bytes'] += sizeof('GCstr') + length + 1
+                stats['payload'] += length
+            longest = stats['longest']
+            if chain and (len(longest) < chains
+                          or len(chain) > longest[-1][0]):
+                longest.append((len(chain), i, chain))
+                longest.sort(key=lambda c: -c[0])
+                del longest[chains:]
+    except KeyboardInterrupt:
+        stats['interrupted'] = True
+    return stats
+
+
+def strsample(addr, length, limit=32):
+    # Render only the beginning of the long strings.
+    return strquote(read_memory(addr + sizeof('GCstr'), min(length, limit))) \
+        + ('...' if length > limit else '')
+
+
+def dump_strtab(stats, samples=3):
+    if stats['interrupted']:
+        yield 'Interrupted after {} strings, the numbers are ' \
+            'partial'.format(stats['walked'])
+    yield 'Strings: {strnum} in {buckets} buckets ' \
+        '(load factor {load:.2f})'.format(
+            load=float(stats['strnum']) / stats['buckets'], **stats
+        )
+    yield 'Interning: {hit} hits, {miss} misses'.format(**stats)
+    yield 'Memory: {bytes} bytes ({payload} bytes of payload)'.format(
+        **stats
+    )
+    yield 'Chain length histogram:'
+    for length, (count, nstr) in sorted(stats['histogram'].items()):
+        yield '\t{length}: {count} buckets ({pct:.2f}%), {nstr} ' \
+            'strings'.format(
+                length=length, count=count, nstr=nstr,
+                pct=100.0 * count / stats['buckets'],
+            )
+    yield 'Longest chains:'
+    for length, i, chain in stats['longest']:
+        yield '\t[{i}]: {length} strings: {sample}{more}'.format(
+            i=i,
+            length=length,
+            sample=', '.join(strsample(s, n) for s, n in chain[:samples]),
+            more=', ...' if length > samples else '',
+        )
+
+
+# }}}
+
+# Table statistics {{{
+
+
+def rol32(val, n):
+    return ((val << n) | (val >> (32 - n))) & 0xFFFFFFFF
+
+
+def hashrot(lo, hi):
+    # Mirrors hashrot from lj_tab.h.
+    if LJ_TARGET_X86ORX64:
+        lo ^= hi
+        hi = rol32(hi, HASH_ROT1)
+        lo = (lo - hi) & 0xFFFFFFFF
+        hi = rol32(hi, HASH_ROT2)
+        hi ^= lo
+        hi = (hi - rol32(lo, HASH_ROT3)) & 0xFFFFFFFF
+    else:
+        lo ^= hi
+        lo = (lo - rol32(hi, HASH_ROT1)) & 0xFFFFFFFF
+        hi = lo ^ rol32(hi, HASH_ROT1 + HASH_ROT2)
+        hi = (hi - rol32(lo, HASH_ROT3)) & 0xFFFFFFFF
+    return hi
+
+
+def hashkey(u64):
+    # Mirrors hashkey from lj_tab.c, but returns the hash value instead
+    # of the node, so it should be masked with the table hmask.
+    itype = itypemap(u64)
+    lo = u64 & 0xFFFFFFFF
+    if itype == LJ_T['STR']:
+        strhash, = read_fields('GCstr', gcval(u64), 'hash')
+        return strhash
+    elif itype == LJ_T['NUMX']:
+        return hashrot(lo, (u64 >> 31) & 0xFFFFFFFE)
+    elif itype in (LJ_T['FALSE'], LJ_T['TRUE']):
+        return 1 if itype == LJ_T['TRUE'] else 0
+    elif LJ_GC64:
+        return hashrot(lo, u64 >> 32)
+    else:
+        return hashrot(lo, (lo + HASH_BIAS) & 0xFFFFFFFF)
+
+
+def fls(val):
+    return val.bit_length() - 1
+
+
+def countint(u64, bins):
+    # Mirrors countint from lj_tab.c.
+    if itypemap(u64) != LJ_T['NUMX'] or tvisint(u64):
+        return 0
+    n = numV(u64)
+    if 0 <= n < LJ_MAX_ASIZE and n == int(n):
+        k = int(n)
+        bins[fls(k - 1) if k > 2 else 0] += 1
+        return 1
+    return 0
+
+
+def countarray(values, bins):
+    # Mirrors countarray from lj_tab.c.
+    na = i = 0
+    if not values:
+        return 0
+    for b in range(LJ_MAX_ABITS):
+        top = 2 << b
+        if top >= len(values):
+            top = len(values) - 1
+            if i > top:
+                break
+        n = sum(1 for v in values[i:top + 1] if itype(v) != LJ_T['NIL'])
+        i = top + 1
+        bins[b] += n
+        na += n
+    return na
+
+
+def bestasize(bins, narray):
+    # Mirrors bestasize from lj_tab.c, returns the new array part size
+    # and the number of keys moved to it.
+    total = na = sz = b = 0
+    while b < LJ_MAX_ABITS and 2 * narray > (1 << b) and total != narray:
+        if bins[b] > 0:
+            total += bins[b]
+            if 2 * total > (1 << b):
+                sz = (2 << b) + 1
+                na = total
+        b += 1
+    return sz, na
+
+
+def hsize2hbits(size):
+    return 0 if not size else 1 if size == 1 else 1 + fls(size - 1)
+
+
+def table_stats(t):
+    array, node, asize, hmask = read_fields(
+        'GCtab', t, 'array', 'node', 'asize', 'hmask'
+    )
+    hsize = hmask + 1 if hmask > 0 else 0
+    nsize = sizeof('Node')
+    stats = {
+        'asize': asize, 'hsize': hsize, 'afill': 0, 'hfill': 0,
+        'outside': 0, 'probes': 0, 'maxprobes': 0, 'chains': {},
+    }
+
+    values = [tv for _, tv in read_tvalues(array, asize)]
+    stats['afill'] = sum(1 for tv in values if itype(tv) != LJ_T['NIL'])
+
+    keys = {}
+    links = {}
+    for addr, key, val, n in read_nodes(node, hsize):
+        i = (addr - node) // nsize
+        links[i] = (n - node) // nsize if n else None
+        if itype(val) != LJ_T['NIL']:
+            keys[i] = key
+    stats['hfill'] = len(keys)
+
+    def chain(start):
+        # Follow Node.next links from the main position, the number of
+        # steps is bounded to survive the corrupted links.
+        i = start
+        for _ in range(hsize):
+            yield i
+            i = links.get(i)
+            if i is None:
+                return
+
+    heads = set()
+    for i, key in keys.items():
+        mainpos = hashkey(key) & hmask
+        heads.add(mainpos)
+        if mainpos != i:
+            stats['outside'] += 1
+        for probes, j in enumerate(chain(mainpos), 1):
+            if j == i:
+                break
+        stats['probes'] += probes
+        stats['maxprobes'] = max(stats['maxprobes'], probes)
+    for mainpos in heads:
+        account(stats['chains'], len(list(chain(mainpos))), 1, 0)
+
+    # Emulate rehashtab from lj_tab.c on inserting a non-integer key.
+    bins = [0] * LJ_MAX_ABITS
+    narray = countarray(values, bins)
+    total = 1 + narray + len(keys)
+    narray += sum(countint(key, bins) for key in keys.values())
+    nasize, na = bestasize(bins, narray)
+    hbits = hsize2hbits(total - na)
+    stats['rehash'] = {'asize': nasize, 'hsize': 1 << hbits if hbits else 0}
+    return stats
+
+
+def percent(part, total):
+    return 100.0 * part / total if total else 0.0
+
+
+def dump_table_stats(stats):
+    yield 'Array part: {asize} slots, {afill} used ({pct:.2f}%)'.format(
+        pct=percent(stats['afill'], stats['asize']), **stats
+    )
+    yield 'Hash part: {hsize} nodes, {hfill} used ({pct:.2f}%)'.format(
+        pct=percent(stats['hfill'], stats['hsize']), **stats
+    )
+    if stats['hfill']:
+        yield 'Keys outside their main position: {outside} ' \
+            '({pct:.2f}%)'.format(
+                pct=percent(stats['outside'], stats['hfill']), **stats
+            )
+        yield 'Lookup probes: {avg:.2f} on average, {maxprobes} at ' \
+            'most'.format(
+                avg=float(stats['probes']) / stats['hfill'], **stats
+            )
+        yield 'Chain length histogram:'
+        for length, (count, _) in sorted(stats['chains'].items()):
+            yield '\t{}: {} chains'.format(length, count)
+    rehash = stats['rehash']
+    current = stats['asize'] * sizeof('TValue') \
+        + stats['hsize'] * sizeof('Node')
+    resized = rehash['asize'] * sizeof('TValue') \
+        + rehash['hsize'] * sizeof('Node')
+    yield 'Rehash: asize {asize} -> {nasize}, hsize {hsize} -> ' \
+        '{nhsize} ({verdict})'.format(
+            nasize=rehash['asize'],
+            nhsize=rehash['hsize'],
+            verdict='shrinks' if resized < current
+            else 'grows' if resized > current else 'keeps size',
+            **stats
+        )
+
+
+# }}}
+
+# Line info {{{
+
+
+# Line tables of the prototypes fetched during the <generation> (e.g.
+# the debugger stop): the prototypes are neither created nor collected
+# until the inferior is resumed, so every line table is read only once
+# for the whole backtrace.
+linecache = {'generation': None, 'protos': {}}
+
+
+def protolines(proto, generation=None):
+    # Fetch the prototype header and the whole lineinfo array of it by
+    # two reads. The result is cached, unless <generation> is omitted.
+    if generation is not None and linecache['generation'] != generation:
+        linecache.update({'generation': generation, 'protos': {}})
+    if generation is not None and proto in linecache['protos']:
+        return linecache['protos'][proto]
+    buf = read_memory(proto, sizeof('GCproto'))
+    chunkname, firstline, sizebc, lineinfo, numline = unpack_fields(
+        'GCproto', proto, buf,
+        'chunkname', 'firstline', 'sizebc', 'lineinfo', 'numline'
+    )
+    size = 1 if numline < 256 else 2 if numline < 65536 else 4
+    lines = {
+        'chunkname': chunkname,
+        'firstline': tosigned(firstline, 4),
+        'numline': numline,
+        'sizebc': sizebc,
+        'size': size,
+        # There is no line info for the FUNC* instruction at pos 0.
+        'lineinfo': None if not lineinfo
+        else read_memory(lineinfo, (sizebc - 1) * size) if sizebc > 1
+        else b'',
+    }
+    if generation is not None:
+        linecache['protos'][proto] = lines
+    return lines
+
+
+def bcpos(proto, pc):
+    # proto_bcpos macro expanded.
+    return (pc - proto - sizeof('GCproto')) // sizeof('BCIns')
+
+
+def bcline(lines, pos):
+    # lj_debug_line expanded for the fetched line table.
+    if lines['lineinfo'] is None or not 0 <= pos <= lines['sizebc']:
+        return 0
+    if pos == lines['sizebc']:
+        return lines['firstline'] + lines['numline']
+    if pos == 0:
+        return lines['firstline']
+    return lines['firstline'] + unpack_uint(
+        lines['lineinfo'], (pos - 1) * lines['size'], lines['size']
+    )
+
+
+def protoline(proto, pc, generation=None):
+    # Source line of the bytecode at <pc>.
+    return bcline(protolines(proto, generation), bcpos(proto, pc))
+
+
+# }}}
+
+# Traces {{{
+
+
+def jit_state_addr():
+    # J(g) macro expanded.
+    g = adapter['global_state']()
+    return g - offsetof('GG_State', 'g') + offsetof('GG_State', 'J')
+
+
+def jit_params(J):
+    offset, size = fieldof('jit_State', 'param')
+    buf = read_memory(J + offset, size)
+    return dict((name, tosigned(unpack_uint(buf, 4 * i, 4), 4))
+                for i, name in enumerate(JIT_PARAMS[:size // 4]))
+
+
+def traces(J):
+    # Yield the address and the header of every trace in J->trace.
+    # The trace array is fetched in bulk and each trace header is
+    # fetched by a single read.
+    trace, sizetrace = read_fields('jit_State', J, 'trace', 'sizetrace')
+    refsize = sizeof('GCRef')
+    for start, n in chunks(sizetrace):
+        buf = read_memory(trace + start * refsize, n * refsize)
+        for i in range(n):
+            obj = unpack_uint(buf, i * refsize, refsize)
+            if obj:
+                yield obj, read_memory(obj, sizeof('GCtrace'))
+
+
+def tracestart(obj, buf, ctx):
+    # Starting location of the trace is <chunkname>:<line>.
+    startpt, startpc = unpack_fields('GCtrace', obj, buf, 'startpt', 'startpc')
+    chunkname, = read_fields('GCproto', startpt, 'chunkname')
+    if chunkname not in ctx['chunks']:
+        ctx['chunks'][chunkname] = strdata(chunkname)
+    return '{}:{}'.format(ctx['chunks'][chunkname],
+                          protoline(startpt, startpc))
+
+
+def dump_traces():
+    # Dump every compiled trace and the totals compared with the limits
+    # given by the JIT engine parameters.
+    J = jit_state_addr()
+    params = jit_params(J)
+    sizetrace, szallmcarea = read_fields(
+        'jit_State', J, 'sizetrace', 'szallmcarea'
+    )
+    ctx = {'chunks': {}}
+    total = {'traces': 0, 'roots': 0, 'bytes': 0, 'mcode': 0}
+    for obj, buf in traces(J):
+        trace = dict(zip(
+            ('traceno', 'root', 'link', 'linktype', 'szmcode', 'mcode',
+             'nins', 'nk', 'nsnap', 'nsnapmap'),
+            unpack_fields(
+                'GCtrace', obj, buf, 'traceno', 'root', 'link', 'linktype',
+                'szmcode', 'mcode', 'nins', 'nk', 'nsnap', 'nsnapmap'
+            ),
+        ))
+        size, _ = gcsize_trace(obj, buf, ctx)
+        total['traces'] += 1
+        total['roots'] += not trace['root']
+        total['bytes'] += size
+        total['mcode'] += trace['szmcode']
+        trace.update(
+            kind='side of {}'.format(trace['root']) if trace['root']
+            else 'root',
+            addr=strx64(obj),
+            start=tracestart(obj, buf, ctx),
+            linktype=TRLINK[trace['linktype']]
+            if trace['linktype'] < len(TRLINK) else 'invalid',
+            mcode=strx64(trace['mcode']),
+            # Instructions and constants are counted the same way
+            # jit.util.traceinfo does.
+            nins=trace['nins'] - REF_BIAS - 1,
+            nk=REF_BIAS - trace['nk'],
+        )
+        yield 'TRACE {traceno} ({kind}) @ {addr}: start {start}, ' \
+            'link {link} ({linktype}), mcode {szmcode} bytes @ {mcode}, ' \
+            'IR {nins} ins/{nk} consts, {nsnap} snapshots/{nsnapmap} ' \
+            'entries'.format(**trace)
+    yield 'Traces: {traces} ({roots} root, {sides} side) of maxtrace ' \
+        '{maxtrace} (trace array size {sizetrace})'.format(
+            sides=total['traces'] - total['roots'],
+            maxtrace=params['maxtrace'],
+            sizetrace=sizetrace,
+            **total
+        )
+    yield 'Memory: {} bytes occupied by traces (including mcode)'.format(
+        total['bytes']
+    )
+    maxmcode = params['maxmcode'] * 1024
+    yield 'Machine code: {mcode} bytes in traces, {szallmcarea} bytes of ' \
+        'maxmcode {maxmcode} allocated for mcode areas ' \
+        '({pct:.2f}%)'.format(
+            mcode=total['mcode'],
+            szallmcarea=szallmcarea,
+            maxmcode=maxmcode,
+            pct=percent(szallmcarea, maxmcode),
+        )
+
+
+# }}}
+
+# Machine code {{{
+
+
+# Index of the JIT-compiled machine code: sorted [start, end) intervals
+# of every trace mcode and every mcode area. The index is built once per
+# <generation> (e.g. the debugger stop), since the traces are neither
+# created nor flushed until the inferior is resumed.
+mcindex = {'valid': False, 'generation': None, 'traces': [], 'areas': []}
+
+
+def mcode_areas(J):
+    # Yield the address and the size of every mcode area: the areas are
+    # chained via MCLink header starting from the current one.
+    area, = read_fields('jit_State', J, 'mcarea')
+    while area:
+        yield area, read_fields('MCLink', area, 'size')[0]
+        area, = read_fields('MCLink', area, 'next')
+
+
+def mcode_index(generation=None):
+    if not mcindex['valid'] or mcindex['generation'] != generation:
+        J = jit_state_addr()
+        intervals = []
+        for obj, buf in traces(J):
+            mcode, szmcode = unpack_fields('GCtrace', obj, buf,
+                                           'mcode', 'szmcode')
+            intervals.append((mcode, mcode + szmcode, obj))
+        mcindex.update({
+            'valid': True,
+            'generation': generation,
+            'traces': sorted(intervals),
+            'areas': sorted((area, area + size, area)
+                            for area, size in mcode_areas(J)),
+        })
+    return mcindex
+
+
+def interval(intervals, addr):
+    # Binary search for the interval containing <addr>.
+    i = bisect.bisect_right(intervals, (addr, float('inf'))) - 1
+    if i >= 0 and addr < intervals[i][1]:
+        return intervals[i]
+    return None
+
+
+def snapshot_pc(snap, map_addr):
+    # snap_pc expanded: the PC follows the snapshot entries.
+    mapofs, nent = snap
+    addr = map_addr + (mapofs + nent) * sizeof('SnapEntry')
+    return read_uint(addr, 8) >> 8 if LJ_FR2 else read_uint(addr, 4)
+
+
+def mcode_lookup(addr, generation=None):
+    # Resolve the address within the JIT-compiled machine code to the
+    # trace, the snapshot (i.e. the exit) covering it and the source
+    # location of the snapshot. Return None, if the address is out of
+    # the mcode areas.
+    index = mcode_index(generation)
+    found = interval(index['traces'], addr)
+    if found is None:
+        area = interval(index['areas'], addr)
+        return area and {'area': area[0], 'size': area[1] - area[0]}
+    mcode, _, obj = found
+    buf = read_memory(obj, sizeof('GCtrace'))
+    traceno, nsnap, snap, snapmap, startpt = unpack_fields(
+        'GCtrace', obj, buf, 'traceno', 'nsnap', 'snap', 'snapmap', 'startpt'
+    )
+    # Rightmost binary search for the mcode offset (in MCode units) the
+    # same way trace_exit_find does.
+    ofs = (addr - mcode) // sizeof('MCode')
+    snapsize = sizeof('SnapShot')
+    snaps = read_memory(snap, nsnap * snapsize)
+    mcofs = fieldof('SnapShot', 'mcofs')
+    lo, exitno = 0, nsnap
+    while lo < exitno:
+        mid = (lo + exitno) >> 1
+        if ofs < unpack_uint(snaps, mid * snapsize + mcofs[0], mcofs[1]):
+            exitno = mid
+        else:
+            lo = mid + 1
+    exitno = max(exitno - 1, 0)
+    mapofs, nent = unpack_fields(
+        'SnapShot', snap + exitno * snapsize,
+        snaps[exitno * snapsize:(exitno + 1) * snapsize], 'mapofs', 'nent'
+    )
+    pc = snapshot_pc((mapofs, nent), snapmap)
+    chunkname, = read_fields('GCproto', startpt, 'chunkname')
+    # XXX: The snapshot may belong to the inlined function, so the line
+    # is known only if the PC is within the starting prototype.
+    return {
+        'traceno': traceno, 'trace': obj, 'mcode': mcode,
+        'offset': addr - mcode, 'snapshot': exitno, 'pc': pc,
+        'location': '{}:{}'.format(strdata(chunkname),
+                                   protoline(startpt, pc, generation)
+                                   or '?'),
+    }
+
+
+def mcode_location(found):
+    return 'TRACE {traceno} {location}'.format(**found)
+
+
+def dump_mcode(addr, generation=None):
+    found = mcode_lookup(addr, generation)
+    if found is None:
+        return '{} is not in the JIT-compiled machine code'.format(
+            strx64(addr)
+        )
+    if 'traceno' not in found:
+        return '{addr} is in mcode area {start}-{end} out of any trace ' \
+            '(exit stubs or free space)'.format(
+                addr=strx64(addr),
+                start=strx64(found['area']),
+                end=strx64(found['area'] + found['size']),
+            )
+    return '{addr} is in TRACE {traceno} @ {trace}: mcode {mcode} + ' \
+        '{offset:#x}, snapshot #{snapshot}, pc {pc}, {location}'.format(
+            addr=strx64(addr),
+            trace=strx64(found['trace']),
+            mcode=strx64(found['mcode']),
+            pc=strx64(found['pc']),
+            **dict((k, found[k])
+                   for k in ('traceno', 'offset', 'snapshot', 'location'))
+        )
+
+
+# }}}
+
+# Backtrace {{{
+
+
+def framelink(fr, slots=None):
+    # Decode the framelink slot: return the signed frame type and size
+    # (or PC) and the address of the function of the frame. <slots> is
+    # the (address, buffer) pair of the stack already fetched.
+    size = 16 if LJ_FR2 else 8
+    start = fr + 8 - size
+    if slots is not None and slots[0] <= start \
+            and start + size <= slots[0] + len(slots[1]):
+        buf = slots[1][start - slots[0]:start - slots[0] + size]
+    else:
+        buf = read_memory(start, size)
+    if LJ_FR2:
+        return tosigned(unpack_uint(buf, 8, 8), 8), \
+            gcval(unpack_uint(buf, 0, 8))
+    u64 = unpack_uint(buf, 0, 8)
+    return tosigned(u64 >> 32, 4), u64 & 0xFFFFFFFF
+
+
+def frame_pc(ftsz):
+    return ftsz & (0xFFFFFFFFFFFFFFFF if LJ_FR2 else 0xFFFFFFFF)
+
+
+def luaframes(L, header=b'', ctx=None):
+    # Yield the framelink, the type and size of the frame and the
+    # function of every guest frame of the coroutine from the top to
+    # the bottom (the same walk lj_debug_frame does). The dummy frames
+    # are skipped. If <ctx> is given, the whole stack is fetched by a
+    # single read and the call instructions are cached in <ctx>, since
+    # the coroutines mostly share the call sites.
+    base, stack, top = unpack_fields('lua_State', L, header,
+                                     'base', 'stack', 'top')
+    tvsize = sizeof('TValue')
+    fr = base - tvsize
+    sentinel = stack + LJ_FR2 * tvsize
+    slots = None
+    if ctx is not None and stack < top <= stack + BULK_SLOTS * tvsize:
+        slots = (stack, read_memory(stack, top - stack))
+    while fr > sentinel:
+        ftsz, func = framelink(fr, slots)
+        if func != L:
+            yield fr, ftsz, func
+        if ftsz & FRAME_TYPE == FRAME_LUA:
+            # frame_prevl: the slot delta is the A operand of the call.
+            pc = frame_pc(ftsz) - sizeof('BCIns')
+            if ctx is None:
+                ins = read_uint(pc, 4)
+            else:
+                if pc not in ctx['ins']:
+                    ctx['ins'][pc] = read_uint(pc, 4)
+                ins = ctx['ins'][pc]
+            prev = fr - (1 + LJ_FR2 + ((ins >> 8) & 0xff)) * tvsize
+        else:
+            prev = fr - (ftsz & ~FRAME_TYPEP)
+        if prev >= fr:
+            # The stack is corrupted, stop the walk.
+            break
+        fr = prev
+
+
+def frameline(proto, nextframe, generation=None):
+    # Current line of the Lua function frame is obtained from the newer
+    # frame (lj_debug_frameline expanded). It is unknown for the top
+    # frame, since the PC is kept in the register of the interpreter.
+    if nextframe is None:
+        return None
+    fr, ftsz, _ = nextframe
+    if ftsz & FRAME_TYPE == FRAME_LUA:
+        pc = frame_pc(ftsz)
+    elif ftsz & FRAME_TYPEP == FRAME_CONT:
+        # frame_contpc: the continuation PC is kept in the slot below.
+        pc = frame_pc(framelink(fr - (1 + LJ_FR2) * sizeof('TValue'))[0])
+    else:
+        return None
+    lines = protolines(proto, generation)
+    pos = bcpos(proto, pc) - 1
+    # The PC is beyond the prototype after the trace exit to JLOOP.
+    return bcline(lines, pos) if 0 <= pos < lines['sizebc'] else None
+
+
+def shortsrc(addr):
+    # lj_debug_shortname simplified: the chunk name without the prefix
+    # or the first line of the chunk loaded from the string.
+    length, = read_fields('GCstr', addr, 'len')
+    name = bytearray(read_memory(addr + sizeof('GCstr'), length))
+    name = name.decode('utf-8', 'replace')
+    if name[:1] in ('@', '='):
+        return name[1:]
+    return '[string "{}"]'.format(name.split('\n')[0])
+
+
+def guestframe(frame, nextframe, generation=None):
+    # Describe the guest frame: the function, the source file and the
+    # current line (if known), and whether the frame is the bottom one
+    # of the VM entry (i.e. it is called from C).
+    fr, ftsz, func = frame
+    ffid, pc, f = read_fields('GCfuncC', func, 'ffid', 'pc', 'f')
+    entry = {
+        'framelink': fr,
+        'func': func,
+        'vmentry': ftsz & FRAME_TYPE == FRAME_C,
+        'file': None,
+        'line': None,
+    }
+    if ffid == 0:
+        proto = pc - sizeof('GCproto')
+        lines = protolines(proto, generation)
+        if 'chunk' not in lines:
+            lines['chunk'] = shortsrc(lines['chunkname'])
+        entry.update(
+            name='Lua function @ {}'.format(strx64(func)),
+            file=lines['chunk'],
+            line=frameline(proto, nextframe, generation),
+        )
+    elif ffid == 1:
+        entry['name'] = 'C function @ {}'.format(strx64(f))
+    else:
+        entry['name'] = 'fast function #{}'.format(ffid)
+    return entry
+
+
+def guestframes(L, generation=None):
+    # Yield the description of every guest frame of the coroutine. The
+    # vararg pseudo-frame replaces the original frame of the function
+    # (the same way lj_debug_frame skips it), but the latter one tells
+    # whether the function is called from C.
+    nextframe = None
+    entry = None
+    for frame in luaframes(L):
+        if entry is not None and nextframe[1] & FRAME_TYPEP == FRAME_VARG:
+            entry['vmentry'] = frame[1] & FRAME_TYPE == FRAME_C
+        else:
+            if entry is not None:
+                yield entry
+            entry = guestframe(frame, nextframe, generation)
+        nextframe = frame
+    if entry is not None:
+        yield entry
+
+
+def vmentries(generation=None):
+    # Yield the guest frames split by the VM entries (i.e. the frames
+    # called from C) starting from the running coroutine. The resumer
+    # of the coroutine is not recorded anywhere, so the main coroutine
+    # is assumed to be the next one.
+    g = adapter['global_state']()
+    cur_L, mainthref = read_fields('global_State', g, 'cur_L', 'mainthref')
+    for L in [cur_L, mainthref] if cur_L and cur_L != mainthref \
+            else [mainthref]:
+        chunk = []
+        for entry in guestframes(L, generation):
+            chunk.append(entry)
+            if entry['vmentry']:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def mixed_backtrace(frames, name, generation=None):
+    # Interleave the native frames with the guest ones: every run of
+    # the VM frames is preceded by the guest frames of the next VM
+    # entry. Yield (<native frame>, None) or (<VM frame>, <guest frame>).
+    entries = None
+    invm = False
+    for frame in frames:
+        isvm = VM_SYMBOL.match(name(frame) or '') is not None
+        if isvm and not invm:
+            if entries is None:
+                entries = vmentries(generation)
+            try:
+                chunk = next(entries, [])
+            except Exception:
+                # Never break the native backtrace due to the guest one.
+                entries, chunk = iter(()), []
+            for entry in chunk:
+                yield frame, entry
+        invm = isvm
+        yield frame, None
+
+
+def guest_location(entry):
+    if entry['file'] is None:
+        return entry['name']
+    return '{name}, {file}:{line}'.format(
+        name=entry['name'], file=entry['file'], line=entry['line'] or '?'
+    )
+
+
+# }}}
+
+# Coroutines {{{
+
+
+# See lua.h for details.
+LUA_OK = 0
+LUA_YIELD = 1
+
+# The keys the coroutines are sorted by (in the descending order).
+THREAD_KEYS = ('stacksize', 'used', 'depth')
+
+
+def thread_status(L, header, cur_L):
+    # coroutine.status expanded (see lib_base.c).
+    status, base, stack, top = unpack_fields(
+        'lua_State', L, header, 'status', 'base', 'stack', 'top'
+    )
+    if L == cur_L:
+        return 'running'
+    if status == LUA_YIELD:
+        return 'suspended'
+    if status != LUA_OK:
+        return 'dead'
+    if base > stack + (1 + LJ_FR2) * sizeof('TValue'):
+        return 'normal'
+    if top == base:
+        return 'dead'
+    return 'suspended'
+
+
+def thread_summary(L, header, cur_L, ctx, generation=None):
+    # Summarize the coroutine stack: its size and usage (in slots), the
+    # number of frames and the top Lua function frame.
+    stacksize, stack, top = unpack_fields(
+        'lua_State', L, header, 'stacksize', 'stack', 'top'
+    )
+    thread = {
+        'addr': L,
+        'status': thread_status(L, header, cur_L),
+        'stacksize': stacksize,
+        'used': (top - stack) // sizeof('TValue'),
+        'depth': 0,
+        'top': None,
+    }
+    nextframe = None
+    for frame in luaframes(L, header, ctx):
+        # The vararg pseudo-frame and the original one are the single
+        # frame of the function.
+        if nextframe is None or nextframe[1] & FRAME_TYPEP != FRAME_VARG:
+            thread['depth'] += 1
+            if thread['top'] is None:
+                entry = guestframe(frame, nextframe, generation)
+                if entry['file'] is not None:
+                    thread['top'] = entry
+        nextframe = frame
+    return thread
+
+
+def threads(generation=None):
+    # Walk the gc.root list once and summarize every coroutine found
+    # there (the main one included). Only the header is fetched for the
+    # rest objects to follow the list.
+    g = adapter['global_state']()
+    root, = read_fields('GCState', g + offsetof('global_State', 'gc'),
+                        'root')
+    cur_L, = read_fields('global_State', g, 'cur_L')
+    header = sizeof('GChead')
+    gct = fieldof('GChead', 'gct')
+    ctx = {'ins': {}}
+    for obj, buf in gclist(root, lambda obj: read_memory(obj, header)):
+        if typenames(i2notu32(unpack_uint(buf, *gct))) != 'LJ_TTHREAD':
+            continue
+        yield thread_summary(obj, read_memory(obj, sizeof('lua_State')),
+                             cur_L, ctx, generation)
+
+
+def parse_threads(arg):
+    # The options for the coroutine list: --top <N> and the key to sort
+    # by: --by-stacksize (default), --by-used or --by-depth.
+    expr, opts = parse_options(arg, ('--top',), tuple(
+        '--by-' + key for key in THREAD_KEYS
+    ))
+    keys = [key for key in THREAD_KEYS if 'by-' + key in opts]
+    if len(keys) > 1:
+        raise ValueError('only one of --by-* options is expected')
+    return expr, {
+        'top': opts.get('top', 20),
+        'key': keys[0] if keys else 'stacksize',
+    }
+
+
+def dump_threads(top=20, key='stacksize', generation=None):
+    # Collect all coroutines (the walk may be interrupted) and dump the
+    # <top> ones with the largest <key> and the totals.
+    summaries = []
+    interrupted = False
+    try:
+        for thread in threads(generation):
+            summaries.append(thread)
+    except KeyboardInterrupt:
+        interrupted = True
+    if interrupted:
+        yield 'Interrupted after {} coroutines, the numbers are ' \
+            'partial'.format(len(summaries))
+    summaries.sort(key=lambda t: -t[key])
+    for thread in summaries[:top]:
+        yield '{addr} ({status}): stack {used}/{stacksize} slots, ' \
+            '{depth} frames, top {top}'.format(
+                addr=strx64(thread['addr']),
+                top=guest_location(thread['top']) if thread['top']
+                else 'none',
+                **dict((k, thread[k])
+                       for k in ('status', 'used', 'stacksize', 'depth'))
+            )
+    statuses = {}
+    for thread in summaries:
+        statuses[thread['status']] = statuses.get(thread['status'], 0) + 1
+    yield 'Coroutines: {total} ({statuses})'.format(
+        total=len(summaries),
+        statuses=', '.join('{} {}'.format(n, status)
+                           for status, n in sorted(statuses.items())),
+    )
+    yield 'Stacks: {} slots allocated, {} slots used'.format(
+        sum(t['stacksize'] for t in summaries),
+        sum(t['used'] for t in summaries),
+    )
+
+
+# }}}
+
+# Heap snapshot {{{
+
+
+# See lj_obj.h for details.
+LJ_GC_WEAKKEY = 0x08
+LJ_GC_WEAKVAL = 0x10
+
+
+def tvrefs(kind, values):
+    # References to the GC objects among the given TValues.
+    for _, u64 in values:
+        if typenames(itypemap(u64)) in gcsizes:
+            yield kind, gcval(u64)
+
+
+def gcrefs_array(addr, count):
+    # Addresses of the objects in GCRef array (the nil ones skipped).
+    refsize = sizeof('GCRef')
+    buf = read_memory(addr, count * refsize) if count else b''
+    for i in range(count):
+        ref = unpack_uint(buf, i * refsize, refsize)
+        if ref:
+            yield ref
+
+
+def gcrefs_upval(obj, buf):
+    # The value is referenced via uv->v both for the open upvalue (the
+    # stack slot) and for the closed one (the value within upvalue).
+    v, = unpack_fields('GCupval', obj, buf, 'v')
+    return tvrefs('value', [(v, read_tvalue(v))])
+
+
+def gcrefs_thread(obj, buf):
+    env, stack, top = unpack_fields('lua_State', obj, buf,
+                                    'env', 'stack', 'top')
+    if env:
+        yield 'env', env
+    for ref in tvrefs('stack', read_tvalues(
+        stack, (top - stack) // sizeof('TValue')
+    )):
+        yield ref
+
+
+def gcrefs_proto(obj, buf):
+    chunkname, k, sizekgc = unpack_fields('GCproto', obj, buf,
+                                          'chunkname', 'k', 'sizekgc')
+    yield 'chunkname', chunkname
+    # The GC constants are stored below the k pointer.
+    for ref in gcrefs_array(k - sizekgc * sizeof('GCRef'), sizekgc):
+        yield 'constant', ref
+
+
+def gcrefs_func(obj, buf):
+    ffid, env, nupvalues, pc = unpack_fields(
+        'GCfuncC', obj, buf, 'ffid', 'env', 'nupvalues', 'pc'
+    )
+    if env:
+        yield 'env', env
+    if ffid == 0:
+        yield 'proto', pc - sizeof('GCproto')
+        for ref in gcrefs_array(obj + offsetof('GCfuncL', 'uvptr'),
+                                nupvalues):
+            yield 'upvalue', ref
+    else:
+        for ref in tvrefs('upvalue', read_tvalues(
+            obj + offsetof('GCfuncC', 'upvalue'), nupvalues
+        )):
+            yield ref
+
+
+def gcrefs_trace(obj, buf):
+    startpt, = unpack_fields('GCtrace', obj, buf, 'startpt')
+    yield 'proto', startpt
+
+
+def gcrefs_tab(obj, buf):
+    marked, mt, array, node, asize, hmask = unpack_fields(
+        'GCtab', obj, buf, 'marked', 'metatable', 'array', 'node', 'asize',
+        'hmask'
+    )
+    # The weakness is set by the GC on the table traversal.
+    kkind = 'weak key' if marked & LJ_GC_WEAKKEY else 'key'
+    vkind = 'weak value' if marked & LJ_GC_WEAKVAL else 'value'
+    if mt:
+        yield 'metatable', mt
+    for ref in tvrefs(vkind, read_tvalues(array, asize)):
+        yield ref
+    for _, key, val, _ in read_nodes(node, hmask + 1 if hmask > 0 else 0):
+        # The keys of the dead nodes are not references.
+        if typenames(itypemap(val)) == 'LJ_TNIL':
+            continue
+        for ref in tvrefs(kkind, [(None, key)]):
+            yield ref
+        for ref in tvrefs(vkind, [(None, val)]):
+            yield ref
+
+
+def gcrefs_udata(obj, buf):
+    env, mt = unpack_fields('GCudata', obj, buf, 'env', 'metatable')
+    if env:
+        yield 'env', env
+    if mt:
+        yield 'metatable', mt
+
+
+gcrefs = {
+    'LJ_TUPVAL':  gcrefs_upval,
+    'LJ_TTHREAD': gcrefs_thread,
+    'LJ_TPROTO':  gcrefs_proto,
+    'LJ_TFUNC':   gcrefs_func,
+    'LJ_TTRACE':  gcrefs_trace,
+    'LJ_TTAB':    gcrefs_tab,
+    'LJ_TUDATA':  gcrefs_udata,
+}
+
+
+def gcroots(g):
+    # The main coroutine, the registry and the GC roots of the VM
+    # (metamethod names, base metatables, etc.).
+    mainthref, = read_fields('global_State', g, 'mainthref')
+    yield 'root', mainthref
+    registry = g + offsetof('global_State', 'registrytv')
+    for ref in tvrefs('root', [(registry, read_tvalue(registry))]):
+        yield ref
+    offset, size = fieldof('global_State', 'gcroot')
+    for ref in gcrefs_array(g + offset, size // sizeof('GCRef')):
+        yield 'root', ref
+
+
+def heap_objects(sizes=True, refs=True, labels=False):
+    # Yield the gct, the address, the size (if <sizes> is set), the
+    # outgoing references (if <refs> is set) and the label (if <labels>
+    # is set) of every GC object. The label is the allocation site of the
+    # functions, prototypes and traces and lj-gc-census bucket of the
+    # other objects.
+    ctx = gcsize_ctx()
+    prefix = gcobj_prefix()
+    header = sizeof('GChead')
+    gct = fieldof('GChead', 'gct')
+
+    def fetch(obj):
+        try:
+            return read_memory(obj, prefix)
+        except Exception:
+            # The object is too close to the end of the mapping.
+            return read_memory(obj, header)
+
+    for obj, buf in gcobjects(fetch):
+        otype = unpack_uint(buf, *gct)
+        tname = typenames(i2notu32(otype))
+        size, label = gcsizes[tname](obj, buf, ctx) \
+            if (sizes or labels) and tname in gcsizes else (0, None)
+        if labels and tname in gcsites:
+            label = gcsites[tname](obj, buf, ctx)
+        objrefs = list(gcrefs[tname](obj, buf)) \
+            if refs and tname in gcrefs else []
+        yield otype, obj, size, objrefs, label if labels else None
+
+
+def heap_snapshot(f):
+    # Walk all GC objects once and write every object with its size and
+    # outgoing references to the file object <f> in the snapshot format
+    # (see luajit_heapdump.py for details).
+    g = adapter['global_state']()
+    stats = {'objects': 0, 'refs': 0, 'bytes': 0, 'written': 0,
+             'interrupted': False}
+    writer = heapdump.Writer(f, LJ_GC64)
+    roots = list(gcroots(g))
+    stats['written'] += writer.record(heapdump.ROOTS, 0, 0, roots)
+    try:
+        for otype, obj, size, refs, label in heap_objects(labels=True):
+            stats['written'] += writer.record(otype, obj, size, refs, label)
+            stats['objects'] += 1
+            stats['refs'] += len(refs)
+            stats['bytes'] += size
+    except KeyboardInterrupt:
+        stats['interrupted'] = True
+    stats['written'] += writer.close(not stats['interrupted'])
+    return stats
+
+
+def dump_heap_snapshot(path):
+    with open(path, 'wb') as f:
+        stats = heap_snapshot(f)
+    if stats['interrupted']:
+        yield 'Interrupted after {} objects, the snapshot is ' \
+            'partial'.format(stats['objects'])
+    yield 'Heap snapshot: {objects} objects ({bytes} bytes) with {refs} ' \
+        'references written to {path} ({written} bytes)'.format(
+            path=path, **stats
+        )
+
+
+def heap_records():
+    # The live heap walk in the same format the snapshot reader yields
+    # the records, without the references not needed to compare heaps.
+    for otype, obj, size, _, label in heap_objects(refs=False, labels=True):
+        yield typenames(i2notu32(otype)), obj, size, [], label
+
+
+def parse_heapdiff(arg):
+    # The options for the heap diff: --top <N>.
+    expr, opts = parse_options(arg, ('--top',))
+    return expr, {'top': opts.get('top', 10)}
+
+
+def dump_heap_diff(old, new=None, top=10):
+    # Compare the snapshot <old> with the snapshot <new> or with the
+    # live heap, if the latter is omitted.
+    if new is not None:
+        lines = heapdump.diff_files(old, new, top)
+    else:
+        lines = heapdump.diff_files(old, None, top, heap_records())
+    try:
+        for line in lines:
+            yield line
+    except KeyboardInterrupt:
+        yield 'Interrupted, the heaps are not compared'
+
+
+# }}}
+
+# Retainers {{{
+
+
+# The reverse reference index of the heap is built once per
+# <generation> (e.g. the debugger stop): building it is the most
+# expensive part, while the queries are cheap.
+retindex = {'generation': None, 'index': None}
+
+
+def retainers_index(generation=None):
+    if retindex['index'] is None or generation is None \
+            or retindex['generation'] != generation:
+        retindex['index'] = None
+        index = heapdump.Retainers()
+        index.add('roots', 0, list(gcroots(adapter['global_state']())))
+        for otype, obj, _, refs, _ in heap_objects(sizes=False):
+            index.add(typenames(i2notu32(otype)), obj, refs)
+        retindex.update({'generation': generation, 'index': index})
+    return retindex['index']
+
+
+def parse_retainers(arg):
+    # The options for the retainer paths: --paths <N> and --depth <N>.
+    expr, opts = parse_options(arg, ('--paths', '--depth'))
+    retainers = {'paths': 3, 'depth': None}
+    retainers.update(opts)
+    return expr, retainers
+
+
+def describe_gcobj(index, addr):
+    tname = index.types.get(addr)
+    if tname in dumpers:
+        return dumpers[tname](addr)
+    return '{} @ {}'.format(tname or 'unknown object', strx64(addr))
+
+
+def dump_retainers(addr, paths=3, depth=None, generation=None):
+    try:
+        index = retainers_index(generation)
+    except KeyboardInterrupt:
+        yield 'Interrupted, the reverse reference index is not built'
+        return
+    for line in index.dump(addr, paths, depth,
+                           lambda obj: describe_gcobj(index, obj)):
+        yield line
+
+
+# }}}
+
+# Bytecode {{{
+
+
+# The opcodes with the modes of A, B and C/D operands in the order of
+# BCDEF from lj_bc.h.
+BCDEF = [
+    ('ISLT',   'var',   '___',   'var'),
+    ('ISGE',   'var',   '___',   'var'),
+    ('ISLE',   'var',   '___',   'var'),
+    ('ISGT',   'var',   '___',   'var'),
+    ('ISEQV',  'var',   '___',   'var'),
+    ('ISNEV',  'var',   '___',   'var'),
+    ('ISEQS',  'var',   '___',   'str'),
+    ('ISNES',  'var',   '___',   'str'),
+    ('ISEQN',  'var',   '___',   'num'),
+    ('ISNEN',  'var',   '___',   'num'),
+    ('ISEQP',  'var',   '___',   'pri'),
+    ('ISNEP',  'var',   '___',   'pri'),
+    ('ISTC',   'dst',   '___',   'var'),
+    ('ISFC',   'dst',   '___',   'var'),
+    ('IST',    '___',   '___',   'var'),
+    ('ISF',    '___',   '___',   'var'),
+    ('ISTYPE', 'var',   '___',   'lit'),
+    ('ISNUM',  'var',   '___',   'lit'),
+    ('MOV',    'dst',   '___',   'var'),
+    ('NOT',    'dst',   '___',   'var'),
+    ('UNM',    'dst',   '___',   'var'),
+    ('LEN',    'dst',   '___',   'var'),
+    ('ADDVN',  'dst',   'var',   'num'),
+    ('SUBVN',  'dst',   'var',   'num'),
+    ('MULVN',  'dst',   'var',   'num'),
+    ('DIVVN',  'dst',   'var',   'num'),
+    ('MODVN',  'dst',   'var',   'num'),
+    ('ADDNV',  'dst',   'var',   'num'),
+    ('SUBNV',  'dst',   'var',   'num'),
+    ('MULNV',  'dst',   'var',   'num'),
+    ('DIVNV',  'dst',   'var',   'num'),
+    ('MODNV',  'dst',   'var',   'num'),
+    ('ADDVV',  'dst',   'var',   'var'),
+    ('SUBVV',  'dst',   'var',   'var'),
+    ('MULVV',  'dst',   'var',   'var'),
+    ('DIVVV',  'dst',   'var',   'var'),
+    ('MODVV',  'dst',   'var',   'var'),
+    ('POW',    'dst',   'var',   'var'),
+    ('CAT',    'dst',   'rbase', 'rbase'),
+    ('KSTR',   'dst',   '___',   'str'),
+    ('KCDATA', 'dst',   '___',   'cdata'),
+    ('KSHORT', 'dst',   '___',   'lits'),
+    ('KNUM',   'dst',   '___',   'num'),
+    ('KPRI',   'dst',   '___',   'pri'),
+    ('KNIL',   'base',  '___',   'base'),
+    ('UGET',   'dst',   '___',   'uv'),
+    ('USETV',  'uv',    '___',   'var'),
+    ('USETS',  'uv',    '___',   'str'),
+    ('USETN',  'uv',    '___',   'num'),
+    ('USETP',  'uv',    '___',   'pri'),
+    ('UCLO',   'rbase', '___',   'jump'),
+    ('FNEW',   'dst',   '___',   'func'),
+    ('TNEW',   'dst',   '___',   'lit'),
+    ('TDUP',   'dst',   '___',   'tab'),
+    ('GGET',   'dst',   '___',   'str'),
+    ('GSET',   'var',   '___',   'str'),
+    ('TGETV',  'dst',   'var',   'var'),
+    ('TGETS',  'dst',   'var',   'str'),
+    ('TGETB',  'dst',   'var',   'lit'),
+    ('TGETR',  'dst',   'var',   'var'),
+    ('TSETV',  'var',   'var',   'var'),
+    ('TSETS',  'var',   'var',   'str'),
+    ('TSETB',  'var',   'var',   'lit'),
+    ('TSETM',  'base',  '___',   'num'),
+    ('TSETR',  'var',   'var',   'var'),
+    ('CALLM',  'base',  'lit',   'lit'),
+    ('CALL',   'base',  'lit',   'lit'),
+    ('CALLMT', 'base',  '___',   'lit'),
+    ('CALLT',  'base',  '___',   'lit'),
+    ('ITERC',  'base',  'lit',   'lit'),
+    ('ITERN',  'base',  'lit',   'lit'),
+    ('VARG',   'base',  'lit',   'lit'),
+    ('ISNEXT', 'base',  '___',   'jump'),
+    ('RETM',   'base',  '___',   'lit'),
+    ('RET',    'rbase', '___',   'lit'),
+    ('RET0',   'rbase', '___',   'lit'),
+    ('RET1',   'rbase', '___',   'lit'),
+    ('FORI',   'base',  '___',   'jump'),
+    ('JFORI',  'base',  '___',   'jump'),
+    ('FORL',   'base',  '___',   'jump'),
+    ('IFORL',  'base',  '___',   'jump'),
+    ('JFORL',  'base',  '___',   'lit'),
+    ('ITERL',  'base',  '___',   'jump'),
+    ('IITERL', 'base',  '___',   'jump'),
+    ('JITERL', 'base',  '___',   'lit'),
+    ('LOOP',   'rbase', '___',   'jump'),
+    ('ILOOP',  'rbase', '___',   'jump'),
+    ('JLOOP',  'rbase', '___',   'lit'),
+    ('JMP',    'rbase', '___',   'jump'),
+    ('FUNCF',  'rbase', '___',   '___'),
+    ('IFUNCF', 'rbase', '___',   '___'),
+    ('JFUNCF', 'rbase', '___',   'lit'),
+    ('FUNCV',  'rbase', '___',   '___'),
+    ('IFUNCV', 'rbase', '___',   '___'),
+    ('JFUNCV', 'rbase', '___',   'lit'),
+    ('FUNCC',  'rbase', '___',   '___'),
+    ('FUNCCW', 'rbase', '___',   '___'),
+]
+
+# See lj_bc.h for details.
+BCBIAS_J = 0x8000
+
+# The constants are shown the same way jit.bc does.
+BCSTR_MAX = 40
+BCSTR_ESCAPES = {0x0a: '\\n', 0x0d: '\\r', 0x09: '\\t'}
+
+# The prototypes decoded during the <generation> (e.g. the debugger
+# stop) and the bytecode positions of the guest frames at it. The
+# bytecode is patched by the JIT compiler only while the inferior runs.
+bccache = {'generation': None, 'protos': {}, 'marks': None}
+
+
+def bcslice(buf, start, addr, size):
+    # The piece of the prototype memory fetched as a whole, the debug
+    # info of the prototypes is not always allocated together with it.
+    if start <= addr and addr + size <= start + len(buf):
+        return buf[addr - start:addr - start + size]
+    return read_memory(addr, size)
+
+
+def bcstr(addr):
+    length, = read_fields('GCstr', addr, 'len')
+    data = bytearray(read_memory(addr + sizeof('GCstr'),
+                                 min(length, BCSTR_MAX)))
+    # The control characters are escaped the same way jit.bc does.
+    text = ''.join(chr(c) if c >= 0x20 and c != 0x7f
+                   else BCSTR_ESCAPES.get(c, '\\{:03d}'.format(c))
+                   for c in data)
+    return '"{}"{}'.format(text, '~' if length > BCSTR_MAX else '')
+
+
+def bcnum(u64):
+    if tvisint(u64):
+        return str(intV(u64))
+    return '{:.14g}'.format(numV(u64))
+
+
+def bcproto(proto, generation=None):
+    # Fetch the whole prototype (the header, the bytecode, the constants
+    # and the debug info) by a single read and decode it. The result is
+    # cached, unless <generation> is omitted.
+    if generation is not None and bccache['generation'] != generation:
+        bccache.update({'generation': generation, 'protos': {},
+                        'marks': None})
+    if generation is not None and proto in bccache['protos']:
+        return bccache['protos'][proto]
+    sizept, = read_fields('GCproto', proto, 'sizept')
+    buf = read_memory(proto, max(sizept, sizeof('GCproto')))
+    chunkname, firstline, numline, sizebc, k, sizeuv, uvinfo = \
+        unpack_fields('GCproto', proto, buf, 'chunkname', 'firstline',
+                      'numline', 'sizebc', 'k', 'sizeuv', 'uvinfo')
+    refsize = sizeof('GCRef')
+    tvsize = sizeof('TValue')
+    insize = sizeof('BCIns')
+    uvnames = []
+    if uvinfo:
+        # The names are zero-terminated and follow each other.
+        names = bcslice(buf, proto, uvinfo, sizept + proto - uvinfo
+                        if proto < uvinfo < proto + sizept else 256)
+        uvnames = bytes(names).split(b'\0')[:sizeuv]
+        uvnames = [n.decode('utf-8', 'replace') for n in uvnames]
+    chunks = {}
+
+    def kgc(d):
+        return unpack_uint(bcslice(buf, proto, k - (d + 1) * refsize,
+                                   refsize), 0, refsize)
+
+    def constant(mode, d, name):
+        if mode == 'str':
+            return bcstr(kgc(d))
+        if mode == 'num':
+            u64 = unpack_uint(bcslice(buf, proto, k + d * tvsize, 8), 0, 8)
+            if name == 'TSETM':
+                # The base index is stored as the number biased by 2^52.
+                return str(int(numV(u64) - 2 ** 52))
+            return bcnum(u64)
+        if mode == 'func':
+            child = kgc(d)
+            chunkname, firstline = read_fields('GCproto', child,
+                                               'chunkname', 'firstline')
+            if chunkname not in chunks:
+                chunks[chunkname] = shortsrc(chunkname)
+            return '{}:{}'.format(chunks[chunkname], tosigned(firstline, 4))
+        if mode == 'uv':
+            return uvnames[d] if d < len(uvnames) else None
+        return None
+
+    code = bcslice(buf, proto, proto + sizeof('GCproto'), sizebc * insize)
+    lines = []
+    targets = set()
+    for pos in range(1, sizebc):
+        ins = unpack_uint(code, pos * insize, insize)
+        op = ins & 0xff
+        if op >= len(BCDEF):
+            lines.append((pos, '??? {:#010x}'.format(ins)))
+            continue
+        name, ma, mb, mc = BCDEF[op]
+        a = (ins >> 8) & 0xff
+        d = ins >> 16
+        line = '{:6} {:>3} '.format(name, '' if ma == '___' else a)
+        if mc == 'jump':
+            target = pos + d - (BCBIAS_J - 1)
+            targets.add(target)
+            lines.append((pos, '{}=> {:04d}'.format(line, target)))
+            continue
+        if mb != '___':
+            d &= 0xff
+        elif mc == '___':
+            lines.append((pos, line.rstrip()))
+            continue
+        kc = constant(mc, d, name)
+        if ma == 'uv':
+            ka = constant('uv', a, name)
+            kc = '{} ; {}'.format(ka, kc) if kc is not None else ka
+        if mb != '___':
+            line += '{:3d} {:3d}'.format(ins >> 24, d)
+            if kc is not None:
+                line += '  ; {}'.format(kc)
+        elif kc is not None:
+            line += '{:3d}      ; {}'.format(d, kc)
+        else:
+            line += '{:3d}'.format(d - 0x10000 if mc == 'lits' and d > 0x7fff
+                                   else d)
+        lines.append((pos, line))
+    if chunkname not in chunks:
+        chunks[chunkname] = shortsrc(chunkname)
+    decoded = {
+        'location': '{}:{}-{}'.format(chunks[chunkname],
+                                      tosigned(firstline, 4),
+                                      tosigned(firstline, 4) + numline),
+        'lines': lines,
+        'targets': targets,
+    }
+    if generation is not None:
+        bccache['protos'][proto] = decoded
+    return decoded
+
+
+def bcmarks(generation=None):
+    # The bytecode positions of the Lua function frames of the running
+    # coroutine per prototype. The position of the frame is obtained
+    # from the newer frame the same way the current line is.
+    if generation is not None and bccache['generation'] != generation:
+        bccache.update({'generation': generation, 'protos': {},
+                        'marks': None})
+    if generation is not None and bccache['marks'] is not None:
+        return bccache['marks']
+    marks = {}
+    g = adapter['global_state']()
+    cur_L, mainthref = read_fields('global_State', g, 'cur_L', 'mainthref')
+    nextframe = None
+    for frame in luaframes(cur_L or mainthref, ctx={'ins': {}}):
+        ffid, pc = read_fields('GCfuncC', frame[2], 'ffid', 'pc')
+        if ffid == 0 and nextframe is not None:
+            fr, ftsz, _ = nextframe
+            if ftsz & FRAME_TYPE == FRAME_LUA:
+                proto = pc - sizeof('GCproto')
+                marks.setdefault(proto, set()).add(
+                    bcpos(proto, frame_pc(ftsz)) - 1
+                )
+        nextframe = frame
+    if generation is not None:
+        bccache['marks'] = marks
+    return marks
+
+
+def dump_bc(addr, generation=None):
+    # Disassemble the prototype or the Lua function in the style of
+    # jit.bc: the branch targets are marked with => and the current
+    # positions of the frames of the running coroutine with ->.
+    tname = typenames(i2notu32(read_fields('GChead', addr, 'gct')[0]))
+    if tname == 'LJ_TFUNC':
+        ffid, pc = read_fields('GCfuncC', addr, 'ffid', 'pc')
+        if ffid != 0:
+            yield '{} is not a Lua function'.format(strx64(addr))
+            return
+        proto = pc - sizeof('GCproto')
+    elif tname == 'LJ_TPROTO':
+        proto = addr
+    else:
+        yield '{} is neither a prototype nor a function ({})'.format(
+            strx64(addr), tname
+        )
+        return
+    decoded = bcproto(proto, generation)
+    marks = bcmarks(generation).get(proto, ())
+    yield '-- BYTECODE -- {} @ {}'.format(decoded['location'],
+                                          strx64(proto))
+    for pos, line in decoded['lines']:
+        line = '{:04d} {} {}'.format(
+            pos, '=>' if pos in decoded['targets'] else '  ', line
+        )
+        yield '-> ' + line if pos in marks else '   ' + line if marks \
+            else line
+
+
+# }}}
+
+# JIT penalties {{{
+
+
+# The trace abort reasons in the order of lj_traceerr.h.
+TRACEERR = [
+    ('RECERR', 'error thrown or hook called during recording'),
+    ('TRACEUV', 'trace too short'),
+    ('TRACEOV', 'trace too long'),
+    ('STACKOV', 'trace too deep'),
+    ('SNAPOV', 'too many snapshots'),
+    ('BLACKL', 'blacklisted'),
+    ('RETRY', 'retry recording'),
+    ('NYIBC', 'NYI: bytecode %s'),
+    ('LLEAVE', 'leaving loop in root trace'),
+    ('LINNER', 'inner loop in root trace'),
+    ('LUNROLL', 'loop unroll limit reached'),
+    ('BADTYPE', 'bad argument type'),
+    ('CJITOFF', 'JIT compilation disabled for function'),
+    ('CUNROLL', 'call unroll limit reached'),
+    ('DOWNREC', 'down-recursion, restarting'),
+    ('NYIFFU', 'NYI: unsupported variant of FastFunc %s'),
+    ('NYIRETL', 'NYI: return to lower frame'),
+    ('STORENN', 'store with nil or NaN key'),
+    ('NOMM', 'missing metamethod'),
+    ('IDXLOOP', 'looping index lookup'),
+    ('NYITMIX', 'NYI: mixed sparse/dense table'),
+    ('NOCACHE', 'symbol not in cache'),
+    ('NYICONV', 'NYI: unsupported C type conversion'),
+    ('NYICALL', 'NYI: unsupported C function type'),
+    ('GFAIL', 'guard would always fail'),
+    ('PHIOV', 'too many PHIs'),
+    ('TYPEINS', 'persistent type instability'),
+    ('MCODEAL', 'failed to allocate mcode memory'),
+    ('MCODEOV', 'machine code too long'),
+    ('MCODELM', 'hit mcode limit (retrying)'),
+    ('SPILLOV', 'too many spill slots'),
+    ('BADRA', 'inconsistent register allocation'),
+    ('NYIIR', 'NYI: cannot assemble IR instruction %d'),
+    ('NYIPHI', 'NYI: PHI shuffling too complex'),
+    ('NYICOAL', 'NYI: register coalescing too complex'),
+]
+
+# See lj_jit.h for details.
+PENALTY_MIN = 36 * 2
+PENALTY_MAX = 60000
+
+# See lj_obj.h for details.
+PROTO_NOJIT = 0x08
+PROTO_ILOOP = 0x10
+
+# The opcodes the blacklisted instructions are patched to (see
+# blacklist_pc in lj_trace.c).
+BC_BLACKLISTED = ('IFORL', 'IITERL', 'ILOOP', 'IFUNCF', 'IFUNCV')
+
+BCOP = dict((bc[0], op) for op, bc in enumerate(BCDEF))
+
+
+def penalty_slots(J):
+    # Yield the PC, the penalty value and the reason of the last abort
+    # of every used slot of the penalty cache fetched by a single read.
+    offset, size = fieldof('jit_State', 'penalty')
+    slotsize = sizeof('HotPenalty')
+    buf = read_memory(J + offset, size)
+    for i in range(size // slotsize):
+        pc, val, reason = unpack_fields(
+            'HotPenalty', J + offset + i * slotsize,
+            buf[i * slotsize:(i + 1) * slotsize], 'pc', 'val', 'reason'
+        )
+        if pc:
+            yield pc, val, reason
+
+
+def patched_protos():
+    # Walk the prototypes (they are linked to gc.root only) and collect
+    # the bytecode intervals of all of them to resolve the PCs and the
+    # instructions patched due to the blacklisting or jit.off().
+    prefix = gcobj_prefix()
+    gct = fieldof('GChead', 'gct')
+    insize = sizeof('BCIns')
+    found = {'intervals': [], 'patched': [], 'interrupted': False}
+    blacklisted = set(BCOP[name] for name in BC_BLACKLISTED)
+
+    def fetch(obj):
+        try:
+            return read_memory(obj, prefix)
+        except Exception:
+            # The object is too close to the end of the mapping.
+            return read_memory(obj, sizeof('GChead'))
+
+    g = adapter['global_state']()
+    root, = read_fields('GCState', g + offsetof('global_State', 'gc'),
+                        'root')
+    try:
+        for obj, buf in gclist(root, fetch):
+            if typenames(i2notu32(unpack_uint(buf, *gct))) != 'LJ_TPROTO':
+                continue
+            sizebc, flags = unpack_fields('GCproto', obj, buf,
+                                          'sizebc', 'flags')
+            start = obj + sizeof('GCproto')
+            found['intervals'].append((start, start + sizebc * insize, obj))
+            if not flags & (PROTO_ILOOP | PROTO_NOJIT):
+                continue
+            code = read_memory(start, sizebc * insize)
+            for pos in range(sizebc):
+                if unpack_uint(code, pos * insize, insize) & 0xff \
+                        in blacklisted:
+                    found['patched'].append(
+                        (start + pos * insize, obj, flags & PROTO_NOJIT)
+                    )
+    except KeyboardInterrupt:
+        found['interrupted'] = True
+    found['intervals'].sort()
+    return found
+
+
+def penalty_aborts(val):
+    # The penalty value starts at PENALTY_MIN and is doubled (plus the
+    # random bits) on every abort (see penalty_pc in lj_trace.c).
+    aborts = 1
+    while PENALTY_MIN << aborts <= val:
+        aborts += 1
+    return aborts
+
+
+def jit_penalties(generation=None):
+    # Collect the locations the JIT compiler gave up on (blacklisted or
+    # disabled) or keeps aborting on (penalized) ranked by the lost
+    # compilation: the blacklisted and disabled ones are never compiled
+    # again, while the penalty value is the number of the hot counter
+    # ticks the location is interpreted until the next attempt.
+    J = jit_state_addr()
+    slots = dict((pc, (val, reason)) for pc, val, reason in penalty_slots(J))
+    found = patched_protos()
+    entries = {}
+    for pc, proto, nojit in found['patched']:
+        entries[pc] = {'pc': pc, 'proto': proto, 'rank': 1 if nojit else 0,
+                       'state': 'JIT disabled' if nojit else 'blacklisted'}
+    for pc, (val, reason) in slots.items():
+        entry = entries.setdefault(pc, {'pc': pc, 'rank': 2,
+                                        'state': 'penalized'})
+        entry.update(val=val, reason=reason)
+    ctx = {'chunks': {}}
+    for entry in entries.values():
+        if 'proto' not in entry:
+            owner = interval(found['intervals'], entry['pc'])
+            entry['proto'] = owner and owner[2]
+        op = read_uint(entry['pc'], 4) & 0xff
+        entry['op'] = BCDEF[op][0] if op < len(BCDEF) else '???'
+        entry['location'] = None
+        if entry['proto'] is not None:
+            chunkname, = read_fields('GCproto', entry['proto'], 'chunkname')
+            if chunkname not in ctx['chunks']:
+                ctx['chunks'][chunkname] = shortsrc(chunkname)
+            entry['location'] = '{}:{}'.format(
+                ctx['chunks'][chunkname],
+                protoline(entry['proto'], entry['pc'], generation),
+            )
+    return {
+        'slots': len(slots),
+        'capacity': fieldof('jit_State', 'penalty')[1]
+        // sizeof('HotPenalty'),
+        'interrupted': found['interrupted'],
+        'entries': sorted(entries.values(),
+                          key=lambda e: (e['rank'], -e.get('val', 0))),
+    }
+
+
+def parse_penalties(arg):
+    # The options for the penalty report: --top <N>.
+    expr, opts = parse_options(arg, ('--top',))
+    return expr, {'top': opts.get('top', 20)}
+
+
+def penalty_reason(reason):
+    if reason >= len(TRACEERR):
+        return 'unknown abort reason {}'.format(reason)
+    # The arguments of the message are not kept in the penalty cache.
+    return '{} ({})'.format(re.sub(r'%[ds]', '?', TRACEERR[reason][1]),
+                            TRACEERR[reason][0])
+
+
+def dump_jit_penalties(top=20, generation=None):
+    penalties = jit_penalties(generation)
+    entries = penalties['entries']
+    if penalties['interrupted']:
+        yield 'Interrupted, the prototypes are walked partially: some ' \
+            'locations are neither found nor resolved'
+    yield 'Penalty cache: {slots} of {capacity} slots used'.format(
+        **penalties
+    )
+    yield 'Blacklisted: {} instructions, JIT disabled: {} ' \
+        'instructions'.format(
+            sum(e['state'] == 'blacklisted' for e in entries),
+            sum(e['state'] == 'JIT disabled' for e in entries),
+        )
+    yield 'Top {} locations by lost compilation:'.format(top)
+    for entry in entries[:top]:
+        if entry['state'] == 'penalized':
+            state = 'penalty {} (~{} aborts)'.format(
+                entry['val'], penalty_aborts(entry['val'])
+            )
+        elif 'val' in entry:
+            state = '{} after ~{} aborts'.format(
+                entry['state'], penalty_aborts(entry['val']) + 1
+            )
+        else:
+            state = entry['state']
+        if 'reason' in entry:
+            state += ', last abort: ' + penalty_reason(entry['reason'])
+        yield '\t{location} ({op} @ {pc}): {state}'.format(
+            location=entry['location'] or 'unknown location',
+            op=entry['op'], pc=strx64(entry['pc']), state=state,
+        )
+
+
+# }}}
+
+# Profilers {{{
+
+
+# See lj_memprof.c, lj_sysprof.c and lj_wbuf.h for details. The states
+# of both profilers are alike (MPS_* and SPS_*).
+PROFILER_STATES = ('idle', 'profiling', 'halted')
+SYSPROF_MODES = ('default', 'leaf', 'callgraph')
+# The order of the counters is the order of the VM states.
+SYSPROF_COUNTERS = ('interp', 'lfunc', 'ffunc', 'cfunc', 'gc', 'exit',
+                    'record', 'opt', 'asm', 'trace')
+STREAM_ERRIO = 0x1
+STREAM_STOP = 0x2
+# Both streams start with the symbol table and end with the same byte
+# (LJM_EPILOGUE_HEADER and LJP_EPILOGUE_BYTE).
+LJS_MAGIC = b'ljs'
+PROFILE_EPILOGUE = b'\x80'
+
+
+def profiler_stream(addr):
+    size, buf, pos, flags, errno = read_fields(
+        'struct lj_wbuf', addr, 'size', 'buf', 'pos', 'flags', 'saved_errno'
+    )
+    return {'size': size, 'buf': buf, 'used': pos - buf if buf else 0,
+            'flags': flags, 'errno': errno}
+
+
+def profilers():
+    # Yield the state of every profiler LuaJIT is built with. The
+    # profilers keep it in the static variables named after them.
+    static_address = adapter['static_address']
+    for name in ('memprof', 'sysprof'):
+        addr = static_address(name) if static_address else None
+        if not addr:
+            continue
+        typename = 'struct ' + name
+        state, = read_fields(typename, addr, 'state')
+        profiler = {
+            'name':   name,
+            'state':  PROFILER_STATES[state]
+            if state < len(PROFILER_STATES) else 'state {}'.format(state),
+            'stream': profiler_stream(addr + offsetof(typename, 'out')),
+        }
+        if name == 'sysprof':
+            mode, interval = read_fields(
+                'struct luam_Sysprof_Options',
+                addr + offsetof(typename, 'opt'), 'mode', 'interval'
+            )
+            profiler['mode'] = SYSPROF_MODES[mode] \
+                if mode < len(SYSPROF_MODES) else 'mode {}'.format(mode)
+            profiler['interval'] = interval
+            profiler['counters'] = read_fields(
+                'struct luam_Sysprof_Counters',
+                addr + offsetof(typename, 'counters'),
+                *['vmst_' + c for c in SYSPROF_COUNTERS] + ['samples']
+            )
+        yield profiler
+
+
+def save_profile(stream, path):
+    # Write the unflushed part of the stream with the epilogue appended,
+    # so the tools parse it till the end. Return True if the buffer
+    # holds the whole stream, i.e. nothing is flushed yet.
+    data = read_memory(stream['buf'], stream['used'])
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.write(PROFILE_EPILOGUE)
+    return bytes(data[:len(LJS_MAGIC)]) == LJS_MAGIC
+
+
+def dump_profilers(prefix=None):
+    found = False
+    for profiler in profilers():
+        found = True
+        name, stream = profiler['name'], profiler['stream']
+        yield '{}: {}'.format(name, profiler['state'])
+        if name == 'sysprof':
+            yield '\tmode: {mode}, interval: {interval} ms'.format(
+                **profiler
+            )
+            counters = profiler['counters']
+            yield '\tsamples: {} ({})'.format(counters[-1], ', '.join(
+                '{} {}'.format(c, n)
+                for c, n in zip(SYSPROF_COUNTERS, counters) if n
+            ) or 'none')
+        if not stream['buf']:
+            yield '\tstream: none'
+            continue
+        if stream['flags'] & STREAM_ERRIO:
+            status = 'I/O error (errno {})'.format(stream['errno'])
+        elif stream['flags'] & STREAM_STOP:
+            status = 'stopped'
+        else:
+            status = 'ok'
+        yield '\tstream: {}, {} of {} buffer bytes unflushed @ {}'.format(
+            status, stream['used'], stream['size'], strx64(stream['buf'])
+        )
+        if prefix is None or not stream['used']:
+            continue
+        path = '{}.{}.bin'.format(prefix, name)
+        if save_profile(stream, path):
+            yield '\tthe whole profile is written to {}'.format(path)
+        else:
+            yield '\tthe tail of the profile is written to {}, append it ' \
+                'to the flushed part to parse'.format(path)
+    if not found:
+        yield 'No profilers found: LuaJIT is built without them or ' \
+            'the debug info is missing'
+
+
+# }}}
+
+# Metrics {{{
+
+
+# The incremental GC states in the order of GCState.state_count.
+GC_STATES = ('pause', 'propagate', 'atomic', 'sweepstring', 'sweep',
+             'finalize')
+
+
+def has_field(typename, field):
+    try:
+        fieldof(typename, field)
+        return True
+    except Exception:
+        return False
+
+
+def metrics():
+    # The same values luaM_metrics() reports (see lj_mapi.c) in the order
+    # of luam_Metrics. The counters missing in the build (cdata without
+    # FFI and everything JIT-related without JIT) are zero.
+    g = adapter['global_state']()
+    gc = g + offsetof('global_State', 'gc')
+    values = collections.OrderedDict(zip(
+        ('strhash_hit', 'strhash_miss', 'gc_strnum'),
+        read_fields('global_State', g,
+                    'strhash_hit', 'strhash_miss', 'strnum'),
+    ))
+    values.update(zip(
+        ('gc_tabnum', 'gc_udatanum'),
+        read_fields('GCState', gc, 'tabnum', 'udatanum'),
+    ))
+    values['gc_cdatanum'] = read_fields('GCState', gc, 'cdatanum')[0] \
+        if has_field('GCState', 'cdatanum') else 0
+    values.update(zip(
+        ('gc_total', 'gc_freed', 'gc_allocated'),
+        read_fields('GCState', gc, 'total', 'freed', 'allocated'),
+    ))
+    offset, size = fieldof('GCState', 'state_count')
+    word = sizeof('size_t')
+    buf = read_memory(gc + offset, size)
+    for i, state in enumerate(GC_STATES):
+        values['gc_steps_' + state] = unpack_uint(buf, i * word, word)
+    fields = ('nsnaprestore', 'ntraceabort', 'szallmcarea', 'tracenum')
+    counters = read_fields('jit_State', jit_state_addr(), *fields) \
+        if has_field('GG_State', 'J') else (0,) * len(fields)
+    values.update(zip(
+        ('jit_snap_restore', 'jit_trace_abort', 'jit_mcode_size',
+         'jit_trace_num'),
+        counters,
+    ))
+    return values
+
+
+def parse_metrics(arg):
+    # The options for the metrics: --json.
+    expr, opts = parse_options(arg, (), ('--json',))
+    return expr, {'json': opts.get('json', False)}
+
+
+def dump_metrics(json_line=False):
+    values = metrics()
+    if json_line:
+        yield json.dumps(values)
+        return
+    yield 'Metrics:'
+    for name, value in values.items():
+        yield '\t{}: {}'.format(name, value)
+
+
+# }}}
+
+# Watch {{{
+
+
+# The sampled fields: the column, the structure within GG_State and the
+# field of it.
+WATCH_FIELDS = (
+    ('total',    'gc', 'GCState',      'total'),
+    ('debt',     'gc', 'GCState',      'debt'),
+    ('gcstate',  'gc', 'GCState',      'state'),
+    ('vmstate',  'g',  'global_State', 'vmstate'),
+    ('strnum',   'g',  'global_State', 'strnum'),
+    ('tracenum', 'J',  'jit_State',    'tracenum'),
+)
+
+
+def parse_watch(arg):
+    # The options for the sampler: --count <N>. The interval (in
+    # milliseconds) and the file name are given instead of the
+    # expression.
+    expr, opts = parse_options(arg, ('--count',))
+    argv = expr.split()
+    if len(argv) != 2 or not argv[0].isdigit() or not int(argv[0]):
+        raise ValueError('expected a positive interval in milliseconds '
+                         'and a file name')
+    return expr, {
+        'interval': int(argv[0]),
+        'path':     os.path.expanduser(argv[1]),
+        'count':    opts.get('count', 0),
+    }
+
+
+def watch_window():
+    # The offsets of the sampled fields within GG_State are computed
+    # once, so every sample is a single read of the span covering them.
+    bases = {'g': offsetof('GG_State', 'g')}
+    bases['gc'] = bases['g'] + offsetof('global_State', 'gc')
+    if has_field('GG_State', 'J'):
+        bases['J'] = offsetof('GG_State', 'J')
+    fields = []
+    for name, base, typename, field in WATCH_FIELDS:
+        if base in bases:
+            offset, size = fieldof(typename, field)
+            fields.append((name, bases[base] + offset, size))
+    start = min(offset for _, offset, _ in fields)
+    end = max(offset + size for _, offset, size in fields)
+    return start, end - start, [(name, offset - start, size)
+                                for name, offset, size in fields]
+
+
+def watch_sample(gg, window):
+    start, size, fields = window
+    buf = read_memory(gg + start, size)
+    sample = collections.OrderedDict(
+        (name, unpack_uint(buf, offset, size))
+        for name, offset, size in fields
+    )
+    state = sample['gcstate']
+    sample['gcstate'] = GC_STATES[state].upper() \
+        if state < len(GC_STATES) else 'INVALID'
+    # The VM states are the ones sysprof counts, and the trace number is
+    # kept while the trace is executed.
+    state = i2notu32(sample['vmstate'])
+    sample['vmstate'] = SYSPROF_COUNTERS[state].upper() \
+        if state < len(SYSPROF_COUNTERS) - 1 else 'TRACE'
+    return sample
+
+
+def dump_watch(path, interval, count, resume):
+    # Sample the fields every <interval> milliseconds up to <count>
+    # times (or until interrupted) and write the time series to <path>:
+    # JSON lines if it ends with .json and CSV otherwise. resume(seconds)
+    # is provided by the extension: it lets the stopped inferior run for
+    # the given time, interrupts it and returns the time the interrupt
+    # is sent at, or None if the inferior has stopped for another reason
+    # (breakpoint, signal, Ctrl-C, exit).
+    window = watch_window()
+    gg = adapter['global_state']() - offsetof('GG_State', 'g')
+    json_lines = path.endswith('.json')
+    samples = 0
+    # The time the inferior is stopped per sample: from the interrupt
+    # up to the request to resume it. The first sample is taken when the
+    # inferior is already stopped, so it is not accounted.
+    pauses = []
+    interrupted = None
+    over = None
+    with open(path, 'w') as f:
+        try:
+            while True:
+                sample = collections.OrderedDict(time=time.time())
+                sample.update(watch_sample(gg, window))
+                if json_lines:
+                    f.write(json.dumps(sample) + '\n')
+                else:
+                    if not samples:
+                        f.write(','.join(sample.keys()) + '\n')
+                    f.write(','.join(str(v) for v in sample.values()) + '\n')
+                samples += 1
+                if interrupted is not None:
+                    pauses.append(time.time() - interrupted)
+                if count and samples >= count:
+                    break
+                interrupted = resume(interval / 1000.0)
+                if interrupted is None:
+                    over = 'The process has stopped for another ' \
+                        'reason (breakpoint, signal, Ctrl-C or exit)'
+                    break
+        except KeyboardInterrupt:
+            over = 'Interrupted'
+    if over:
+        yield '{}, watching is over'.format(over)
+    yield '{} samples of {} bytes written to {}'.format(
+        samples, window[1], path
+    )
+    if pauses:
+        # The resume itself (e.g. ptrace and the continue handling of
+        # the debugger) is not accounted.
+        yield 'Time from the interrupt to the resume per sample: ' \
+            'avg {:.0f} us, max {:.0f} us'.format(
+                1e6 * sum(pauses) / len(pauses), 1e6 * max(pauses)
+            )
+
+
+# }}}
@@ -0,0 +1,530 @@
+# Heap snapshot of the LuaJIT inferior: the compact binary format
+# written by the lj-heapdump command of the debugger extensions and the
+# reader to analyze the snapshot offline. The module depends on nothing
+# but the standard library, so the snapshot taken from the production
+# core can be analyzed anywhere without the debugger.
+#
+# The snapshot is a stream of records. All integers are unsigned LEB128
+# unless stated otherwise; the addresses are stored as zigzag-encoded
+# deltas to keep them short, since the neighbour objects are mostly
+# allocated close to each other.
+# * header: MAGIC, version (u8), flags (u8, see FLAG_* below)
+# * object: type (u8, the gct field of the object), delta of the address
+#   to the address of the previous object, size in bytes, label index
+#   (see below), the number of references and the references: kind (u8,
+#   index in REF_KINDS) and delta of the referenced object address to
+#   the object address
+# * label: LABEL type, length and UTF-8 bytes of the string. The labels
+#   are the allocation sites of the functions, prototypes and traces
+#   (<chunkname>:<firstline>) and the lj-gc-census buckets of the other
+#   objects (e.g. the table shape). Every label is written once before
+#   the first object labeled with it, and the objects refer to the
+#   labels by the 1-based index in the order they are written (zero is
+#   no label).
+# * roots: the same as object with ROOTS type and zero address, its
+#   references are the GC roots
+# * end: END or END_PARTIAL type (the walk is interrupted)
+#
+#
+# Two snapshots (e.g. taken before and after the load test) are compared
+# via --diff: the objects are matched by the type, the label and the size
+# rather than by the address, so the snapshots of different processes are
+# comparable too. The objects are counted per such signature in sorted
+# runs, which are spilled to the temporary files when they grow too big,
+# and merged, so the snapshots are never kept in memory.
+#
+# Usage: luajit_heapdump.py <file> [--top <N>]
+#        luajit_heapdump.py <file> --retainers <address> [--paths <N>]
+#                          [--depth <N>]
+#        luajit_heapdump.py <file> --diff <old file> [--top <N>]
+
+import argparse
+import collections
+import heapq
+import json
+import sys
+import tempfile
+
+MAGIC = b'LJHEAP'
+VERSION = 2
+
+FLAG_GC64 = 0x1
+
+# Pseudo-types of the records.
+LABEL = 0xfc
+ROOTS = 0xfd
+END_PARTIAL = 0xfe
+END = 0xff
+
+# The gct values of the GC objects (~LJ_T* from lj_obj.h).
+TYPES = {
+    4:  'LJ_TSTR',
+    5:  'LJ_TUPVAL',
+    6:  'LJ_TTHREAD',
+    7:  'LJ_TPROTO',
+    8:  'LJ_TFUNC',
+    9:  'LJ_TTRACE',
+    10: 'LJ_TCDATA',
+    11: 'LJ_TTAB',
+    12: 'LJ_TUDATA',
+}
+
+# The kinds of the references between the objects.
+REF_KINDS = [
+    'root',
+    'metatable',
+    'env',
+    'key',
+    'value',
+    'weak key',
+    'weak value',
+    'upvalue',
+    'proto',
+    'constant',
+    'chunkname',
+    'stack',
+]
+
+REF = dict((kind, i) for i, kind in enumerate(REF_KINDS))
+
+# The references that do not keep the object alive.
+WEAK_KINDS = ('weak key', 'weak value')
+
+# The types labeled with the allocation sites.
+SITE_TYPES = ('LJ_TPROTO', 'LJ_TFUNC', 'LJ_TTRACE')
+
+# The size of the piece read from the snapshot at once.
+READ_CHUNK = 1 << 20
+
+# The number of the distinct signatures counted in memory before the
+# sorted run is spilled to the temporary file.
+RUN_SIZE = 1 << 16
+
+
+def zigzag(val):
+    return val << 1 if val >= 0 else (-val << 1) - 1
+
+
+def unzigzag(val):
+    return -((val + 1) >> 1) if val & 1 else val >> 1
+
+
+def uleb128(buf, val):
+    while val >= 0x80:
+        buf.append((val & 0x7f) | 0x80)
+        val >>= 7
+    buf.append(val)
+
+
+class Writer(object):
+    # Every record is encoded at once and written to the file object
+    # right away, so the snapshot is never kept in memory.
+    def __init__(self, f, gc64):
+        self.f = f
+        self.prev = 0
+        self.labels = {}
+        f.write(MAGIC + bytes(bytearray([VERSION, FLAG_GC64 if gc64 else 0])))
+
+    def record(self, otype, addr, size, refs, label=None):
+        buf = bytearray()
+        if label is not None and label not in self.labels:
+            data = label.encode('utf-8')
+            buf.append(LABEL)
+            uleb128(buf, len(data))
+            buf += data
+            self.labels[label] = len(self.labels) + 1
+        buf.append(otype)
+        uleb128(buf, zigzag(addr - self.prev))
+        uleb128(buf, size)
+        uleb128(buf, self.labels.get(label, 0))
+        uleb128(buf, len(refs))
+        for kind, target in refs:
+            buf.append(REF[kind])
+            uleb128(buf, zigzag(target - addr))
+        self.f.write(bytes(buf))
+        if otype != ROOTS:
+            self.prev = addr
+        return len(buf)
+
+    def close(self, complete=True):
+        self.f.write(bytes(bytearray([END if complete else END_PARTIAL])))
+        return 1
+
+
+class Reader(object):
+    # The snapshot is decoded piece by piece, so it is never kept in
+    # memory as a whole.
+    def __init__(self, f):
+        self.f = f
+        self.buf = bytearray(f.read(len(MAGIC) + 2))
+        if bytes(self.buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError('not a LuaJIT heap snapshot')
+        if self.buf[len(MAGIC)] != VERSION:
+            raise ValueError('unsupported snapshot version {}'.format(
+                self.buf[len(MAGIC)]
+            ))
+        self.gc64 = bool(self.buf[len(MAGIC) + 1] & FLAG_GC64)
+        self.buf = bytearray()
+        self.pos = 0
+        self.labels = [None]
+        self.partial = None
+
+    def byte(self):
+        val = self.buf[self.pos]
+        self.pos += 1
+        return val
+
+    def uleb128(self):
+        val = 0
+        shift = 0
+        while True:
+            byte = self.byte()
+            val |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return val
+
+    def decode(self, prev):
+        otype = self.byte()
+        if otype in (END, END_PARTIAL):
+            return otype, None
+        if otype == LABEL:
+            length = self.uleb128()
+            if self.pos + length > len(self.buf):
+                raise IndexError('the label is split')
+            data = self.buf[self.pos:self.pos + length]
+            self.pos += length
+            return otype, bytes(data).decode('utf-8', 'replace')
+        addr = prev + unzigzag(self.uleb128())
+        size = self.uleb128()
+        label = self.uleb128()
+        if label >= len(self.labels):
+            raise ValueError('invalid label index {}'.format(label))
+        refs = []
+        for _ in range(self.uleb128()):
+            kind = self.byte()
+            if kind >= len(REF_KINDS):
+                raise ValueError('invalid reference kind {}'.format(kind))
+            refs.append((REF_KINDS[kind], addr + unzigzag(self.uleb128())))
+        return otype, (addr if otype != ROOTS else 0, size, refs,
+                       self.labels[label])
+
+    def __iter__(self):
+        # Yield (type, address, size, references, label) for every
+        # record, the type is the name from TYPES or 'roots'.
+        prev = 0
+        while True:
+            start = self.pos
+            try:
+                otype, record = self.decode(prev)
+            except IndexError:
+                # The record is split by the piece boundary.
+                chunk = self.f.read(READ_CHUNK)
+                if not chunk:
+                    raise ValueError('the snapshot is truncated')
+                self.buf = self.buf[start:] + bytearray(chunk)
+                self.pos = 0
+                continue
+            if record is None:
+                self.partial = otype == END_PARTIAL
+                return
+            if otype == LABEL:
+                self.labels.append(record)
+                continue
+            if otype == ROOTS:
+                yield ('roots', 0) + record[1:]
+                continue
+            prev = record[0]
+            yield (TYPES.get(otype, 'LJ_TINVALID'),) + record
+
+
+class Retainers(object):
+    # Reverse reference index of the heap: the referrers of every object
+    # and the GC roots. It is built both from the snapshot and from the
+    # inferior memory by the debugger extensions.
+    def __init__(self):
+        self.referrers = {}
+        self.roots = set()
+        self.types = {}
+
+    def add(self, otype, addr, refs):
+        if otype == 'roots':
+            self.roots.update(target for _, target in refs)
+            return
+        self.types[addr] = otype
+        for kind, target in refs:
+            if kind in WEAK_KINDS:
+                continue
+            self.referrers.setdefault(target, []).append((addr, REF[kind]))
+
+    def paths(self, target, count=3, depth=None):
+        # Breadth-first search from the object up to the GC roots over
+        # the reverse references. Yield at most <count> shortest paths
+        # (from the different roots) as lists of (object, kind of the
+        # reference to the next object) pairs.
+        parent = {target: None}
+        queue = collections.deque([(target, 0)])
+        while queue and count > 0:
+            obj, level = queue.popleft()
+            if obj in self.roots:
+                path = []
+                while obj is not None:
+                    child = parent[obj]
+                    path.append((obj, child and REF_KINDS[child[1]]))
+                    obj = child and child[0]
+                yield path
+                count -= 1
+                continue
+            if depth is not None and level >= depth:
+                continue
+            for referrer, kind in self.referrers.get(obj, ()):
+                if referrer not in parent:
+                    parent[referrer] = (obj, kind)
+                    queue.append((referrer, level + 1))
+
+    def dump(self, target, count=3, depth=None, describe=None):
+        describe = describe or (lambda obj: '{} @ {}'.format(
+            self.types.get(obj, 'unknown object'), hex(obj)
+        ))
+        yield '{} is referenced by {} objects directly'.format(
+            describe(target), len(self.referrers.get(target, ()))
+        )
+        found = 0
+        for path in self.paths(target, count, depth):
+            found += 1
+            yield 'Path #{} ({} references):'.format(found, len(path) - 1)
+            yield '\tGC root: {}'.format(describe(path[0][0]))
+            for (_, kind), (obj, _) in zip(path, path[1:]):
+                yield '\t{} -> {}'.format(kind, describe(obj))
+        if not found:
+            yield 'No path from the GC roots is found{}'.format(
+                ' within {} references'.format(depth)
+                if depth is not None else ''
+            )
+
+
+def read(path):
+    # Yield the records of the snapshot file.
+    with open(path, 'rb') as f:
+        for record in Reader(f):
+            yield record
+
+
+def summary(path, top=10):
+    # Totals per type and the largest objects of the snapshot.
+    types = {}
+    largest = []
+    nrefs = 0
+    reader = None
+    with open(path, 'rb') as f:
+        reader = Reader(f)
+        for otype, addr, size, refs, _ in reader:
+            nrefs += len(refs)
+            if otype == 'roots':
+                yield 'Roots: {} references'.format(len(refs))
+                continue
+            stats = types.setdefault(otype, [0, 0])
+            stats[0] += 1
+            stats[1] += size
+            largest.append((size, otype, addr))
+            if len(largest) > 4 * top:
+                largest = sorted(largest, reverse=True)[:top]
+    if reader.partial:
+        yield 'The snapshot is partial: the walk was interrupted'
+    for otype, (count, size) in sorted(types.items(),
+                                       key=lambda t: -t[1][1]):
+        yield '{}: {} objects, {} bytes'.format(otype, count, size)
+    yield 'Total: {} objects, {} bytes, {} references'.format(
+        sum(t[0] for t in types.values()),
+        sum(t[1] for t in types.values()),
+        nrefs,
+    )
+    yield 'Top {} largest objects:'.format(top)
+    for size, otype, addr in sorted(largest, reverse=True)[:top]:
+        yield '\t{} @ {}: {} bytes'.format(otype, hex(addr), size)
+
+
+def spill(counts):
+    # Write the sorted run to the temporary file.
+    f = tempfile.TemporaryFile('w+')
+    for signature, count in sorted(counts.items()):
+        f.write(json.dumps([signature, count]) + '\n')
+    f.seek(0)
+    return f
+
+
+def unspill(f):
+    for line in f:
+        signature, count = json.loads(line)
+        yield tuple(signature), count
+
+
+def comparable(label):
+    # The addresses of the C functions differ from process to process
+    # (ASLR), so only the fact the function is a C one is compared.
+    if label and label.startswith('C function @'):
+        return 'C function'
+    return label or ''
+
+
+def signatures(records, run_size=RUN_SIZE):
+    # Yield (signature, count) pairs sorted by the signature, that is the
+    # type, the label and the size of the object. The counts are kept in
+    # memory until there are <run_size> distinct signatures, then the
+    # sorted run is spilled to the temporary file, and all the runs are
+    # merged at the end.
+    runs = []
+    counts = {}
+    try:
+        for otype, _, size, _, label in records:
+            if otype == 'roots':
+                continue
+            signature = (otype, comparable(label), size)
+            counts[signature] = counts.get(signature, 0) + 1
+            if len(counts) >= run_size:
+                runs.append(spill(counts))
+                counts = {}
+        streams = [unspill(f) for f in runs]
+        streams.append(iter(sorted(counts.items())))
+        prev, total = None, 0
+        for signature, count in heapq.merge(*streams):
+            if signature != prev and prev is not None:
+                yield prev, total
+                total = 0
+            prev = signature
+            total += count
+        if prev is not None:
+            yield prev, total
+    finally:
+        for f in runs:
+            f.close()
+
+
+def merge(old, new):
+    # Merge two sorted (signature, count) streams into (signature, old
+    # count, new count) ones.
+    a = next(old, None)
+    b = next(new, None)
+    while a is not None or b is not None:
+        if b is None or a is not None and a[0] < b[0]:
+            yield a[0], a[1], 0
+            a = next(old, None)
+        elif a is None or b[0] < a[0]:
+            yield b[0], 0, b[1]
+            b = next(new, None)
+        else:
+            yield a[0], a[1], b[1]
+            a = next(old, None)
+            b = next(new, None)
+
+
+def account(groups, name, size, old, new):
+    stats = groups.setdefault(name, [0, 0, 0, 0])
+    stats[0] += old
+    stats[1] += new
+    stats[2] += old * size
+    stats[3] += new * size
+
+
+def growth(groups, top=None):
+    # Yield the lines for the groups changed the most in bytes.
+    changed = [(name, stats) for name, stats in groups.items()
+               if stats[0] != stats[1] or stats[2] != stats[3]]
+    changed.sort(key=lambda g: (g[1][2] - g[1][3], g[1][0] - g[1][1]))
+    for name, (old, new, oldsize, newsize) in changed[:top]:
+        yield '\t{}: {} -> {} objects ({:+d}), {} -> {} bytes ' \
+            '({:+d})'.format(name, old, new, new - old,
+                             oldsize, newsize, newsize - oldsize)
+
+
+def diff(old, new, top=10, run_size=RUN_SIZE):
+    # Compare two heap walks given as the record iterables (e.g. Reader
+    # objects) and yield the report on the growth by type, by allocation
+    # site and by table shape. The objects are matched by the signature,
+    # so the ones not matched are reported as allocated or freed.
+    types = {}
+    sites = {}
+    shapes = {}
+    totals = {'matched': 0, 'allocated': 0, 'freed': 0}
+    counts = merge(signatures(old, run_size), signatures(new, run_size))
+    for (otype, label, size), ocount, ncount in counts:
+        totals['matched'] += min(ocount, ncount)
+        totals['allocated'] += max(ncount - ocount, 0)
+        totals['freed'] += max(ocount - ncount, 0)
+        account(types, otype, size, ocount, ncount)
+        if otype in SITE_TYPES and label:
+            account(sites, label, size, ocount, ncount)
+        elif otype == 'LJ_TTAB' and label:
+            account(shapes, label, size, ocount, ncount)
+    for name, records in (('old', old), ('new', new)):
+        if getattr(records, 'partial', False):
+            yield 'The {} snapshot is partial: the walk was ' \
+                'interrupted'.format(name)
+    total = [sum(t[i] for t in types.values()) for i in range(4)]
+    yield 'Total: {} -> {} objects, {} -> {} bytes ({:+d})'.format(
+        total[0], total[1], total[2], total[3], total[3] - total[2],
+    )
+    yield 'Matched: {matched} objects, allocated: {allocated} objects, ' \
+        'freed: {freed} objects'.format(**totals)
+    yield 'By type:'
+    for line in growth(types):
+        yield line
+    yield 'Top {} allocation sites by growth:'.format(top)
+    for line in growth(sites, top):
+        yield line
+    yield 'Top {} table shapes by growth:'.format(top)
+    for line in growth(shapes, top):
+        yield line
+
+
+def diff_files(old, new, top=10, records=None):
+    # Compare the snapshot files or the snapshot file <old> with the
+    # given <records> (e.g. the live heap walk) instead of <new> one.
+    with open(old, 'rb') as fold:
+        if records is not None:
+            for line in diff(Reader(fold), records, top):
+                yield line
+            return
+        with open(new, 'rb') as fnew:
+            for line in diff(Reader(fold), Reader(fnew), top):
+                yield line
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Summarize LuaJIT heap snapshot',
+    )
+    parser.add_argument('file', help='snapshot written by lj-heapdump')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of the largest objects (or the '
+                        'groups grown the most) to show')
+    parser.add_argument('--retainers', type=lambda v: int(v, 0),
+                        help='address of the object to find the shortest '
+                        'paths from the GC roots to')
+    parser.add_argument('--paths', type=int, default=3,
+                        help='number of the paths to show')
+    parser.add_argument('--depth', type=int,
+                        help='maximum length of the path')
+    parser.add_argument('--diff', metavar='OLD',
+                        help='snapshot to compare the given one with')
+    args = parser.parse_args()
+    if args.diff and args.retainers is not None:
+        parser.error('--diff and --retainers are mutually exclusive')
+    try:
+        if args.diff:
+            lines = diff_files(args.diff, args.file, args.top)
+        elif args.retainers is None:
+            lines = summary(args.file, args.top)
+        else:
+            index = Retainers()
+            for otype, addr, _, refs, _ in read(args.file):
+                index.add(otype, addr, refs)
+            lines = index.dump(args.retainers, args.paths, args.depth)
+        for line in lines:
+            sys.stdout.write(line + '\n')
+    except (IOError, OSError, ValueError) as e:
+        sys.exit('{}: {}'.format(args.file, e))
+
+
+if __name__ == '__main__':
+    main()
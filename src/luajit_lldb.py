@@ -3,9 +3,18 @@
 # in lldb.
 
 import abc
+import atexit
+import functools
+import os
 import re
+import threading
+import time
 import lldb
 
+# XXX: LLDB adds the directory of the imported script to sys.path, so
+# the debugger-agnostic core located nearby is importable as is.
+import luajit_dbg_core as core
+
 LJ_64 = None
 LJ_GC64 = None
 LJ_FR2 = None
@@ -14,8 +23,6 @@ PADDING = None
 
 # Constants
 IRT_P64 = 9
-LJ_GCVMASK = ((1 << 47) - 1)
-LJ_TISNUM = None
 
 # Debugger specific {{{
 
@@ -25,24 +32,25 @@ target = None
 
 
 class Ptr:
-    def __init__(self, value, normal_type):
-        self.value = value
-        self.normal_type = normal_type
+    # The type of the pointed object, set for every <Struct>Ptr class.
+    normal_type = None
+
+    def __init__(self, value):
+        self.value = addrof(value)
+        self.target = None
 
     @property
     def __deref(self):
-        return self.normal_type(self.value.Dereference())
+        # The pointed object is created only once, so all its fields
+        # are unpacked from a single read of the object.
+        if self.target is None:
+            self.target = self.normal_type(self.value)
+        return self.target
 
     def __add__(self, other):
         assert isinstance(other, int)
         return self.__class__(
-            cast(
-                self.normal_type.__name__ + ' *',
-                cast(
-                    'uintptr_t',
-                    self.value.unsigned + other * self.value.deref.size,
-                ),
-            ),
+            self.value + other * core.sizeof(self.normal_type.__name__)
         )
 
     def __sub__(self, other):
@@ -50,35 +58,35 @@ class Ptr:
         if isinstance(other, int):
             return self.__add__(-other)
         else:
-            return int((self.value.unsigned - other.value.unsigned)
-                       / sizeof(self.normal_type.__name__))
+            return int((self.value - other.value)
+                       / core.sizeof(self.normal_type.__name__))
 
     def __eq__(self, other):
         assert isinstance(other, Ptr) or isinstance(other, int) and other >= 0
         if isinstance(other, Ptr):
-            return self.value.unsigned == other.value.unsigned
+            return self.value == other.value
         else:
-            return self.value.unsigned == other
+            return self.value == other
 
     def __ne__(self, other):
         return not self == other
 
     def __gt__(self, other):
         assert isinstance(other, Ptr)
-        return self.value.unsigned > other.value.unsigned
+        return self.value > other.value
 
     def __ge__(self, other):
         assert isinstance(other, Ptr)
-        return self.value.unsigned >= other.value.unsigned
+        return self.value >= other.value
 
     def __bool__(self):
-        return self.value.unsigned != 0
+        return self.value != 0
 
     def __int__(self):
-        return self.value.unsigned
+        return self.value
 
     def __str__(self):
-        return self.value.value
+        return hex(self.value)
 
     def __getattr__(self, name):
         if name != '__deref':
@@ -92,14 +100,23 @@ class MetaStruct(type):
 
         def make_general(field, tp):
             builtin = {
-                        'uint':   'unsigned',
-                        'int':    'signed',
-                        'string': 'value',
-                    }
+                'uint': lambda self: self[field],
+                'int': lambda self: core.tosigned(
+                    self[field], core.fieldof(name, field)[1]
+                ),
+                'number': lambda self: core.numV(self[field]),
+            }
             if tp in builtin.keys():
-                return lambda self: getattr(self[field], builtin[tp])
-            else:
-                return lambda self: globals()[tp](self[field])
+                return builtin[tp]
+
+            def wrap(self):
+                addr, data = self.member(field)
+                wrapper = globals()[tp]
+                if issubclass(wrapper, Ptr):
+                    return wrapper(core.unpack_uint(data, 0, len(data)))
+                # Nested structure reuses the buffer of the outer one.
+                return wrapper(addr, data)
+            return wrap
 
         if hasattr(cls, 'metainfo'):
             for field in cls.metainfo:
@@ -114,35 +131,50 @@ class MetaStruct(type):
 
 
 class Struct(metaclass=MetaStruct):
-    def __init__(self, value):
-        self.value = value
+    def __init__(self, value, data=b''):
+        self.value = addrof(value)
+        self.data = data
+
+    def fetch(self):
+        # The whole object is read on the first access to any of its
+        # fields, the others are unpacked from the same buffer.
+        size = core.sizeof(self.__class__.__name__)
+        if len(self.data) < size:
+            self.data = core.read_memory(self.value, size)
+        return self.data
+
+    def member(self, name):
+        # Address and the raw contents of the given field.
+        offset, size = core.fieldof(self.__class__.__name__, name)
+        return self.value + offset, self.fetch()[offset:offset + size]
 
     def __getitem__(self, name):
-        return self.value.GetChildMemberWithName(name)
+        _, data = self.member(name)
+        return core.unpack_uint(data, 0, len(data))
 
     @property
     def addr(self):
-        return self.value.address_of
+        return self.value
 
 
 c_structs = {
     'MRef': [
-        (property(lambda self: self['ptr64'].unsigned if LJ_GC64
-                  else self['ptr32'].unsigned), 'ptr')
+        (property(lambda self: self['ptr64'] if LJ_GC64
+                  else self['ptr32']), 'ptr')
     ],
     'GCRef': [
-        (property(lambda self: self['gcptr64'].unsigned if LJ_GC64
-                  else self['gcptr32'].unsigned), 'gcptr')
+        (property(lambda self: self['gcptr64'] if LJ_GC64
+                  else self['gcptr32']), 'gcptr')
     ],
     'TValue': [
         ('GCRef', 'gcr'),
         ('uint', 'it'),
         ('uint', 'i'),
         ('int', 'it64'),
-        ('string', 'n'),
-        (property(lambda self: FR(self['fr']) if not LJ_GC64 else None), 'fr'),
-        (property(lambda self: self['ftsz'].signed if LJ_GC64 else None),
-         'ftsz')
+        ('number', 'n'),
+        (property(lambda self: FR(self.value) if not LJ_GC64 else None), 'fr'),
+        (property(lambda self: core.tosigned(self['ftsz'], 8) if LJ_GC64
+                  else None), 'ftsz')
     ],
     'GCState': [
         ('GCRef', 'root'),
@@ -178,7 +210,9 @@ c_structs = {
         ('GCRef', 'nextgc')
     ],
     'GCobj': [
-        ('GChead', 'gch')
+        # GCobj is as large as the largest GC object, so only the
+        # common header is read.
+        (property(lambda self: GChead(self.value)), 'gch')
     ],
     'GCstr': [
         ('uint', 'hash'),
@@ -189,7 +223,11 @@ c_structs = {
         ('int', 'ftsz')
     ],
     'FR': [
-        ('FrameLink', 'tp')
+        # There is no named type for TValue.fr, so the frame link is
+        # located via TValue layout.
+        (property(lambda self: FrameLink(
+            self.value + core.offsetof('TValue', 'fr.tp')
+        )), 'tp')
     ],
     'GCfuncC': [
         ('MRef', 'pc'),
@@ -227,10 +265,7 @@ for cls in c_structs.keys():
 for cls in Struct.__subclasses__():
     ptr_name = cls.__name__ + 'Ptr'
 
-    globals()[ptr_name] = type(ptr_name, (Ptr,), {
-        '__init__':
-            lambda self, value: super(type(self), self).__init__(value, cls)
-    })
+    globals()[ptr_name] = type(ptr_name, (Ptr,), {'normal_type': cls})
 
 
 class Command(object):
@@ -249,6 +284,9 @@ class Command(object):
         except Exception as e:
             msg = 'Failed to execute command `{}`: {}'.format(self.command, e)
             result.SetError(msg)
+        finally:
+            # The layout misses are written to the cache once per command.
+            core.save_cache()
 
     def parse(self, command):
         process = target.GetProcess()
@@ -280,73 +318,27 @@ class Command(object):
         """
 
 
-def cast(typename, value):
-    pointer_type = False
-    name = None
-    if isinstance(value, Struct) or isinstance(value, Ptr):
-        # Get underlying value, if passed object is a wrapper.
-        value = value.value
-
-    # Obtain base type name, decide whether it's a pointer.
-    if isinstance(typename, type):
-        name = typename.__name__
-        if name.endswith('Ptr'):
-            pointer_type = True
-            name = name[:-3]
-    else:
-        name = typename
-        if name[-1] == '*':
-            name = name[:-1].strip()
-            pointer_type = True
-
-    # Get the lldb type representation.
-    t = target.FindFirstType(name)
-    if pointer_type:
-        t = t.GetPointerType()
-
-    if isinstance(value, int):
-        # Integer casts require some black magic for lldb to behave properly.
-        if pointer_type:
-            casted = target.CreateValueFromAddress(
-                'value',
-                lldb.SBAddress(value, target),
-                t.GetPointeeType(),
-            ).address_of
-        else:
-            casted = target.CreateValueFromData(
-                name='value',
-                data=lldb.SBData.CreateDataFromInt(value, size=8),
-                type=t,
-            )
-    else:
-        casted = value.Cast(t)
-
-    if isinstance(typename, type):
-        # Wrap lldb object, if possible
-        return typename(casted)
-    else:
-        return casted
-
-
 def lookup_global(name):
     return target.FindFirstGlobalVariable(name)
 
 
 def type_member(type_obj, name):
-    return next((x for x in type_obj.members if x.name == name), None)
+    # Unlike the values, the types do not flatten the members of
+    # anonymous structs and unions, so they are looked up recursively.
+    for member in type_obj.members:
+        if member.name == name:
+            return member.GetOffsetInBytes(), member.type
+        if not member.name:
+            found = type_member(member.type, name)
+            if found is not None:
+                return member.GetOffsetInBytes() + found[0], found[1]
+    return None
 
 
 def find_type(typename):
     return target.FindFirstType(typename)
 
 
-def offsetof(typename, membername):
-    type_obj = find_type(typename)
-    member = type_member(type_obj, membername)
-    assert member is not None
-    return member.GetOffsetInBytes()
-
-
 def sizeof(typename):
     type_obj = find_type(typename)
     return type_obj.GetByteSize()
@@ -356,28 +348,106 @@ def vtou64(value):
     return value.unsigned & 0xFFFFFFFFFFFFFFFF
 
 
-def vtoi(value):
-    return value.signed
+def addrof(value):
+    # The wrappers are built right from the address, but the values
+    # obtained via lldb (e.g. the evaluated expressions) are accepted too.
+    return value if isinstance(value, int) else vtou64(value)
+
+
+# Adapter for the core {{{
+
+
+def read_memory(addr, size):
+    error = lldb.SBError()
+    data = target.GetProcess().ReadMemory(addr, size, error)
+    if error.Fail():
+        raise RuntimeError('cannot read {size} bytes at {addr}: {err}'.format(
+            size=size,
+            addr=hex(addr),
+            err=error.GetCString(),
+        ))
+    return data
+
+
+def fieldof(typename, membername):
+    # The member of the nested structure is given by its path, e.g.
+    # 'fr.tp' for TValue.
+    offset, type_obj = 0, find_type(typename)
+    for name in membername.split('.'):
+        member = type_member(type_obj, name)
+        assert member is not None
+        offset += member[0]
+        type_obj = member[1]
+    return offset, type_obj.GetByteSize()
+
+
+def global_state():
+    return int(G(L(None)))
 
 
-def dbg_eval(expr):
+def static_address(name):
+    variable = target.FindFirstGlobalVariable(name)
+    return variable.GetLoadAddress() if variable.IsValid() else None
+
+
+def stop_generation():
+    # The key of the per-stop caches. The stop ID is counted per process,
+    # so the identity of the process is a part of the key as well: the
+    # caches are not reused for another core file or a relaunched one.
     process = target.GetProcess()
-    thread = process.GetSelectedThread()
-    frame = thread.GetSelectedFrame()
-    return frame.EvaluateExpression(expr)
+    return (target.GetExecutable().fullpath, process.GetUniqueID(),
+            process.GetProcessID(), process.GetStopID())
 
 
-# }}} Debugger specific
+def watch_resume(interval):
+    # Let the inferior run for <interval> seconds and interrupt it. The
+    # stop is ours only if the interrupt has been sent and no thread has
+    # stopped for another reason (breakpoint, watchpoint, signal, etc.):
+    # the interrupted threads report either no reason or SIGSTOP.
+    # Return the time the interrupt is sent at or None.
+    process = target.GetProcess()
+    interrupted = []
 
+    def interrupt():
+        interrupted.append(time.time())
+        process.SendAsyncInterrupt()
 
-def gcval(obj):
-    return cast(GCobjPtr, cast('uintptr_t', obj.gcptr & LJ_GCVMASK) if LJ_GC64
-                else cast('uintptr_t', obj.gcptr))
+    timer = threading.Timer(interval, interrupt)
+    timer.start()
+    try:
+        process.Continue()
+    finally:
+        timer.cancel()
+    if not interrupted or process.GetState() != lldb.eStateStopped:
+        return None
+    sigstop = process.GetUnixSignals().GetSignalNumberFromName('SIGSTOP')
+    for thread in process:
+        reason = thread.GetStopReason()
+        if reason in (lldb.eStopReasonInvalid, lldb.eStopReasonNone):
+            continue
+        if reason == lldb.eStopReasonSignal \
+                and thread.GetStopReasonDataAtIndex(0) == sigstop:
+            continue
+        return None
+    return interrupted[0]
+
+
+def objfile_build_id():
+    # UUID (i.e. build-id for ELF) of the module libluajit is linked
+    # into, if any.
+    contexts = target.FindFunctions('luaJIT_setmode')
+    if contexts.GetSize() == 0:
+        return None
+    return contexts.GetContextAtIndex(0).GetModule().GetUUIDString()
+
+
+# }}}
+
+# }}} Debugger specific
 
 
 def gcref(obj):
-    return cast(GCobjPtr, obj.gcptr if LJ_GC64
-                else cast('uintptr_t', obj.gcptr))
+    return GCobjPtr(obj.gcptr)
 
 
 def gcnext(obj):
@@ -431,16 +501,13 @@ def dump_gc(g):
 
 
 def mref(typename, obj):
-    return cast(typename, obj.ptr)
+    return typename(obj.ptr)
 
 
 def J(g):
-    g_offset = offsetof('GG_State', 'g')
-    J_offset = offsetof('GG_State', 'J')
-    return cast(
-        jit_StatePtr,
-        vtou64(cast('char *', g)) - g_offset + J_offset,
-    )
+    g_offset = core.offsetof('GG_State', 'g')
+    J_offset = core.offsetof('GG_State', 'J')
+    return jit_StatePtr(int(g) - g_offset + J_offset)
 
 
 def G(L):
@@ -513,183 +580,6 @@ def strx64(val):
                   hex(int(val) & 0xFFFFFFFFFFFFFFFF))
 
 
-def funcproto(func):
-    assert func.ffid == 0
-    proto_size = sizeof('GCproto')
-    value = cast('uintptr_t', vtou64(mref('char *', func.pc)) - proto_size)
-    return cast(GCprotoPtr, value)
-
-
-def strdata(obj):
-    try:
-        ptr = cast('char *', obj + 1)
-        return ptr.summary
-    except UnicodeEncodeError:
-        return "<luajit-lldb: error occurred while rendering non-ascii slot>"
-
-
-def itype(o):
-    return tou32(o.it64 >> 47) if LJ_GC64 else o.it
-
-
-def tvisint(o):
-    return LJ_DUALNUM and itype(o) == LJ_TISNUM
-
-
-def tvislightud(o):
-    if LJ_64 and not LJ_GC64:
-        return (vtoi(cast('int32_t', itype(o))) >> 15) == -2
-    else:
-        return itype(o) == LJ_T['LIGHTUD']
-
-
-def tvisnumber(o):
-    return itype(o) <= LJ_TISNUM
-
-
-def dump_lj_tnil(tv):
-    return 'nil'
-
-
-def dump_lj_tfalse(tv):
-    return 'false'
-
-
-def dump_lj_ttrue(tv):
-    return 'true'
-
-
-def dump_lj_tlightud(tv):
-    return 'light userdata @ {}'.format(strx64(gcval(tv.gcr)))
-
-
-def dump_lj_tstr(tv):
-    return 'string {body} @ {address}'.format(
-        body=strdata(cast(GCstrPtr, gcval(tv.gcr))),
-        address=strx64(gcval(tv.gcr))
-    )
-
-
-def dump_lj_tupval(tv):
-    return 'upvalue @ {}'.format(strx64(gcval(tv.gcr)))
-
-
-def dump_lj_tthread(tv):
-    return 'thread @ {}'.format(strx64(gcval(tv.gcr)))
-
-
-def dump_lj_tproto(tv):
-    return 'proto @ {}'.format(strx64(gcval(tv.gcr)))
-
-
-def dump_lj_tfunc(tv):
-    func = cast(GCfuncCPtr, gcval(tv.gcr))
-    ffid = func.ffid
-
-    if ffid == 0:
-        pt = funcproto(func)
-        return 'Lua function @ {addr}, {nups} upvalues, {chunk}:{line}'.format(
-            addr=strx64(func),
-            nups=func.nupvalues,
-            chunk=strdata(cast(GCstrPtr, gcval(pt.chunkname))),
-            line=pt.firstline
-        )
-    elif ffid == 1:
-        return 'C function @ {}'.format(strx64(func.f))
-    else:
-        return 'fast function #{}'.format(ffid)
-
-
-def dump_lj_ttrace(tv):
-    trace = cast(GCtracePtr, gcval(tv.gcr))
-    return 'trace {traceno} @ {addr}'.format(
-        traceno=strx64(trace.traceno),
-        addr=strx64(trace)
-    )
-
-
-def dump_lj_tcdata(tv):
-    return 'cdata @ {}'.format(strx64(gcval(tv.gcr)))
-
-
-def dump_lj_ttab(tv):
-    table = cast(GCtabPtr, gcval(tv.gcr))
-    return 'table @ {gcr} (asize: {asize}, hmask: {hmask})'.format(
-        gcr=strx64(table),
-        asize=table.asize,
-        hmask=strx64(table.hmask),
-    )
-
-
-def dump_lj_tudata(tv):
-    return 'userdata @ {}'.format(strx64(gcval(tv.gcr)))
-
-
-def dump_lj_tnumx(tv):
-    if tvisint(tv):
-        return 'integer {}'.format(cast('int32_t', tv.i))
-    else:
-        return 'number {}'.format(tv.n)
-
-
-def dump_lj_invalid(tv):
-    return 'not valid type @ {}'.format(strx64(gcval(tv.gcr)))
-
-
-dumpers = {
-    'LJ_TNIL':     dump_lj_tnil,
-    'LJ_TFALSE':   dump_lj_tfalse,
-    'LJ_TTRUE':    dump_lj_ttrue,
-    'LJ_TLIGHTUD': dump_lj_tlightud,
-    'LJ_TSTR':     dump_lj_tstr,
-    'LJ_TUPVAL':   dump_lj_tupval,
-    'LJ_TTHREAD':  dump_lj_tthread,
-    'LJ_TPROTO':   dump_lj_tproto,
-    'LJ_TFUNC':    dump_lj_tfunc,
-    'LJ_TTRACE':   dump_lj_ttrace,
-    'LJ_TCDATA':   dump_lj_tcdata,
-    'LJ_TTAB':     dump_lj_ttab,
-    'LJ_TUDATA':   dump_lj_tudata,
-    'LJ_TNUMX':    dump_lj_tnumx,
-}
-
-
-LJ_T = {
-    'NIL':     i2notu32(0),
-    'FALSE':   i2notu32(1),
-    'TRUE':    i2notu32(2),
-    'LIGHTUD': i2notu32(3),
-    'STR':     i2notu32(4),
-    'UPVAL':   i2notu32(5),
-    'THREAD':  i2notu32(6),
-    'PROTO':   i2notu32(7),
-    'FUNC':    i2notu32(8),
-    'TRACE':   i2notu32(9),
-    'CDATA':   i2notu32(10),
-    'TAB':     i2notu32(11),
-    'UDATA':   i2notu32(12),
-    'NUMX':    i2notu32(13),
-}
-
-
-def itypemap(o):
-    if LJ_64 and not LJ_GC64:
-        return LJ_T['NUMX'] if tvisnumber(o) \
-            else LJ_T['LIGHTUD'] if tvislightud(o) else itype(o)
-    else:
-        return LJ_T['NUMX'] if tvisnumber(o) else itype(o)
-
-
-def typenames(value):
-    return {
-        LJ_T[k]: 'LJ_T' + k for k in LJ_T.keys()
-    }.get(int(value), 'LJ_TINVALID')
-
-
-def dump_tvalue(tvptr):
-    return dumpers.get(typenames(itypemap(tvptr)), dump_lj_invalid)(tvptr)
-
-
 FRAME_TYPE = 0x3
 FRAME_P = 0x4
 FRAME_TYPEP = FRAME_TYPE | FRAME_P
@@ -720,22 +610,20 @@ def bc_a(ins):
 
 
 def frame_ftsz(framelink):
-    return vtou64(cast('ptrdiff_t', framelink.ftsz if LJ_FR2
-                       else framelink.fr.tp.ftsz))
+    # The value is interpreted as ptrdiff_t.
+    ftsz = framelink.ftsz if LJ_FR2 else framelink.fr.tp.ftsz
+    return ftsz & ((1 << 8 * core.CTSIZE_PTR) - 1)
 
 
 def frame_pc(framelink):
-    return cast(BCInsPtr, frame_ftsz(framelink)) if LJ_FR2 \
+    return BCInsPtr(frame_ftsz(framelink)) if LJ_FR2 \
         else mref(BCInsPtr, framelink.fr.tp.pcr)
 
 
 def frame_prevl(framelink):
-    # We are evaluating the `frame_pc(framelink)[-1])` with lldb's
-    # REPL, because the lldb API is faulty and it's not possible to cast
-    # a struct member of 32-bit type to 64-bit type without getting onto
-    # the next property bits, despite the fact that it's an actual value, not
-    # a pointer to it.
-    bcins = vtou64(dbg_eval('((BCIns *)' + str(frame_pc(framelink)) + ')[-1]'))
+    # The previous instruction is read right from the memory, since
+    # BCIns is not a structure.
+    bcins = core.read_uint(int(frame_pc(framelink) - 1), core.sizeof('BCIns'))
     return framelink - (1 + LJ_FR2 + bc_a(bcins))
 
 
@@ -748,7 +636,7 @@ def frame_sized(framelink):
 
 
 def frame_prevd(framelink):
-    return framelink - int(frame_sized(framelink) / sizeof('TValue'))
+    return framelink - int(frame_sized(framelink) / core.sizeof('TValue'))
 
 
 def frame_type(framelink):
@@ -810,10 +698,14 @@ def dump_framelink(L, fr):
             p='P' if frame_typep(fr) & FRAME_P else ''
         ),
         d=fr - frame_prev(fr),
-        f=dump_lj_tfunc(fr - LJ_FR2),
+        f=core.dump_lj_tfunc(core.read_tvalue(int(fr - LJ_FR2))),
     )
 
 
+def dump_tvalue(tvptr):
+    return core.dump_tvalue(core.read_tvalue(int(tvptr)))
+
+
 def dump_stack_slot(L, slot, base=None, top=None):
     base = base or L.base
     top = top or L.top
@@ -828,30 +720,24 @@ def dump_stack_slot(L, slot, base=None, top=None):
     )
 
 
-def dump_stack(L, base=None, top=None):
+def dump_stack(L, base=None, top=None, window=core.WINDOW):
     base = base or L.base
     top = top or L.top
     stack = mref(TValuePtr, L.stack)
     maxstack = mref(TValuePtr, L.maxstack)
     red = 5 + 2 * LJ_FR2
 
-    dump = [
-        '{padding} Red zone: {nredslots: >2} slots {padding}'.format(
-            padding='-' * len(PADDING),
-            nredslots=red,
-        ),
-    ]
-    dump.extend([
-        dump_stack_slot(L, maxstack + offset, base, top)
-            for offset in range(red, 0, -1)  # noqa: E131
-    ])
-    dump.extend([
-        '{padding} Stack: {nstackslots: >5} slots {padding}'.format(
-            padding='-' * len(PADDING),
-            nstackslots=int((maxstack - stack) >> 3),
-        ),
-        dump_stack_slot(L, maxstack, base, top),
-        '{start}:{end} [    ] {nfreeslots} slots: Free stack slots'.format(
+    # Every slot is yielded as a callable, so it is rendered only if it
+    # falls into the given window (see core.paginate for details).
+    def slot(s):
+        return functools.partial(dump_stack_slot, L, s, base, top)
+
+    def framelink(fr):
+        return functools.partial(dump_framelink, L, fr)
+
+    def freeslots():
+        fmt = '{start}:{end} [    ] {nfreeslots} slots: Free stack slots'
+        return fmt.format(
             start='{address:{padding}}'.format(
                 address=strx64(top + 1),
                 padding=len(PADDING),
@@ -860,20 +746,60 @@ def dump_stack(L, base=None, top=None):
                 address=strx64(maxstack - 1),
                 padding=len(PADDING),
             ),
-            nfreeslots=int((maxstack - top - 8) >> 3),
-        ),
-    ])
+            nfreeslots=int((int(maxstack) - int(top) - 8) >> 3),
+        )
+
+    redzone_header = '{padding} Red zone: {nredslots: >2} slots {padding}'
+    redzone_header = redzone_header.format(
+        padding='-' * len(PADDING),
+        nredslots=red,
+    )
+    stack_header = '{padding} Stack: {nstackslots: >5} slots {padding}'.format(
+        padding='-' * len(PADDING),
+        nstackslots=int((int(maxstack) - int(stack)) >> 3),
+    )
+
+    def from_top():
+        yield redzone_header
+        for offset in range(red, 0, -1):
+            yield slot(maxstack + offset)
+        yield stack_header
+        yield slot(maxstack)
+        yield freeslots
+        for fr, frametop in frames(L):
+            # Dump all data slots in the (framelink, top) interval.
+            for offset in range(frametop - fr, 0, -1):
+                yield slot(fr + offset)
+            # Dump frame slot (2 slots in case of GC64).
+            yield framelink(fr)
+
+    def from_bottom():
+        yield stack_header
+        # Frames are linked from the top to the bottom, so the whole
+        # chain is collected to walk it backwards.
+        for fr, frametop in reversed(list(frames(L))):
+            yield framelink(fr)
+            for offset in range(1, frametop - fr + 1):
+                yield slot(fr + offset)
+        yield freeslots
+        yield slot(maxstack)
+        yield redzone_header
+        for offset in range(1, red + 1):
+            yield slot(maxstack + offset)
+
+    return core.paginate(
+        from_bottom() if window['reverse'] else from_top(), window
+    )
 
-    for framelink, frametop in frames(L):
-        # Dump all data slots in the (framelink, top) interval.
-        dump.extend([
-            dump_stack_slot(L, framelink + offset, base, top)
-                for offset in range(frametop - framelink, 0, -1)  # noqa: E131
-        ])
-        # Dump frame slot (2 slots in case of GC64).
-        dump.append(dump_framelink(L, framelink))
 
-    return '\n'.join(dump)
+def print_lines(lines):
+    # Every line is printed as soon as it is rendered, so the dump of a
+    # huge object can be stopped via Ctrl-C at any moment.
+    try:
+        for line in lines:
+            print(line)
+    except KeyboardInterrupt:
+        print('Interrupted')
 
 
 class LJDumpTValue(Command):
@@ -905,7 +831,7 @@ Whether the type of the given address differs from the listed above, then
 error message occurs.
     '''
     def execute(self, debugger, args, result):
-        tvptr = TValuePtr(cast('TValue *', self.parse(args)))
+        tvptr = TValuePtr(self.parse(args))
         print('{}'.format(dump_tvalue(tvptr)))
 
 
@@ -979,22 +905,16 @@ lj-str <GCstr *>
 
 The command receives a <gcr> of the corresponding GCstr object and dumps
 the payload, size in bytes and hash.
-
-*Caveat*: Since Python 2 provides no native Unicode support, the payload
-is replaced with the corresponding error when decoding fails.
     '''
     def execute(self, debugger, args, result):
-        string_ptr = GCstrPtr(cast('GCstr *', self.parse(args)))
-        print("String: {body} [{len} bytes] with hash {hash}".format(
-            body=strdata(string_ptr),
-            hash=strx64(string_ptr.hash),
-            len=string_ptr.len,
-        ))
+        string_ptr = GCstrPtr(self.parse(args))
+        print(core.dump_string(int(string_ptr)))
 
 
 class LJDumpTable(Command):
     '''
-lj-tab <GCtab *>
+lj-tab [--limit <N>] [--offset <K>] [--from-top|--from-bottom] [--stats]
+       <GCtab *>
 
 The command receives a GCtab address and dumps the table contents:
 * Metatable address whether the one is set
@@ -1002,44 +922,38 @@ The command receives a GCtab address and dumps the table contents:
   <aslot ptr>: [<index>]: <tv>
 * Hash part <hsize> nodes:
   <hnode ptr>: { <tv> } => { <tv> }; next = <next hnode ptr>
+
+The options restrict both array and hash parts independently:
+* --limit <N>: dump at most <N> entries of each part
+* --offset <K>: skip the first <K> entries of each part
+* --from-top: walk each part from the first entry (default)
+* --from-bottom: walk each part from the last entry
+
+If --stats option is given, the summary is dumped instead of the table
+contents:
+* Array part: <asize> slots, <non-nil slots> used (<fill ratio>)
+* Hash part: <hmask + 1> nodes, <non-nil nodes> used (<fill ratio>)
+* Keys outside their main position: <count> (<percentage>)
+* Lookup probes: <average> on average, <maximum> at most
+* Chain length histogram (Node.next chains starting at main positions):
+  <length>: <count> chains
+* Rehash: asize <asize> -> <new asize>, hsize <hsize> -> <new hsize>
+  (<shrinks|grows|keeps size>), i.e. the sizes lj_tab_resize is called
+  with when a non-integer key is inserted into the full hash part
     '''
     def execute(self, debugger, args, result):
-        t = GCtabPtr(cast('GCtab *', self.parse(args)))
-        array = mref(TValuePtr, t.array)
-        nodes = mref(NodePtr, t.node)
-        mt = gcval(t.metatable)
-        capacity = {
-            'apart': int(t.asize),
-            'hpart': int(t.hmask + 1) if t.hmask > 0 else 0
-        }
-
-        if mt:
-            print('Metatable detected: {}'.format(strx64(mt)))
-
-        print('Array part: {} slots'.format(capacity['apart']))
-        for i in range(capacity['apart']):
-            slot = array + i
-            print('{ptr}: [{index}]: {value}'.format(
-                ptr=strx64(slot),
-                index=i,
-                value=dump_tvalue(slot)
-            ))
-
-        print('Hash part: {} nodes'.format(capacity['hpart']))
-        # See hmask comment in lj_obj.h
-        for i in range(capacity['hpart']):
-            node = nodes + i
-            print('{ptr}: {{ {key} }} => {{ {val} }}; next = {n}'.format(
-                ptr=strx64(node),
-                key=dump_tvalue(TValuePtr(node.key.addr)),
-                val=dump_tvalue(TValuePtr(node.val.addr)),
-                n=strx64(mref(NodePtr, node.next))
-            ))
+        expr, window, stats = core.parse_table(args)
+        t = GCtabPtr(self.parse(expr))
+        if stats:
+            print_lines(core.dump_table_stats(core.table_stats(int(t))))
+        else:
+            print_lines(core.dump_table(int(t), window))
 
 
 class LJDumpStack(Command):
     '''
-lj-stack [<lua_State *>]
+lj-stack [--limit <N>] [--offset <K>] [--from-top|--from-bottom]
+         [<lua_State *>]
 
 The command receives a lua_State address and dumps the given Lua
 coroutine guest stack:
@@ -1067,12 +981,577 @@ coroutine guest stack:
     + CP: Protected C frame
     + PP: VM performs a call as a result of executinig pcall or xpcall
 
+The options restrict the dumped slots (section headers are not counted):
+* --limit <N>: dump at most <N> slots
+* --offset <K>: skip the first <K> slots
+* --from-top: walk the stack from L->maxstack to L->stack (default)
+* --from-bottom: walk the stack from L->stack to L->maxstack
+
 If L is omitted the main coroutine is used.
     '''
     def execute(self, debugger, args, result):
-        lstate = self.parse(args)
-        lstate_ptr = cast('lua_State *', lstate) if coro is not None else None
-        print('{}'.format(dump_stack(L(lstate_ptr))))
+        expr, window = core.parse_window(args)
+        print_lines(dump_stack(L(self.parse(expr)), window=window))
+
+
+class LJGCCensus(Command):
+    '''
+lj-gc-census [--stride <N>] [--sites <N>] [--arena]
+
+The command walks all GC objects (gc.root list, string table and
+gc.mmudata ring) and dumps the number of objects and bytes occupied by
+them per type, sorted by the occupied memory:
+* <type>: <count> objects, <bytes> bytes
+  <bucket>: <count> objects, <bytes> bytes
+
+Object sizes are computed the same way the GC releases the objects.
+Tables are split into buckets by array and hash part sizes, strings and
+userdata by payload length, traces by machine code size (the machine
+code is accounted within the trace size).
+
+* --stride <N>: decode only every <N>-th object and scale the results,
+  so the census of a huge heap is estimated much faster
+* --sites <N>: dump <N> allocation sites occupying the most memory;
+  functions, prototypes and traces are accounted by <chunk:line> of the
+  corresponding (or starting) prototype
+* --arena: instead of chasing the object lists (a random access per
+  object), scan the segments of the lj_alloc arena sequentially by large
+  pieces and recognize the GC objects among the chunks in use by the
+  header type and the chunk size. The objects larger than 128 KiB are
+  mmapped directly and missed, as well as the variable-length cdata
+
+The walk can be interrupted via Ctrl-C, then the partial results are
+reported.
+    '''
+    def execute(self, debugger, args, result):
+        _, opts = core.parse_census(args)
+        census = core.gc_census(opts['stride'], opts['sites'] > 0,
+                                opts['arena'])
+        print_lines(core.dump_gc_census(census, opts['stride'],
+                                        opts['sites']))
+
+
+class LJStrtab(Command):
+    '''
+lj-strtab [--chains <N>]
+
+The command walks the string interning table (g->strhash) and dumps:
+* Strings: <strnum> in <buckets> buckets (load factor <strnum/buckets>)
+* Interning: <strhash_hit> hits, <strhash_miss> misses
+* Memory: <bytes occupied by the strings> (<payload bytes>)
+* Chain length histogram:
+  <length>: <count> buckets (<percentage>), <strings in such chains>
+* Longest chains:
+  [<bucket>]: <length> strings: <sample strings>
+
+* --chains <N>: the number of the longest chains to dump (10 by default)
+
+The walk can be interrupted via Ctrl-C, then the partial results are
+reported.
+    '''
+    def execute(self, debugger, args, result):
+        _, opts = core.parse_strtab(args)
+        print_lines(core.dump_strtab(core.strtab_stats(opts['chains'])))
+
+
+class LJTrace(Command):
+    '''
+lj-trace
+
+The command requires no args and walks the trace array (J->trace) to dump
+every compiled trace:
+* TRACE <traceno> (<root|side of <root trace>>) @ <GCtrace address>:
+  start <chunk:line>, link <linked trace> (<link type>),
+  mcode <szmcode> bytes @ <mcode address>,
+  IR <instructions>/<constants>, <nsnap> snapshots/<nsnapmap> entries
+
+and the totals compared with the JIT engine parameters:
+* Traces: <count> (<root traces>, <side traces>) of maxtrace <maxtrace>
+* Memory: <bytes occupied by traces, IR, snapshots and mcode>
+* Machine code: <mcode bytes in traces>, <bytes allocated for mcode
+  areas> of maxmcode <maxmcode> (<percentage>)
+
+Dumping is interrupted via Ctrl-C, then the totals are not reported.
+    '''
+    def execute(self, debugger, args, result):
+        print_lines(core.dump_traces())
+
+
+class LJMCode(Command):
+    '''
+lj-mcode [<address>]
+
+The command resolves the address within the JIT-compiled machine code
+(the PC of the selected frame, if omitted) to the trace it belongs to:
+* <address> is in TRACE <traceno> @ <GCtrace address>:
+  mcode <mcode address> + <offset>, snapshot #<snapno>,
+  pc <snapshot PC>, <chunk:line of snapshot PC>
+
+The snapshot is the one whose exit covers the given address (the same
+way the VM looks it up on the trace exit). The line is known only if
+the snapshot PC belongs to the starting prototype of the trace.
+
+The lookup is the binary search in the index of all traces and mcode
+areas. The index is built once until the inferior is resumed.
+    '''
+    def execute(self, debugger, args, result):
+        process = target.GetProcess()
+        pc = vtou64(self.parse(args)) if args else \
+            process.GetSelectedThread().GetSelectedFrame().GetPC()
+        print(core.dump_mcode(pc, stop_generation()))
+
+
+class LJBacktrace(Command):
+    '''
+lj-bt
+
+The command prints the backtrace of the selected thread with the guest
+(Lua) frames put into the native one:
+* frame #<n>: <pc> <native function>[ at <file:line>]
+* frame #<n>: [Lua] <function>[, <file:current line>]
+
+The guest frames of every VM entry precede the frame of the assembler
+VM (lj_vm_*, lj_BC_*, etc.) running them. The frames are taken from the
+running coroutine, then from the main one. The current line is decoded
+from the line info of the prototype, which is fetched once until the
+inferior is resumed. The frames executing the JIT-compiled machine code
+are named after the trace.
+    '''
+    def execute(self, debugger, args, result):
+        process = target.GetProcess()
+        generation = stop_generation()
+        thread = process.GetSelectedThread()
+        print_lines(self.backtrace(thread, generation))
+
+    def backtrace(self, thread, generation):
+        frames = core.mixed_backtrace(
+            (thread.GetFrameAtIndex(i) for i in range(thread.GetNumFrames())),
+            lambda frame: frame.GetFunctionName(),
+            generation,
+        )
+        for n, (frame, entry) in enumerate(frames):
+            if entry is not None:
+                yield 'frame #{}: [Lua] {}'.format(
+                    n, core.guest_location(entry)
+                )
+                continue
+            name = frame.GetFunctionName()
+            if name is None:
+                found = core.mcode_lookup(frame.GetPC(), generation)
+                if found is not None and 'traceno' in found:
+                    name = core.mcode_location(found)
+            line = frame.GetLineEntry()
+            yield 'frame #{n}: {pc} {name}{at}'.format(
+                n=n,
+                pc=core.strx64(frame.GetPC()),
+                name=name or '??',
+                at=' at {}:{}'.format(line.GetFileSpec().GetFilename(),
+                                      line.GetLine())
+                if line.IsValid() else '',
+            )
+
+
+class LJThreads(Command):
+    '''
+lj-threads [--top <N>] [--by-stacksize|--by-used|--by-depth]
+
+The command walks the gc.root list once and summarizes every coroutine
+(LJ_TTHREAD object) found there, the main one included:
+* <lua_State *> (<status>): stack <used>/<stacksize> slots,
+  <depth> frames, top <top Lua function frame, chunk:current line>
+
+and the totals:
+* Coroutines: <count> (<count per status>)
+* Stacks: <slots allocated>, <slots used>
+
+The status is the one coroutine.status reports. The current line of the
+top Lua frame is unknown for the running coroutine, since the interpreter
+keeps the PC in the register.
+
+* --top <N>: the number of the coroutines to dump (20 by default)
+* --by-stacksize, --by-used, --by-depth: dump the coroutines with the
+  largest stack size (default), used stack slots or number of frames
+
+The walk can be interrupted via Ctrl-C, then the partial results are
+reported.
+    '''
+    def execute(self, debugger, args, result):
+        _, opts = core.parse_threads(args)
+        generation = stop_generation()
+        print_lines(core.dump_threads(generation=generation, **opts))
+
+
+class LJHeapdump(Command):
+    '''
+lj-heapdump <file>
+
+The command walks all GC objects (gc.root list, string table and
+gc.mmudata ring) once and writes the heap snapshot to the given file:
+every object address, type, size and label (the same lj-gc-census
+reports: the allocation site or the bucket, e.g. the table shape) and
+outgoing references to the other objects:
+* tables: metatable, keys and values (weak ones are marked)
+* functions: environment, prototype and upvalues
+* upvalues: value
+* prototypes: chunk name and GC constants
+* coroutines: environment and stack slots
+* userdata: environment and metatable
+* traces: starting prototype
+
+The GC roots (main coroutine, registry, metamethod names, etc.) are
+written as well. The snapshot is written while walking, and it is read
+offline without the debugger via luajit_heapdump.py located next to
+this extension (see the module for the format):
+$ python3 luajit_heapdump.py <file>
+
+The walk can be interrupted via Ctrl-C, then the partial snapshot is
+written.
+    '''
+    def execute(self, debugger, args, result):
+        if not args:
+            raise ValueError('lj-heapdump expects a file name')
+        print_lines(core.dump_heap_snapshot(os.path.expanduser(args)))
+
+
+class LJRetainers(Command):
+    '''
+lj-retainers [--paths <N>] [--depth <N>] <GCobj *>
+
+The command finds the shortest reference paths from the GC roots (main
+coroutine, registry, metamethod names, etc.) to the given GC object and
+reports up to --paths of them (3 by default); every path starts at the
+root and lists the kinds of the references (key, value, metatable,
+upvalue, stack slot, etc.) down to the object. The paths longer than
+--depth references are not searched.
+
+The reverse reference index of the heap is built on the first query
+(all GC objects are walked once, the same way as lj-heapdump does) and
+reused by the next ones until the inferior is resumed. The weak
+references of the weak tables are not followed, since they do not keep
+the object alive. The same search is done offline for the snapshot
+written by lj-heapdump:
+$ python3 luajit_heapdump.py <file> --retainers <address>
+
+The walk can be interrupted via Ctrl-C, then no index is built.
+    '''
+    def execute(self, debugger, args, result):
+        expr, opts = core.parse_retainers(args)
+        if not expr:
+            raise ValueError('lj-retainers expects a GC object address')
+        generation = stop_generation()
+        print_lines(core.dump_retainers(
+            vtou64(self.parse(expr)), generation=generation, **opts
+        ))
+
+
+class LJHeapdiff(Command):
+    '''
+lj-heapdiff [--top <N>] <old file> [<new file>]
+
+The command compares two heap snapshots written by lj-heapdump (e.g.
+the ones taken from the cores dumped before and after the load test) or
+the snapshot with the current heap, if the second file is omitted (e.g.
+the snapshot taken at one stop with the heap at the later one):
+* the number of objects and bytes per type
+* --top (10 by default) allocation sites (<chunkname>:<firstline> of
+  the functions, prototypes and traces) grown the most
+* --top table shapes (lj-gc-census buckets of the array and hash part
+  sizes) grown the most
+
+The objects are matched by the type, the label (the site or the shape)
+and the size rather than by the address, so the heaps of the different
+processes are compared as well; the objects that are not matched are
+reported as allocated or freed. The objects are counted in the sorted
+runs spilled to the temporary files and merged, so the heaps are never
+kept in memory. The same comparison is done offline:
+$ python3 luajit_heapdump.py <new file> --diff <old file>
+
+The walk can be interrupted via Ctrl-C, then nothing is compared.
+    '''
+    def execute(self, debugger, args, result):
+        expr, opts = core.parse_heapdiff(args)
+        files = [os.path.expanduser(path) for path in expr.split()]
+        if len(files) not in (1, 2):
+            raise ValueError('lj-heapdiff expects one or two file names')
+        print_lines(core.dump_heap_diff(*files, **opts))
+
+
+class LJBytecode(Command):
+    '''
+lj-bc <GCproto *|GCfunc *>
+
+The command disassembles the bytecode of the given prototype (or the
+prototype of the given Lua function) in the style of jit.bc:
+* -- BYTECODE -- <chunk>:<firstline>-<lastline> @ <GCproto address>
+* <pos> [=>] <opcode> <operands> [; <constant, upvalue or child>]
+
+The branch targets are marked with =>, and the instructions the frames
+of the running coroutine execute (i.e. the frame PCs) are marked with
+->. The bytecode, constants and debug info are fetched by a single read
+of the whole prototype; the decoded prototypes are cached until the
+inferior is resumed, so the frames of the same function are dumped
+without reading the memory again.
+    '''
+    def execute(self, debugger, args, result):
+        if not args:
+            raise ValueError('lj-bc expects a GCproto or GCfunc address')
+        generation = stop_generation()
+        print_lines(core.dump_bc(vtou64(self.parse(args)),
+                                 generation=generation))
+
+
+class LJJitPenalty(Command):
+    '''
+lj-jit-penalty [--top <N>]
+
+The command reports the locations the JIT compiler gave up on or keeps
+aborting on, so the cause of the interpreter-only slow path is found
+from a single core:
+* Penalty cache: <used> of <capacity> slots used
+* Blacklisted: <count> instructions, JIT disabled: <count> instructions
+* --top (20 by default) locations ranked by the lost compilation:
+  <chunk:line> (<opcode> @ <PC>): <state>[, last abort: <reason>]
+
+The blacklisted instructions (the loops and function headers patched to
+ILOOP, IFUNCF, etc. after too many aborts) and the ones of the functions
+with JIT disabled via jit.off() are never compiled again, so they go
+first. They are followed by the J->penalty slots ranked by the penalty
+value, which is doubled on every abort and delays the next attempt by
+that number of hot counter ticks. The abort reason is the last one kept
+in the penalty slot; the arguments of the message are not kept.
+
+The prototypes are walked once to find the patched instructions and to
+resolve the PCs. The walk can be interrupted via Ctrl-C, then the
+results are partial.
+    '''
+    def execute(self, debugger, args, result):
+        _, opts = core.parse_penalties(args)
+        generation = stop_generation()
+        print_lines(core.dump_jit_penalties(generation=generation, **opts))
+
+
+class LJAlloc(Command):
+    '''
+lj-alloc
+
+The command requires no args and dumps the state of the lj_alloc
+allocator, so it is seen whether the memory is occupied by the live data
+or wasted by the allocator:
+* lj_alloc state: <address of malloc_state>
+* Segments: <number> segments, <bytes> bytes, then every segment
+* In use: <number> chunks, <bytes> bytes
+* Top chunk: <bytes> (the free space at the end of the segment)
+* Designated victim: <bytes> (the remainder of the last split chunk)
+* Small bins and Tree bins: the free chunks per bin size (range)
+* Direct mmapped (estimated): <bytes> of gc.total not found within the
+  segments; the chunks larger than 128 KiB are mmapped directly and
+  are not linked anywhere, so only the estimate is known
+* GC total: <gc.total>
+* Fragmentation: <free bytes in the top chunk, the designated victim
+  and the bins>, <percentage of gc.total>
+
+The segments are walked sequentially chunk by chunk. The walk can be
+interrupted via Ctrl-C, then the results are partial. Nothing is
+reported if LuaJIT uses the system allocator (LUAJIT_USE_SYSMALLOC).
+    '''
+    def execute(self, debugger, args, result):
+        print_lines(core.dump_alloc())
+
+
+class LJProfbuf(Command):
+    '''
+lj-profbuf [<prefix>]
+
+The command reports the state of the memory (memprof) and the sampling
+(sysprof) profilers, so the profile events not yet flushed by the
+writer are not lost if the process crashes while profiling:
+* <profiler>: <idle|profiling|halted>
+* mode: <default|leaf|callgraph>, interval: <sampling interval> ms
+  (sysprof only)
+* samples: <total> (<number of samples per VM state>) (sysprof only)
+* stream: <ok|stopped|I/O error>, <N> of <size> buffer bytes
+  unflushed @ <buffer address>
+
+If <prefix> is given, the unflushed bytes of every profiler are written
+to the <prefix>.memprof.bin and <prefix>.sysprof.bin files with the
+epilogue appended, so they are parsed by tools/memprof.lua and
+tools/sysprof.lua. If nothing has been flushed yet, the file is the
+whole profile, otherwise it is the tail of the profile to be appended to
+the part the writer has already flushed (e.g. to the profile file).
+    '''
+    def execute(self, debugger, args, result):
+        prefix = os.path.expanduser(args.strip()) if args.strip() else None
+        print_lines(core.dump_profilers(prefix))
+
+
+class LJMetrics(Command):
+    '''
+lj-metrics [--json]
+
+The command dumps the same metrics misc.getmetrics() reports (see
+luam_Metrics in lmisclib.h) computed from global_State and jit_State, so
+the values from a core line up with the time series collected from the
+live process:
+* strhash_hit, strhash_miss: <string interning hits and misses>
+* gc_strnum, gc_tabnum, gc_udatanum, gc_cdatanum: <number of objects>
+* gc_total, gc_freed, gc_allocated: <bytes allocated now, freed and
+  allocated in total>
+* gc_steps_<state>: <number of incremental GC steps per GC state>
+* jit_snap_restore, jit_trace_abort, jit_mcode_size, jit_trace_num:
+  <JIT counters>
+
+With --json, the metrics are dumped as a single JSON object line.
+    '''
+    def execute(self, debugger, args, result):
+        _, opts = core.parse_metrics(args)
+        print_lines(core.dump_metrics(opts['json']))
+
+
+class LJWatch(Command):
+    '''
+lj-watch [--count <N>] <interval> <file>
+
+The command samples the GC and JIT state of the live process every
+<interval> milliseconds, up to --count samples (until interrupted via
+Ctrl-C or until the process stops for another reason by default), and
+writes the time series to the given file: JSON lines if the file name
+ends with .json, CSV otherwise. Every sample has the following fields:
+* time: <UNIX time of the sample>
+* total: <total number of allocated bytes in GC area>
+* debt: <how much GC is behind schedule>
+* gcstate: <GC state>
+* vmstate: <VM state>
+* strnum: <number of strings in the string table>
+* tracenum: <overall number of traces> (with JIT only)
+
+The process is interrupted at every interval and resumed right after
+the sample is taken: the offsets of the fields are computed once, so
+every sample is a single memory read. The time from the interrupt to
+the resume per sample is reported when the watching is over (the cost
+of the resume itself is not measured), and the process is left stopped.
+    '''
+    def execute(self, debugger, args, result):
+        _, opts = core.parse_watch(args)
+        process = target.GetProcess()
+        if not process.IsValid() or 'core' in process.GetPluginName():
+            raise ValueError('lj-watch requires a live process')
+        # The process is resumed synchronously, so the sample is taken
+        # right after it is interrupted.
+        async_mode = debugger.GetAsync()
+        debugger.SetAsync(False)
+        try:
+            print_lines(core.dump_watch(resume=watch_resume, **opts))
+        finally:
+            debugger.SetAsync(async_mode)
+
+
+def valaddr(valobj):
+    # Address of the object the value (or the pointer value) refers to.
+    if valobj.GetType().IsPointerType():
+        return valobj.GetValueAsUnsigned()
+    return valobj.GetLoadAddress()
+
+
+def formatter(summary):
+    # The formatters are used by the IDE variable views for every value
+    # of the given type, the uninitialized ones included, so the errors
+    # are not reported and the value is just left without the summary.
+    @functools.wraps(summary)
+    def wrapper(valobj, internal_dict):
+        try:
+            address = valaddr(valobj)
+            return summary(address) if address else None
+        except Exception:
+            return None
+    return wrapper
+
+
+@formatter
+def tvalue_summary(address):
+    return core.dump_tvalue(core.read_tvalue(address))
+
+
+@formatter
+def gcstr_summary(address):
+    return core.dump_gcstr(address)
+
+
+@formatter
+def gctab_summary(address):
+    return core.dump_gctab(address)
+
+
+class TableChildren(object):
+    # Synthetic children of GCtab: the array slots followed by the hash
+    # nodes in use. The children are fetched page by page only when requested,
+    # so the IDE variable view fetches the visible range only.
+    def __init__(self, valobj, internal_dict):
+        self.valobj = valobj
+        self.update()
+
+    def update(self):
+        # The children are fetched again after every stop.
+        self.address = valaddr(self.valobj)
+        self.capacity = None
+        self.pages = {}
+        return False
+
+    def has_children(self):
+        return True
+
+    def table_capacity(self):
+        if self.capacity is None:
+            try:
+                self.capacity = core.table_capacity(self.address)
+            except Exception:
+                self.capacity = (0, [])
+        return self.capacity
+
+    def num_children(self):
+        asize, used = self.table_capacity()
+        return asize + len(used)
+
+    def get_child_index(self, name):
+        # Only the array slots are looked up by name without fetching:
+        # the keys of the hash part are never resolved by name.
+        m = re.match(r'^\[(0|[1-9]\d*)\]$', name)
+        if m is None or int(m.group(1)) >= self.table_capacity()[0]:
+            return -1
+        return int(m.group(1))
+
+    def get_child_at_index(self, index):
+        page, i = divmod(index, core.CHILDREN_PAGE)
+        if page not in self.pages:
+            self.pages[page] = list(core.table_entries(
+                self.address, page * core.CHILDREN_PAGE, core.CHILDREN_PAGE,
+                self.table_capacity()
+            ))
+        if i >= len(self.pages[page]):
+            return None
+        key, slot, _ = self.pages[page][i]
+        return self.valobj.CreateValueFromAddress(
+            core.dump_key(key), slot, find_type('TValue')
+        )
+
+
+def register_formatters(debugger):
+    # Both the objects and the pointers to them are formatted. The
+    # formatters are put into the separate category, so they can be
+    # turned off with `type category disable luajit`.
+    for typename, summary in (
+        ('TValue', tvalue_summary),
+        ('GCstr', gcstr_summary),
+        ('GCtab', gctab_summary),
+    ):
+        debugger.HandleCommand(
+            'type summary add -w luajit -F luajit_lldb.{} {}'.format(
+                summary.__name__, typename
+            )
+        )
+    debugger.HandleCommand(
+        'type synthetic add -w luajit -l luajit_lldb.TableChildren GCtab'
+    )
+    debugger.HandleCommand('type category enable luajit')
 
 
 def register_commands(debugger, commands):
@@ -1089,36 +1568,80 @@ def register_commands(debugger, commands):
 
 
 def configure(debugger):
-    global LJ_64, LJ_GC64, LJ_FR2, LJ_DUALNUM, PADDING, LJ_TISNUM, target
+    global LJ_64, LJ_GC64, LJ_FR2, LJ_DUALNUM, PADDING, target
     target = debugger.GetSelectedTarget()
     module = target.modules[0]
-    LJ_DUALNUM = module.FindSymbol('lj_lib_checknumber') is not None
+
+    # The flags (as well as the type layout) are cached on disk, so the
+    # debug info lookups are skipped for the already known build.
+    build_id = objfile_build_id()
+    flags = core.cached_flags(build_id)
 
     try:
-        irtype_enum = target.FindFirstType('IRType').enum_members
-        for member in irtype_enum:
-            if member.name == 'IRT_PTR':
-                LJ_64 = member.unsigned & 0x1f == IRT_P64
-            if member.name == 'IRT_PGC':
-                LJ_FR2 = LJ_GC64 = member.unsigned & 0x1f == IRT_P64
+        if flags is None:
+            flags = {
+                'lj_dualnum':
+                    module.FindSymbol('lj_lib_checknumber').IsValid(),
+                'little_endian':
+                    target.GetByteOrder() == lldb.eByteOrderLittle,
+                'x86orx64':
+                    re.match(r'^(x86_64|i[3-6]86)', target.GetTriple())
+                    is not None,
+            }
+            irtype_enum = target.FindFirstType('IRType').enum_members
+            for member in irtype_enum:
+                if member.name == 'IRT_PTR':
+                    flags['lj_64'] = member.unsigned & 0x1f == IRT_P64
+                if member.name == 'IRT_PGC':
+                    flags['lj_gc64'] = member.unsigned & 0x1f == IRT_P64
+        LJ_64 = flags['lj_64']
+        LJ_FR2 = LJ_GC64 = flags['lj_gc64']
+        LJ_DUALNUM = flags['lj_dualnum']
     except Exception:
         print('luajit_lldb.py failed to load: '
               'no debugging symbols found for libluajit')
         return
 
-    PADDING = ' ' * len(strx64((TValuePtr(L().addr))))
-    LJ_TISNUM = 0xfffeffff if LJ_64 and not LJ_GC64 else LJ_T['NUMX']
+    core.configure(
+        read_memory=read_memory,
+        sizeof=sizeof,
+        fieldof=fieldof,
+        global_state=global_state,
+        static_address=static_address,
+        build_id=build_id,
+        **flags
+    )
+
+    PADDING = ' ' * len(strx64(L().addr))
 
 
 def __lldb_init_module(debugger, internal_dict):
     configure(debugger)
     register_commands(debugger, {
-        'lj-tv':    LJDumpTValue,
-        'lj-state': LJState,
-        'lj-arch':  LJDumpArch,
-        'lj-gc':    LJGC,
-        'lj-str':   LJDumpString,
-        'lj-tab':   LJDumpTable,
-        'lj-stack': LJDumpStack,
+        'lj-tv':        LJDumpTValue,
+        'lj-state':     LJState,
+        'lj-arch':      LJDumpArch,
+        'lj-gc':        LJGC,
+        'lj-gc-census': LJGCCensus,
+        'lj-str':       LJDumpString,
+        'lj-tab':       LJDumpTable,
+        'lj-stack':     LJDumpStack,
+        'lj-strtab':    LJStrtab,
+        'lj-trace':     LJTrace,
+        'lj-mcode':     LJMCode,
+        'lj-bt':        LJBacktrace,
+        'lj-threads':   LJThreads,
+        'lj-heapdump':  LJHeapdump,
+        'lj-retainers': LJRetainers,
+        'lj-heapdiff':  LJHeapdiff,
+        'lj-bc':        LJBytecode,
+        'lj-jit-penalty': LJJitPenalty,
+        'lj-alloc':     LJAlloc,
+        'lj-profbuf':   LJProfbuf,
+        'lj-metrics':   LJMetrics,
+        'lj-watch':     LJWatch,
     })
+    register_formatters(debugger)
+    # The formatters may miss the layout outside of the commands.
+    atexit.register(core.save_cache)
     print('luajit_lldb.py is successfully loaded')
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# Benchmark for the LuaJIT debugger extensions (luajit-gdb.py and
+# luajit_lldb.py) against the synthetic cores.
+#
+# Every workload from the workloads/ directory is run with the given
+# scales and the core of the process is dumped via gcore. Then every
+# command of the workload is run against the core in the batch mode of
+# each available debugger, and the wall time and the peak RSS of the
+# debugger process are recorded. The 'load' row is the session that
+# only loads the extension, so the cost of the command itself is the
+# difference with it.
+#
+# Usage: bench.py --luajit <path> [--gdb <path>] [--lldb <path>]
+#                 [--gcore <path>] [--scales <N,M,...>]
+#                 [--workloads <name,...>] [--repeat <N>]
+#                 [--workdir <dir>] [--save <file>]
+#                 [--compare <file>] [--threshold <percent>]
+#
+# The results are saved to the JSON <file> with --save option and the
+# results saved before are compared with the current ones with
+# --compare option: the runs slower by more than --threshold percent
+# (10 by default) are reported and the script exits with the non-zero
+# status.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKLOADS_DIR = os.path.join(BENCH_DIR, 'workloads')
+EXTENSIONS_DIR = os.path.normpath(os.path.join(BENCH_DIR, '..', '..', 'src'))
+
+# Commands to be measured for every workload. The expressions reported
+# by the workload are substituted by the names in braces.
+WORKLOADS = {
+    'table': [
+        'lj-tab {t}',
+        'lj-tab --stats {t}',
+        'lj-tab --limit 100 {t}',
+    ],
+    'stack': [
+        'lj-stack',
+        'lj-stack --limit 100',
+    ],
+    'coroutines': [
+        'lj-stack {L}',
+        'lj-gc',
+        'lj-gc-census',
+        'lj-gc-census --arena',
+        'lj-alloc',
+        'lj-threads',
+    ],
+    'strings': [
+        'lj-str {s}',
+        'lj-strtab',
+        'lj-gc',
+    ],
+}
+
+# The session without any command.
+LOAD = 'load'
+
+
+def gdb_argv(debugger, luajit, core, command):
+    argv = [
+        debugger, '-batch', '-nx',
+        '-ex', 'source {}'.format(
+            os.path.join(EXTENSIONS_DIR, 'luajit-gdb.py')
+        ),
+    ]
+    if command != LOAD:
+        argv += ['-ex', command]
+    return argv + [luajit, core]
+
+
+def lldb_argv(debugger, luajit, core, command):
+    argv = [
+        debugger, '--batch', '--no-lldbinit',
+        '--core', core,
+        '-o', 'command script import {}'.format(
+            os.path.join(EXTENSIONS_DIR, 'luajit_lldb.py')
+        ),
+    ]
+    if command != LOAD:
+        argv += ['-o', command]
+    return argv + [luajit]
+
+
+DEBUGGERS = {
+    'gdb':  gdb_argv,
+    'lldb': lldb_argv,
+}
+
+
+def dump_core(args, workload, scale):
+    # Run the workload until it is ready and dump the core of it.
+    env = dict(os.environ, LUA_PATH='{}/?.lua;;'.format(WORKLOADS_DIR))
+    script = os.path.join(WORKLOADS_DIR, workload + '.lua')
+    proc = subprocess.Popen([args.luajit, script, str(scale)], env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    exprs = {}
+    try:
+        for line in proc.stdout:
+            line = line.rstrip('\n')
+            if line == 'ready':
+                break
+            name, _, expr = line.partition('=')
+            exprs[name] = expr
+        else:
+            raise RuntimeError('workload {} exited unexpectedly'.format(
+                workload
+            ))
+        prefix = os.path.join(args.workdir, '{}-{}'.format(workload, scale))
+        subprocess.check_call([args.gcore, '-o', prefix, str(proc.pid)],
+                              stdout=subprocess.DEVNULL)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+    return '{}.{}'.format(prefix, proc.pid), exprs
+
+
+def measure(argv):
+    # Return the wall time (in seconds) and the peak RSS (in KiB) of the
+    # given process. The output is dropped, so its rendering is
+    # measured, but not the terminal one.
+    with tempfile.TemporaryFile() as stderr:
+        start = time.time()
+        proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL, stderr=stderr)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.time() - start
+        # The process is already reaped by os.wait4 above.
+        proc.returncode = status
+        stderr.seek(0)
+        output = stderr.read().decode(errors='replace')
+    # The debuggers report the failed commands to stderr, but do not
+    # always exit with the non-zero status in the batch mode.
+    errors = [line for line in output.splitlines()
+              if line.lower().startswith(('error', 'python exception'))]
+    if status != 0 or errors:
+        raise RuntimeError('`{}` failed: {}'.format(
+            ' '.join(argv), '\n'.join(errors) or output.strip()
+        ))
+    return wall, rusage.ru_maxrss
+
+
+def run(args):
+    results = []
+    for workload in args.workloads:
+        for scale in args.scales:
+            core, exprs = dump_core(args, workload, scale)
+            core_size = os.path.getsize(core)
+            for name, debugger in args.debuggers.items():
+                for template in [LOAD] + WORKLOADS[workload]:
+                    argv = DEBUGGERS[name](debugger, args.luajit, core,
+                                           template.format(**exprs))
+                    samples = [measure(argv) for _ in range(args.repeat)]
+                    result = {
+                        'debugger': name,
+                        'workload': workload,
+                        'scale': scale,
+                        'core': core_size,
+                        # The addresses differ from run to run, so the
+                        # command template identifies the result.
+                        'command': template,
+                        'wall': min(s[0] for s in samples),
+                        'rss': max(s[1] for s in samples),
+                    }
+                    report(result)
+                    results.append(result)
+            os.unlink(core)
+    return results
+
+
+def report(result):
+    fmt = '{debugger:5} {workload:11} {scale:>8} {core:>12} ' \
+          '{command:32} {wall:>9.3f}s {rss:>9} KiB'
+    sys.stdout.write(fmt.format(**result) + '\n')
+    sys.stdout.flush()
+
+
+def key(result):
+    return (result['debugger'], result['workload'], result['scale'],
+            result['command'])
+
+
+def compare(results, baseline, threshold):
+    # Report the runs slower than the baseline ones by more than the
+    # given percentage. Return the number of such runs.
+    previous = dict((key(r), r) for r in baseline)
+    regressions = 0
+    for result in results:
+        old = previous.get(key(result))
+        if old is None or old['wall'] == 0:
+            continue
+        ratio = result['wall'] / old['wall']
+        if ratio > 1 + threshold / 100.0:
+            regressions += 1
+            fmt = 'REGRESSION: {} {} {} `{}`: {:.3f}s -> {:.3f}s ' \
+                  '(x{:.2f}), {} KiB -> {} KiB\n'
+            sys.stdout.write(fmt.format(
+                result['debugger'], result['workload'], result['scale'],
+                result['command'], old['wall'], result['wall'], ratio,
+                old['rss'], result['rss'],
+            ))
+    return regressions
+
+
+def csv(value):
+    return [v for v in value.split(',') if v]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark LuaJIT debugger extensions',
+    )
+    parser.add_argument('--luajit', required=True,
+                        help='LuaJIT binary with debug info')
+    parser.add_argument('--gdb', help='gdb binary')
+    parser.add_argument('--lldb', help='lldb binary')
+    parser.add_argument('--gcore', default='gcore', help='gcore binary')
+    parser.add_argument('--scales', type=lambda v: list(map(int, csv(v))),
+                        default=[1000, 100000],
+                        help='comma-separated workload sizes')
+    parser.add_argument('--workloads', type=csv,
+                        default=sorted(WORKLOADS.keys()),
+                        help='comma-separated workloads to run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of every command')
+    parser.add_argument('--workdir', default=tempfile.gettempdir(),
+                        help='directory to dump the cores to')
+    parser.add_argument('--save', help='file to save the results to')
+    parser.add_argument('--compare',
+                        help='file with the results to compare with')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='slowdown (in percent) to be reported')
+    args = parser.parse_args()
+
+    unknown = set(args.workloads) - set(WORKLOADS.keys())
+    if unknown:
+        parser.error('unknown workloads: {}'.format(', '.join(unknown)))
+    args.debuggers = dict((name, getattr(args, name))
+                          for name in DEBUGGERS if getattr(args, name))
+    if not args.debuggers:
+        parser.error('at least one of --gdb and --lldb is required')
+    if args.repeat < 1:
+        parser.error('--repeat must be positive')
+    return args
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+-- Helpers shared by the workloads of the debugger extensions
+-- benchmark. Every workload reports the debugger expressions for
+-- the objects to be dumped as <name>=<expression> lines, then
+-- reports readiness and waits until the core is dumped.
+
+local ffi = require('ffi')
+
+local M = {}
+
+-- Size of the workload given by the benchmark runner.
+M.scale = tonumber(arg[1]) or 1000
+
+local function address(obj)
+  return tostring(obj):match('0x%x+')
+end
+
+function M.report(name, expr)
+  io.write(('%s=%s\n'):format(name, expr))
+end
+
+function M.table(name, t)
+  M.report(name, ('(GCtab *)%s'):format(address(t)))
+end
+
+function M.thread(name, L)
+  M.report(name, ('(lua_State *)%s'):format(address(L)))
+end
+
+function M.string(name, s)
+  -- The payload follows the GCstr header.
+  local payload = address(ffi.cast('const char *', s))
+  M.report(name, ('(GCstr *)%s - 1'):format(payload))
+end
+
+function M.wait()
+  io.write('ready\n')
+  io.flush()
+  -- The runner closes stdin as soon as the core is dumped.
+  io.read('*a')
+end
+
+return M
@@ -0,0 +1,19 @@
+-- Lots of coroutines suspended within a few nested calls.
+local common = require('common')
+
+local function nested(depth)
+  if depth == 0 then
+    return coroutine.yield()
+  end
+  local res = nested(depth - 1)
+  return res
+end
+
+local coros = {}
+for i = 1, common.scale do
+  coros[i] = coroutine.create(nested)
+  coroutine.resume(coros[i], 8)
+end
+
+common.thread('L', coros[#coros])
+common.wait()
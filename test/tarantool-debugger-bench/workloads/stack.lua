@@ -0,0 +1,19 @@
+-- Deep guest stack of Lua frames with a few locals each.
+local common = require('common')
+
+-- XXX: The depth is limited, since the guest stack size is
+-- limited by LUAI_MAXSTACK slots.
+local MAXDEPTH = 8000
+
+local function descend(depth)
+  if depth == 0 then
+    common.wait()
+    return depth
+  end
+  local a, b = depth, tostring(depth)
+  -- Avoid tail call, so every level keeps its frame.
+  local res = descend(depth - 1)
+  return res, a, b
+end
+
+descend(math.min(common.scale, MAXDEPTH))
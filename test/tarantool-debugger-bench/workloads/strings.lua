@@ -0,0 +1,10 @@
+-- Lots of interned strings of various lengths.
+local common = require('common')
+
+local strings = {}
+for i = 1, common.scale do
+  strings[i] = ('%d'):format(i):rep(i % 16 + 1)
+end
+
+common.string('s', strings[#strings])
+common.wait()
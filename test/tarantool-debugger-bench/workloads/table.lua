@@ -0,0 +1,11 @@
+-- Huge table with both array and hash parts populated.
+local common = require('common')
+
+local t = {}
+for i = 1, common.scale do
+  t[i] = i
+  t['key' .. i] = i + 0.5
+end
+
+common.table('t', t)
+common.wait()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Test for the heap snapshot diff of luajit_heapdump.py: the objects
+# counted per signature in the sorted runs spilled to the temporary
+# files are merged to the same counts as the ones kept in memory.
+#
+# Usage: heapdump-diff.test.py
+
+import collections
+import io
+import os
+import sys
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(TEST_DIR, '..', '..', 'src')))
+
+import luajit_heapdump as heapdump  # noqa: E402
+
+GCT = dict((name, gct) for gct, name in heapdump.TYPES.items())
+
+ROOTS = ('roots', 0, 0, [('root', 0x1000)], None)
+
+
+def heap(objects):
+    # The records of the heap walk with the objects given as (type,
+    # size, label) tuples.
+    records = [ROOTS]
+    for i, (otype, size, label) in enumerate(objects):
+        records.append((otype, 0x1000 + 0x100 * i, size, [], label))
+    return records
+
+
+OLD = heap([
+    ('LJ_TSTR', 24, None),
+    ('LJ_TSTR', 24, None),
+    ('LJ_TSTR', 32, None),
+    ('LJ_TTAB', 56, 'array 0, hash 4'),
+    ('LJ_TTAB', 56, 'array 0, hash 4'),
+    ('LJ_TFUNC', 40, '@a.lua:1'),
+    ('LJ_TFUNC', 40, 'C function @ 0x5555d000'),
+    ('LJ_TUDATA', 64, None),
+])
+
+NEW = heap([
+    ('LJ_TSTR', 24, None),
+    ('LJ_TSTR', 40, None),
+    ('LJ_TTAB', 56, 'array 0, hash 4'),
+    ('LJ_TTAB', 56, 'array 0, hash 4'),
+    ('LJ_TTAB', 56, 'array 0, hash 4'),
+    ('LJ_TTAB', 120, 'array 8, hash 0'),
+    ('LJ_TFUNC', 40, '@a.lua:1'),
+    ('LJ_TFUNC', 40, '@a.lua:1'),
+    ('LJ_TFUNC', 40, 'C function @ 0x7f00d000'),
+    ('LJ_TFUNC', 40, '@b.lua:10'),
+])
+
+
+def expected(records):
+    counts = collections.Counter(
+        (otype, heapdump.comparable(label), size)
+        for otype, _, size, _, label in records if otype != 'roots'
+    )
+    return sorted(counts.items())
+
+
+def snapshot(records):
+    f = io.BytesIO()
+    writer = heapdump.Writer(f, gc64=True)
+    for otype, addr, size, refs, label in records:
+        writer.record(heapdump.ROOTS if otype == 'roots' else GCT[otype],
+                      addr, size, refs, label)
+    writer.close()
+    f.seek(0)
+    return heapdump.Reader(f)
+
+
+class TestHeapdumpDiff(unittest.TestCase):
+    def test_signatures(self):
+        # Every run is spilled with the single signature in memory.
+        for run_size in (1, 2, 3, heapdump.RUN_SIZE):
+            for records in (OLD, NEW):
+                self.assertEqual(
+                    list(heapdump.signatures(iter(records), run_size)),
+                    expected(records), 'run_size {}'.format(run_size)
+                )
+
+    def test_merge(self):
+        merged = list(heapdump.merge(
+            heapdump.signatures(iter(OLD), 2),
+            heapdump.signatures(iter(NEW), 2),
+        ))
+        old = dict(expected(OLD))
+        new = dict(expected(NEW))
+        self.assertEqual(merged, [
+            (signature, old.get(signature, 0), new.get(signature, 0))
+            for signature in sorted(set(old) | set(new))
+        ])
+
+    def test_diff(self):
+        report = list(heapdump.diff(snapshot(OLD), snapshot(NEW), top=3,
+                                    run_size=2))
+        inmemory = heapdump.diff(iter(OLD), iter(NEW), top=3)
+        self.assertEqual(report, list(inmemory))
+        self.assertEqual(report[:2], [
+            'Total: 8 -> 10 objects, 336 -> 512 bytes (+176)',
+            'Matched: 5 objects, allocated: 5 objects, freed: 3 objects',
+        ])
+        self.assertIn('\t@a.lua:1: 1 -> 2 objects (+1), 40 -> 80 bytes '
+                      '(+40)', report)
+        self.assertIn('\t@b.lua:10: 0 -> 1 objects (+1), 0 -> 40 bytes '
+                      '(+40)', report)
+        # The C functions are matched regardless of their addresses.
+        self.assertFalse(any('C function' in line for line in report))
+
+
+if __name__ == '__main__':
+    unittest.main()
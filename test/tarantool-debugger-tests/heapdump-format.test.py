@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Test for the heap snapshot format of luajit_heapdump.py: the records
+# written by Writer are decoded by Reader back as is, even when every
+# record is split by the boundary of the pieces read from the file.
+#
+# Usage: heapdump-format.test.py
+
+import io
+import os
+import sys
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(TEST_DIR, '..', '..', 'src')))
+
+import luajit_heapdump as heapdump  # noqa: E402
+
+# The gct values of the object types.
+GCT = dict((name, gct) for gct, name in heapdump.TYPES.items())
+
+# The records as they are yielded by Reader: the roots are both the
+# first record and the one in the middle of the stream, the addresses
+# go both up and down, the labels are repeated and the references point
+# both before and after the object.
+RECORDS = [
+    ('roots', 0, 0, [('root', 0x7f0000001000), ('root', 0x40001000)], None),
+    ('LJ_TTAB', 0x7f0000001000, 56, [
+        ('metatable', 0x7f0000002000),
+        ('key', 0x7f0000000ff0),
+        ('value', 0x40001000),
+        ('weak key', 0x7f0000001000),
+    ], 'array 4, hash 2'),
+    ('LJ_TSTR', 0x7f0000000ff0, 24, [], None),
+    ('LJ_TFUNC', 0x40001000, 40, [
+        ('env', 0x7f0000001000),
+        ('proto', 0x40000f00),
+        ('upvalue', 0xffffffffff00),
+    ], '@test.lua:1'),
+    ('LJ_TPROTO', 0x40000f00, 1 << 20, [('chunkname', 0x7f0000000ff0)],
+     '@test.lua:1'),
+    ('roots', 0, 0, [('stack', 0x40000f00)], None),
+    ('LJ_TUPVAL', 0xffffffffff00, 48, [('value', 0)], None),
+    ('LJ_TTAB', 0x7f0000002000, 64, [], 'array 4, hash 2'),
+    ('LJ_TUDATA', 0x1, 0, [], 'Ünicode label'),
+]
+
+
+def write(records, complete=True):
+    f = io.BytesIO()
+    writer = heapdump.Writer(f, gc64=True)
+    for otype, addr, size, refs, label in records:
+        writer.record(heapdump.ROOTS if otype == 'roots' else GCT[otype],
+                      addr, size, refs, label)
+    writer.close(complete)
+    return f.getvalue()
+
+
+class TestHeapdumpFormat(unittest.TestCase):
+    def setUp(self):
+        self.read_chunk = heapdump.READ_CHUNK
+
+    def tearDown(self):
+        heapdump.READ_CHUNK = self.read_chunk
+
+    def test_roundtrip(self):
+        data = write(RECORDS)
+        # Every record is split by the piece boundary with the small
+        # pieces, including the single byte ones.
+        for chunk in (1, 2, 3, 7, 64, heapdump.READ_CHUNK):
+            heapdump.READ_CHUNK = chunk
+            reader = heapdump.Reader(io.BytesIO(data))
+            self.assertTrue(reader.gc64)
+            self.assertEqual(list(reader), RECORDS, 'chunk {}'.format(chunk))
+            self.assertFalse(reader.partial)
+
+    def test_partial(self):
+        reader = heapdump.Reader(io.BytesIO(write(RECORDS, complete=False)))
+        self.assertEqual(list(reader), RECORDS)
+        self.assertTrue(reader.partial)
+
+    def test_truncated(self):
+        data = write(RECORDS)
+        for size in (len(data) - 1, len(data) // 2):
+            heapdump.READ_CHUNK = 5
+            reader = heapdump.Reader(io.BytesIO(data[:size]))
+            with self.assertRaisesRegex(ValueError, 'truncated'):
+                list(reader)
+
+    def test_invalid(self):
+        with self.assertRaisesRegex(ValueError, 'not a LuaJIT'):
+            heapdump.Reader(io.BytesIO(b'NOTHEAP\x02\x00'))
+        data = bytearray(write(RECORDS))
+        data[len(heapdump.MAGIC)] = heapdump.VERSION + 1
+        with self.assertRaisesRegex(ValueError, 'unsupported'):
+            heapdump.Reader(io.BytesIO(bytes(data)))
+
+    def test_zigzag(self):
+        for val in (0, 1, -1, 63, -64, 64, 1 << 47, -(1 << 47)):
+            self.assertGreaterEqual(heapdump.zigzag(val), 0)
+            self.assertEqual(heapdump.unzigzag(heapdump.zigzag(val)), val)
+
+
+if __name__ == '__main__':
+    unittest.main()
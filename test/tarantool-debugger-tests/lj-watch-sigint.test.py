@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Test for lj-watch command of luajit-gdb.py against the live process.
+#
+# The sampler interrupts the process via SIGINT, so the signal must
+# never reach the process: LuaJIT aborts the running chunk with the
+# "interrupted!" error on it. The process is run under gdb and stopped
+# at os.time() call, then the samples are taken with the default SIGINT
+# handling, and the command is refused if SIGINT is passed to the
+# process.
+#
+# Usage: LUAJIT_TEST_BINARY=<path> GDB=<path> lj-watch-sigint.test.py
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+EXTENSION = os.path.normpath(os.path.join(
+    TEST_DIR, '..', '..', 'src', 'luajit-gdb.py'
+))
+LUAJIT = os.environ.get('LUAJIT_TEST_BINARY')
+GDB = os.environ.get('GDB') or shutil.which('gdb')
+
+# The workload runs forever: os.time() is called once to stop it under
+# the debugger, then the process allocates the tables and runs the GC,
+# so the samples differ.
+WORKLOAD = '''
+os.time()
+local t = {}
+local n = 0
+while true do
+  n = n + 1
+  t[n % 1000] = {n}
+end
+'''
+
+COUNT = 5
+
+
+@unittest.skipUnless(LUAJIT and GDB, 'luajit or gdb is not found')
+class TestWatchSigint(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.output = os.path.join(self.workdir, 'watch.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def run_gdb(self, *commands):
+        argv = [
+            GDB, '-batch', '-nx',
+            '-iex', 'set pagination off',
+            '-ex', 'source {}'.format(EXTENSION),
+            '-ex', 'break lj_cf_os_time',
+            '-ex', 'run',
+            '-ex', 'delete',
+        ]
+        for command in commands:
+            argv += ['-ex', command]
+        argv += [
+            '-ex', 'python print("alive: {}".format('
+                   'gdb.selected_inferior().pid != 0))',
+            '-ex', 'kill',
+            '--args', LUAJIT, '-e', WORKLOAD,
+        ]
+        env = dict(os.environ, XDG_CACHE_HOME=self.workdir)
+        proc = subprocess.run(argv, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, env=env,
+                              universal_newlines=True, timeout=300)
+        return proc.stdout
+
+    def test_default_handling(self):
+        out = self.run_gdb('lj-watch --count {} 10 {}'.format(
+            COUNT, self.output
+        ))
+        self.assertIn('{} samples'.format(COUNT), out)
+        self.assertIn('Time from the interrupt to the resume', out)
+        self.assertNotIn('watching is over', out)
+        self.assertNotIn('interrupted!', out)
+        self.assertIn('alive: True', out)
+        with open(self.output) as f:
+            # The header is followed by the samples.
+            self.assertEqual(len(f.read().splitlines()), COUNT + 1)
+
+    def test_sigint_passed(self):
+        out = self.run_gdb('handle SIGINT pass', 'lj-watch --count {} 10 {}'
+                           .format(COUNT, self.output))
+        self.assertIn('handle SIGINT stop nopass', out)
+        self.assertFalse(os.path.exists(self.output))
+        self.assertIn('alive: True', out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Test for the ports of the table hashing routines from lj_tab.c used
+# by lj-tab --stats: the main positions of the keys (hashkey) and the
+# sizes of the table parts after the rehash (countint and bestasize).
+#
+# The expected values are obtained from LuaJIT itself (x86_64, both
+# GC64 and non-GC64 builds): every key is inserted into the empty table
+# with 2^20 hash nodes, and the index of the node it occupies is its
+# main position. The rehash is triggered by inserting the string key to
+# the table with no array part and the hash part full of the integer
+# keys.
+#
+# Usage: table-hash.test.py
+
+import os
+import struct
+import sys
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(TEST_DIR, '..', '..', 'src')))
+
+import luajit_dbg_core as core  # noqa: E402
+
+HMASK = (1 << 20) - 1
+
+# The keys of the same type and value share the hash regardless of the
+# GC mode: the numbers (0, 1, 2, 42, -1, 0.5, 3.14, -2.5e10, 1e300,
+# 2^53, inf, -inf and the denormal 1e-310) and the booleans.
+NUMBERS = [
+    (0x0000000000000000, 0),
+    (0x3ff0000000000000, 724749),
+    (0x4000000000000000, 774145),
+    (0x4045000000000000, 138109),
+    (0xbff0000000000000, 724749),
+    (0x3fe0000000000000, 658969),
+    (0x40091eb851eb851f, 798887),
+    (0xc2174876e8000000, 726423),
+    (0x7e37e43c8800759c, 879981),
+    (0x4340000000000000, 1038737),
+    (0x7ff0000000000000, 466701),
+    (0xfff0000000000000, 466701),
+    (0x000012688b70e62b, 873139),
+]
+
+# The GC objects (tables, C function, userdata) and the light userdata
+# are hashed by the address.
+MAINPOS = {
+    'gc64': NUMBERS + [
+        (0xffff7fffffffffff, 0),
+        (0xfffeffffffffffff, 1),
+        (0xfffa7fc54d1ea600, 246710),
+        (0xfffa7fc54d1ea690, 115750),
+        (0xfffa7fc54d1ea648, 705534),
+        (0xfffbffc54d1ea720, 995546),
+        (0xfff9ffc54d1ea648, 540642),
+        (0xfffe000012345678, 965584),
+        (0xfffe00e9f81e98e2, 546568),
+    ],
+    'lj64': NUMBERS + [
+        (0xfffffffe8b70e62b, 0),
+        (0xfffffffd8b70e62b, 1),
+        (0xfffffff4400f1ca0, 158120),
+        (0xfffffff4400f1d18, 944732),
+        (0xfffffff4400f1cf0, 945963),
+        (0xfffffff7400f1cc8, 421882),
+        (0xfffffff3400f1d40, 682541),
+        (0xffff000012345678, 235170),
+        (0xffff00d923afa8c2, 317483),
+    ],
+}
+
+# The integer keys of the hash part and the sizes of the array and the
+# hash parts after the rehash.
+REHASH = [
+    ([1, 2, 3, 4], 5, 2),
+    ([1, 2, 3, 5, 9, 17, 33, 100], 17, 4),
+    ([1, 3, 5, 7, 9, 11, 13, 15], 17, 2),
+    ([100, 200, 300, 400], 0, 8),
+    ([0, 1, 2, 3, 4, 5, 6, 7], 9, 2),
+    ([1, 2, 4, 8, 16, 32, 64, 128], 17, 4),
+    (list(range(1, 16)) + [1000], 17, 2),
+    ([1, 2, 3, 1000, 2000, 3000, 4000, 5000], 5, 8),
+    ([-1, 1.5, 2, 3], 5, 4),
+]
+
+
+def configure(gc64):
+    def missing(*args):
+        raise RuntimeError('no debug info')
+
+    # Only the layout-independent routines are tested, so there is no
+    # inferior at all.
+    core.configure(read_memory=missing, sizeof=missing, fieldof=missing,
+                   global_state=missing, lj_64=True, lj_gc64=gc64,
+                   lj_dualnum=False, little_endian=True, x86orx64=True)
+
+
+def number(val):
+    return struct.unpack('<Q', struct.pack('<d', val))[0]
+
+
+class TestTableHash(unittest.TestCase):
+    def test_hashkey(self):
+        for mode, gc64 in (('gc64', True), ('lj64', False)):
+            configure(gc64)
+            for u64, mainpos in MAINPOS[mode]:
+                self.assertEqual(core.hashkey(u64) & HMASK, mainpos,
+                                 '{}: {:#x}'.format(mode, u64))
+
+    def test_rehash(self):
+        configure(True)
+        for keys, asize, hsize in REHASH:
+            # Mirrors rehashtab from lj_tab.c for the table with no
+            # array part on inserting the string key.
+            bins = [0] * core.LJ_MAX_ABITS
+            narray = sum(core.countint(number(k), bins) for k in keys)
+            nasize, na = core.bestasize(bins, narray)
+            hbits = core.hsize2hbits(1 + len(keys) - na)
+            self.assertEqual((nasize, 1 << hbits if hbits else 0),
+                             (asize, hsize), keys)
+
+
+if __name__ == '__main__':
+    unittest.main()